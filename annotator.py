@@ -1,5 +1,6 @@
 import ast
 import os
+import threading
 
 import cv2
 import torch
@@ -24,6 +25,8 @@ from utils import config
 from utils.cnn_worker import CNN_worker
 from utils.importer import Importer
 from utils.predictor import SAMImageSetter
+from utils.sam_embedding_cache import SAMEmbeddingCache
+from utils.sam_prefetch import SAMPrefetchWorker
 from utils.sam_predictor import load_model as sam_load_model
 from utils.sam_predictor import mask_to_seg, predict_by_points, predict_by_box
 from utils.states import DrawState
@@ -61,6 +64,12 @@ class Annotator(MainWindow):
         self.image_set = False
         self.image_setter = None
         self.queue_to_image_setter = []
+        self.sam_cache = SAMEmbeddingCache(memory_max_mb=self.settings.read_sam_cache_memory_size(),
+                                           disk_dir=self.settings.read_sam_cache_dir(),
+                                           disk_max_mb=self.settings.read_sam_cache_disk_size())
+        self.sam_prefetch = None
+        # энкодер SAM работает в одном потоке: загрузка текущего изображения или предзагрузка
+        self.sam_encoder_lock = threading.Lock()
 
         self.view.mask_end_drawing.on_mask_end_drawing.connect(self.ai_mask_end_drawing)
 
@@ -295,7 +304,10 @@ class Annotator(MainWindow):
         """
         Старт загрузки изображения в модель SAM
         """
-        self.cv2_image = cv2.imread(image_name)
+        if image_name != self.cv2_image_path or self.cv2_image is None:
+            # текущее изображение уже декодировано при открытии
+            self.cv2_image = cv2.imread(image_name)
+            self.cv2_image_path = image_name
         self.image_set = False
         self.image_setter.set_image(self.cv2_image)
         self.queue_to_image_setter = []
@@ -310,6 +322,13 @@ class Annotator(MainWindow):
         """
         return image_name
 
+    def get_prefetch_path(self, image_name):
+        """
+        Путь к файлу, который SAM получит при открытии изображения, или None, если предзагрузка невозможна
+        Кэш SAM адресуется по пикселям, поэтому предзагружать нужно тот же файл, что и get_jpg_path
+        """
+        return self.get_jpg_path(image_name)
+
     def on_image_set(self):
         """
         Завершение прогрева модели SAM. Если остались изображения в очереди - берем последнее, а очередь очищаем
@@ -321,8 +340,12 @@ class Annotator(MainWindow):
             self.set_image(jpg_path)
 
         else:
-            self.info_message(
-                "Нейросеть SAM готова к сегментации" if self.lang == 'RU' else "SAM ready to work")
+            message = "Нейросеть SAM готова к сегментации" if self.lang == 'RU' else "SAM ready to work"
+            if self.sam_prefetch:
+                self.sam_prefetch.register_access(self.image_setter.is_cache_hit)
+                stats = self.sam_prefetch.get_stats()
+                message += f" (cache {stats['hits']}/{stats['hits'] + stats['misses']})"
+            self.info_message(message)
             self.image_set = True
 
     def showSettings(self):
@@ -354,10 +377,38 @@ class Annotator(MainWindow):
         self.sam = self.load_sam()
         self.image_setter = SAMImageSetter()
         self.image_setter.set_predictor(self.sam)
+        self.image_setter.set_cache(self.sam_cache, self.settings.read_sam_model())
+        self.image_setter.set_encoder_lock(self.sam_encoder_lock)
         self.image_setter.finished.connect(self.on_image_set)
+        self.create_sam_prefetch()
         if self.tek_image_path:
             self.queue_image_to_sam(self.tek_image_path)
 
+    def create_sam_prefetch(self):
+        """
+        Фоновая предзагрузка в SAM следующих изображений списка
+        """
+        if self.sam_prefetch:
+            self.sam_prefetch.stop()
+            self.sam_prefetch.wait(5000)
+            self.sam_prefetch = None
+
+        if self.settings.read_sam_prefetch_num() > 0 and SAMPrefetchWorker.is_supported(self.sam):
+            self.sam_prefetch = SAMPrefetchWorker(self.sam, self.sam_cache, self.settings.read_sam_model(),
+                                                  is_busy=self.image_setter.isRunning,
+                                                  encoder_lock=self.sam_encoder_lock)
+
+    def on_image_list_position_changed(self):
+        """
+        Постановка соседних изображений в очередь предзагрузки SAM. Задания для прежней позиции отменяются
+        """
+        if not self.sam_prefetch:
+            return
+
+        names = self.images_list_widget.get_neighbour_names(self.settings.read_sam_prefetch_num())
+        paths = [self.get_prefetch_path(os.path.join(self.dataset_dir, name)) for name in names]
+        self.sam_prefetch.schedule([path for path in paths if path])
+
     def handle_detection_model(self):
         """
         Загрузка модели для обнаружения объектов
@@ -497,6 +548,12 @@ class Annotator(MainWindow):
             hf.save_mask_as_image(sam_mask, mask_name)
         points_mass = mask_to_seg(sam_mask, simplify_factor=simplify_factor)
 
+        self.add_sam_points_to_scene(points_mass, cls_num=cls_num)
+
+    def add_sam_points_to_scene(self, points_mass, cls_num=None):
+        """
+        Добавление на сцену полигонов, полученных из масок SAM. Слишком маленькие полигоны отбрасываются
+        """
         if len(points_mass) > 0:
             filtered_points_mass = []
             for points in points_mass:
@@ -652,6 +709,9 @@ class Annotator(MainWindow):
         if self.image_setter:
             self.image_setter.running = False  # Изменяем флаг выполнения
             self.image_setter.wait(5000)  # Даем время, чтобы закончить
+        if self.sam_prefetch:
+            self.sam_prefetch.stop()
+            self.sam_prefetch.wait(5000)
         if self.gd_worker:
             self.gd_worker.running = False
             self.gd_worker.wait(5000)
@@ -849,7 +909,9 @@ class Annotator(MainWindow):
                                             grounding_dino_model=self.gd_model,
                                             box_threshold=self.prompt_input_dialog.get_box_threshold(),
                                             text_threshold=self.prompt_input_dialog.get_text_threshold(),
-                                            prompt=prompt)
+                                            prompt=prompt,
+                                            simplify_factor=float(self.settings.read_simplify_factor()),
+                                            min_size=self.settings.read_clear_sam_size())
 
         self.progress_toolbar.set_percent(10)
 
@@ -883,12 +945,13 @@ class Annotator(MainWindow):
         """
         Завершение обнаружения объектов по текстовому prompt GroundingDINO
         """
-        masks = self.gd_worker.getMasks()
+        # маски уже переведены в полигоны в потоке GroundingSAMWorker
+        polygons = self.gd_worker.getPolygons()
         self.progress_toolbar.set_percent(50)
 
-        for i, mask in enumerate(masks):
-            self.add_sam_polygon_to_scene(mask, cls_num=self.prompt_cls_num)
-            self.progress_toolbar.set_percent(50 + int(i + 1) * 100.0 / len(masks))
+        points_mass = [points for mask_polygons in polygons for points in mask_polygons]
+        self.add_sam_points_to_scene(points_mass, cls_num=self.prompt_cls_num)
+        self.progress_toolbar.set_percent(100)
 
         self.labels_count_conn.on_labels_count_change.emit(self.labels_on_tek_image.count())
         self.progress_toolbar.hide_progressbar()
@@ -923,17 +986,30 @@ class Annotator(MainWindow):
         self.CNN_worker = CNN_worker(model=self.yolo, conf_thres=conf_thres_set, iou_thres=iou_thres_set,
                                      img_name=None, img_path=None, simplify_factor=self.settings.read_simplify_factor(),
                                      images_list=images_list, model_name=self.settings.read_detector_model(),
-                                     scanning=None, nc=len(names.keys()))
+                                     scanning=None, nc=len(names.keys()), pipelined=True,
+                                     batch_size=self.settings.read_detector_batch_size())
 
         self.CNN_worker.started.connect(self.on_cnn_started)
 
         self.progress_toolbar.set_signal(self.CNN_worker.psnt_connection.percent)
+        self.CNN_worker.psnt_connection.stats.connect(self.on_cnn_stage_stats)
+        self.CNN_worker.info_conn.info_message.connect(self.info_message)
 
         self.CNN_worker.finished.connect(self.on_all_images_finished)
 
         if not self.CNN_worker.isRunning():
             self.CNN_worker.start()
 
+    def on_cnn_stage_stats(self, stats):
+        """
+        Скорость стадий конвейерной детекции (изображений в секунду) в строке состояния
+        """
+        names = {'decode': 'чтение', 'predict': 'детекция', 'polygons': 'полигоны'} if self.lang == 'RU' else {}
+        unit = 'изобр./с' if self.lang == 'RU' else 'img/s'
+        message = ', '.join(f"{names.get(stage, stage)}: {stat['throughput']:0.1f} {unit}"
+                            for stage, stat in stats.items())
+        self.info_message(message)
+
     def on_all_images_finished(self):
         """
         При завершении классификации всех изображений
@@ -8,6 +8,7 @@ import utils.help_functions as hf
 from annotator import Annotator
 from ui.custom_widgets.edit_with_button import EditWithButton
 from utils import config
+from utils.geo_export import export_to_geo, get_geo_driver
 from utils.pil_translate import GeoTIFF
 
 
@@ -109,6 +110,15 @@ class Detector(Annotator):
 
         return jpg_path
 
+    def get_prefetch_path(self, image_name):
+        """
+        GeoTIFF предзагружается, только если уже переведен в jpg: перевод в потоке GUI дольше, чем выигрыш от кэша
+        """
+        suffix = image_name.split('.')[-1]
+        if suffix in ['tif', 'tiff']:
+            return self.map_geotiff_names.get(image_name)
+        return image_name
+
     def open_image(self, image_name):
 
         message = f"Загружаю {os.path.basename(image_name)}..." if self.settings.read_lang() == 'RU' else f"Loading {os.path.basename(image_name)}..."
@@ -130,9 +140,10 @@ class Detector(Annotator):
         self.esri_path_window = EditWithButton(None, in_separate_window=True,
                                                theme=self.settings.read_theme(),
                                                on_button_clicked_callback=self.on_input_esri_path,
-                                               is_dir=False, dialog_text='ESRI shapefile name',
-                                               title=f"Choose ESRI shapefile name", file_type='shp',
-                                               placeholder='ESRI shapefile name', is_existing_file_only=False)
+                                               is_dir=False, dialog_text='Geo file name (.shp, .gpkg, .geojson)',
+                                               title=f"Choose geo file name", file_type='shp',
+                                               placeholder='Geo file name (.shp, .gpkg, .geojson)',
+                                               is_existing_file_only=False)
         self.esri_path_window.show()
 
     def on_input_esri_path(self):
@@ -141,50 +152,45 @@ class Detector(Annotator):
 
         self.esri_path_window.hide()
 
-        if hf.get_extension(esri_filename) != 'shp':
+        if not get_geo_driver(esri_filename):
 
             if self.settings.read_lang() == 'RU':
-                message = f"Имя ESRI shapefile файла должно иметь расширение .shp"
+                message = f"Файл экспорта должен иметь расширение .shp, .gpkg или .geojson"
             else:
-                message = f"ESRI shapefile has to have '.shp' extension."
+                message = f"Export file has to have '.shp', '.gpkg' or '.geojson' extension."
 
             self.statusBar().showMessage(
                 message, 3000)
 
             return
 
-        if self.lrm:
-            esri_shapes = []
-            view_shapes = self.view.get_all_shapes()
-            for shape in view_shapes:
-                shape_id = shape['id']
-                is_found = False
-                for det_shape in self.detected_shapes:
-                    if det_shape['id'] == shape_id:
-                        esri_shapes.append(det_shape)
-                        is_found = True
-                        break
-                if not is_found:
-                    esri_shapes.append(shape)
-
-            hf.convert_shapes_to_esri(esri_shapes, self.tek_image_path, out_shapefile=esri_filename)
+        self.save_view_to_project()
+
+        # для текущего изображения берем результаты детектора - у них есть conf
+        esri_shapes = []
+        view_shapes = self.view.get_all_shapes()
+        detected_by_id = {det_shape['id']: det_shape for det_shape in self.detected_shapes}
+        for shape in view_shapes:
+            esri_shapes.append(detected_by_id.get(shape['id'], shape))
+
+        objects_num = export_to_geo(self.project_data.get_data()['images'], self.dataset_dir, esri_filename,
+                                    override_shapes={self.tek_image_name: esri_shapes})
 
+        format_name = get_geo_driver(esri_filename)
+        if objects_num:
             if self.settings.read_lang() == 'RU':
-                message = f"ESRI shapefile файл создан. Добавлено {len(esri_shapes)} объектов"
+                message = f"Файл {format_name} создан. Добавлено {objects_num} объектов"
             else:
-                message = f"ESRI shapefile has been created with {len(esri_shapes)} objects."
-
-            self.statusBar().showMessage(
-                message, 3000)
+                message = f"{format_name} file has been created with {objects_num} objects."
 
         else:
             if self.settings.read_lang() == 'RU':
-                message = f"ESRI shapefile файл не создан. Не найден файл геоданных"
+                message = f"Файл {format_name} не создан. Нет разметки на изображениях с геопривязкой"
             else:
-                message = f"Can't create ESRI shapefile. No geo data"
+                message = f"Can't create {format_name} file. No labels on georeferenced images"
 
-            self.statusBar().showMessage(
-                message, 3000)
+        self.statusBar().showMessage(
+            message, 3000)
 
     def toggle_act(self, is_active):
         super(Detector, self).toggle_act(is_active)
@@ -204,7 +210,11 @@ class Detector(Annotator):
     def detect_scan(self):
         self.scanning_mode = True
 
-        self.detect()
+        # при сканировании исходное изображение читается по окнам, временный JPEG не нужен
+        img_name = os.path.basename(self.tek_image_path)
+        img_path = os.path.dirname(self.tek_image_path)
+
+        self.run_detection(img_name=img_name, img_path=img_path)
 
 
 if __name__ == '__main__':
@@ -14,6 +14,8 @@ from groundingdino.models import build_model
 from groundingdino.util.slconfig import SLConfig
 from groundingdino.util.utils import clean_state_dict, get_phrases_from_posmap
 
+from utils.sam_predictor import predict_batch
+
 
 def load_image(image_path):
     # load image
@@ -161,18 +163,13 @@ def predict(predictor, image_path, text_prompt, output_dir=None, grounded_checkp
         boxes_filt[i][2:] += boxes_filt[i][:2]
 
     boxes_filt = boxes_filt.cpu()
-    transformed_boxes = predictor.transform.apply_boxes_torch(boxes_filt, (H, W)).to(device)
 
-    if len(transformed_boxes.size()) == 0:
+    if boxes_filt.size(0) == 0:
         return []
 
     try:
-        masks, _, _ = predictor.predict_torch(
-            point_coords=None,
-            point_labels=None,
-            boxes=transformed_boxes.to(device),
-            multimask_output=False,
-        )
+        # все боксы декодируются пачками, а не по одному
+        masks, _ = predict_batch(predictor, boxes=boxes_filt.numpy(), multimask_output=False)
     except:
         print("An error in GroundingDINO mask creation")
         return []
@@ -183,7 +180,7 @@ def predict(predictor, image_path, text_prompt, output_dir=None, grounded_checkp
         plt.figure(figsize=(10, 10))
         plt.imshow(image)
         for mask in masks:
-            show_mask(mask.cpu().numpy(), plt.gca(), random_color=True)
+            show_mask(mask, plt.gca(), random_color=True)
         for box, label in zip(boxes_filt, pred_phrases):
             show_box(box.numpy(), plt.gca(), label)
 
@@ -193,6 +190,6 @@ def predict(predictor, image_path, text_prompt, output_dir=None, grounded_checkp
             bbox_inches="tight", dpi=300, pad_inches=0.0
         )
 
-        save_mask_data(output_dir, masks, boxes_filt, pred_phrases)
+        save_mask_data(output_dir, torch.from_numpy(masks[:, None]), boxes_filt, pred_phrases)
 
-    return [mask.cpu().numpy() for mask in masks]
+    return masks
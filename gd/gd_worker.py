@@ -1,4 +1,5 @@
 from PySide2 import QtCore
+from utils.sam_predictor import masks_to_polygons
 from .gd_sam2 import predict
 
 
@@ -7,7 +8,12 @@ class GroundingSAMWorker(QtCore.QThread):
     def __init__(self, config_file=None, grounded_checkpoint=None,
                  sam_predictor=None, grounding_dino_model=None,
                  tek_image_path=None, box_threshold=0.4, text_threshold=0.55,
-                 prompt=None, device='cuda', output_dir=None):
+                 prompt=None, device='cuda', output_dir=None, simplify_factor=None, min_size=80,
+                 fast_contours=False):
+        """
+        simplify_factor - если задан, маски сразу переводятся в полигоны (см. getPolygons)
+        fast_contours - контуры через cv2 (masks_to_polygons(fast=True)), по умолчанию - как add_sam_polygon_to_scene
+        """
         super(GroundingSAMWorker, self).__init__()
         self.config_file = config_file
         self.grounded_checkpoint = grounded_checkpoint
@@ -16,6 +22,10 @@ class GroundingSAMWorker(QtCore.QThread):
         self.tek_image_path = tek_image_path
         self.prompt = prompt
         self.masks = []
+        self.polygons = []
+        self.simplify_factor = simplify_factor
+        self.min_size = min_size
+        self.fast_contours = fast_contours
         self.device = device
         self.output_dir = output_dir
         self.box_threshold = box_threshold
@@ -42,5 +52,15 @@ class GroundingSAMWorker(QtCore.QThread):
                              box_threshold=self.box_threshold, text_threshold=self.text_threshold, device=self.device,
                              config_file=self.config_file)
 
+        if self.simplify_factor is not None and len(self.masks):
+            self.polygons = masks_to_polygons(self.masks, simplify_factor=self.simplify_factor,
+                                              min_size=self.min_size, fast=self.fast_contours)
+
     def getMasks(self):
         return self.masks
+
+    def getPolygons(self):
+        """
+        Полигоны для каждой маски, список [[x, y], ...]
+        """
+        return self.polygons
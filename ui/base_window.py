@@ -28,11 +28,15 @@ from ui.shortcuts_editor import ShortCutsEditor
 from ui.signals_and_slots import ImagesPanelCountConnection, LabelsPanelCountConnection, ThemeChangeConnection, \
     RubberBandModeConnection
 from ui.splash_screen import MovieSplashScreen
+from ui.tiled_pixmap_item import TiledPixmapItem
 from ui.view import GraphicsView
 from utils import config
 from utils import help_functions as hf
+from utils.autosave import AutosaveWorker, ProjectJournal, compact_entries
+from utils.image_pyramid import PyramidDiskCache, open_image_pyramid
 from utils.importer import Importer
 from utils.project import ProjectHandler
+from utils.pyramid_worker import PyramidBuilderWorker
 from utils.settings_handler import AppSettings
 from utils.settings_handler import shortcuts as shortcuts_init
 from utils.states import DrawState, WindowState, ViewState
@@ -129,6 +133,23 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.lrm = None  # ЛРМ снимка
 
+        # Изображение, декодированное один раз для отображения и обработки, и путь к нему
+        self.cv2_image = None
+        self.cv2_image_path = None
+        self.pyramid_cache = PyramidDiskCache(self.settings.read_pyramid_cache_dir(),
+                                              max_mb=self.settings.read_pyramid_cache_size())
+        # Потоки построения пирамид больших изображений
+        self.pyramid_builders = []
+
+        # Сохранение проекта в фоне и журнал несохраненных изменений
+        self.autosaver = AutosaveWorker()
+        self.autosaver.on_save.on_finished.connect(self.on_project_saved)
+        self.autosave_timer = QtCore.QTimer()
+        self.autosave_timer.timeout.connect(self.autosave)
+        autosave_interval = self.settings.read_autosave_interval()
+        if autosave_interval > 0:
+            self.autosave_timer.start(autosave_interval * 1000)
+
         self.image_types = ['jpg', 'png', 'tiff', 'jpeg', 'tif']
 
         self.dataset_images = []
@@ -915,6 +936,13 @@ class MainWindow(QtWidgets.QMainWindow):
         self.selected_count_conn.on_labels_count_change.emit(len(items))
 
         self.view.setFocus()
+        self.on_image_list_position_changed()
+
+    def on_image_list_position_changed(self):
+        """
+        Текущее изображение в списке изменилось. Переопределяется в наследниках, например, для предзагрузки
+        """
+        pass
 
     def labels_on_tek_image_clicked(self, item):
         item_id = item.text().split(" ")[-1]
@@ -950,7 +978,7 @@ class MainWindow(QtWidgets.QMainWindow):
             self.project_data.export_finished.on_finished.connect(self.on_project_export)
             self.project_data.export(export_dir, export_map=export_map, format=export_format, variant_idx=idx,
                                      splits=splits, sim=sim_idx, is_filter_null=is_filter_null,
-                                     new_image_size=new_image_size)
+                                     new_image_size=new_image_size, incremental=True)
 
     def importFromYOLOBox(self):
 
@@ -1363,14 +1391,56 @@ class MainWindow(QtWidgets.QMainWindow):
         self.cls_combo.setEnabled(is_active)
         self.load_lrm_data_act.setEnabled(is_active)
 
+    def set_view_image(self, image_name):
+        """
+        Отображение изображения. Декодируется один раз, тот же массив сохраняется в cv2_image
+        Большие изображения отображаются тайлами из пирамиды, которая кэшируется на диске
+        """
+        image, pyramid, is_complete = open_image_pyramid(image_name, cache=self.pyramid_cache)
+        if image is None:
+            # формат, который не читает cv2
+            self.view.setPixmap(QtGui.QPixmap(image_name))
+        else:
+            self.view.setImage(image, pyramid)
+
+        self.cv2_image = image
+        self.cv2_image_path = image_name
+
+        if not is_complete:
+            # пока строится полная пирамида, изображение отображается по временной
+            self.start_pyramid_builder(image_name, image)
+
+    def start_pyramid_builder(self, image_name, image):
+        if any(builder.image_path == image_name for builder in self.pyramid_builders):
+            # пирамида этого изображения уже строится
+            return
+
+        builder = PyramidBuilderWorker(image_name, image, cache=self.pyramid_cache)
+        builder.finished.connect(lambda: self.on_pyramid_built(builder))
+        # ссылка на поток хранится до его окончания
+        self.pyramid_builders.append(builder)
+        builder.start()
+
+    def on_pyramid_built(self, builder):
+        if builder in self.pyramid_builders:
+            self.pyramid_builders.remove(builder)
+
+        pyramid = builder.get_pyramid()
+        if pyramid is None or builder.image_path != self.cv2_image_path:
+            # за время построения открыто другое изображение, пирамида уже в кэше
+            return
+
+        pixmap_item = self.view.pixmap_item
+        if isinstance(pixmap_item, TiledPixmapItem):
+            pixmap_item.set_pyramid(pyramid)
+        # уровень 0 из кэша открыт через mmap, декодированная копия в памяти освобождается
+        self.cv2_image = pyramid.image
+
     def open_image(self, image_name):
 
-        self.view.setPixmap(QtGui.QPixmap(image_name))
+        self.set_view_image(image_name)
         self.view.fitInView(self.view.pixmap_item, QtCore.Qt.KeepAspectRatio)
 
-        image = cv2.imread(image_name)
-        self.cv2_image = image
-
         self.image_set = True
         self.toggle_act(self.image_set)
 
@@ -1412,11 +1482,12 @@ class MainWindow(QtWidgets.QMainWindow):
         if dialog.exec_():
             painter = QPainter(self.printer)
             rect = painter.viewport()
-            size = self.view.pixmap_item.pixmap().size()
+            image_rect = QtCore.QRect(QtCore.QPoint(0, 0), self.view.get_image_size())
+            size = image_rect.size()
             size.scale(rect.size(), QtCore.Qt.KeepAspectRatio)
             painter.setViewport(rect.x(), rect.y(), size.width(), size.height())
-            painter.setWindow(self.view.pixmap_item.pixmap().rect())
-            painter.drawPixmap(0, 0, self.view.pixmap_item.pixmap())
+            painter.setWindow(image_rect)
+            painter.drawPixmap(image_rect, self.view.get_print_pixmap())
 
     def about(self):
         """
@@ -1583,10 +1654,16 @@ class MainWindow(QtWidgets.QMainWindow):
             return
 
         if self.loaded_proj_name:
+            # несохраненные изменения закрываемого проекта остаются в его журнале
+            self.autosave()
             self.close_project()
 
+        # проект мог еще сохраняться в фоне
+        self.autosaver.wait_saved()
+
         self.loaded_proj_name = project_name
         self.project_data.load(project_name)
+        self.recover_from_journal(project_name)
         self.on_load_project()
 
     def on_load_project(self):
@@ -1617,7 +1694,7 @@ class MainWindow(QtWidgets.QMainWindow):
         loaded_proj_name, _ = QFileDialog.getOpenFileName(self,
                                                           title,
                                                           last_opened_path,
-                                                          'JSON Proj File (*.json)')
+                                                          'JSON Proj File (*.json);;SAMA Packed Proj File (*.sama)')
 
         if loaded_proj_name:
             self.settings.write_last_opened_path(os.path.dirname(loaded_proj_name))
@@ -1652,19 +1729,13 @@ class MainWindow(QtWidgets.QMainWindow):
         """
 
         if self.loaded_proj_name:
-            self.view.start_circle_progress()
-
             self.set_labels_color()  # сохранение информации о цветах масок
             self.save_view_to_project()
-
-            self.project_data.save(self.loaded_proj_name)
-
             self.fill_project_labels()
 
-            self.view.stop_circle_progress()
-
-            self.info_message(
-                f"Проект успешно сохранен" if self.lang == 'RU' else "Project is saved")
+            # запись идет в фоне, по окончании - on_project_saved
+            self.autosaver.enqueue_snapshot(self.loaded_proj_name,
+                                            self.project_data.make_snapshot(self.loaded_proj_name))
 
         else:
             self.save_project_as()
@@ -1677,7 +1748,7 @@ class MainWindow(QtWidgets.QMainWindow):
             proj_name, _ = QFileDialog.getSaveFileName(self,
                                                        'Выберите имя нового проекта' if self.settings.read_lang == 'RU' else 'Type new project name',
                                                        'projects',
-                                                       'JSON Proj File (*.json)')
+                                                       'JSON Proj File (*.json);;SAMA Packed Proj File (*.sama)')
 
         if proj_name:
             self.loaded_proj_name = proj_name
@@ -1686,14 +1757,59 @@ class MainWindow(QtWidgets.QMainWindow):
             self.fill_project_labels()
             self.loaded_proj_name = proj_name
 
-            self.view.start_circle_progress()
-            self.project_data.save(proj_name)
-            self.view.stop_circle_progress()
+            self.autosaver.enqueue_snapshot(proj_name, self.project_data.make_snapshot(proj_name))
 
-    def on_project_saved(self):
+    def on_project_saved(self, is_ok=True):
+        self.project_data.finish_snapshot(is_ok)
 
-        self.info_message(
-            f"Проект успешно сохранен" if self.lang == 'RU' else "Project is saved")
+        if is_ok:
+            self.info_message(
+                f"Проект успешно сохранен" if self.lang == 'RU' else "Project is saved")
+        else:
+            self.info_message(
+                f"Ошибка сохранения проекта" if self.lang == 'RU' else "Error in saving project")
+
+    def autosave(self):
+        """
+        Дозапись изменений проекта в журнал (в фоне). Полностью проект сохраняется только по команде пользователя
+        """
+        if not self.loaded_proj_name or not self.project_data.is_loaded:
+            return
+
+        if self.window_state == WindowState.normal:
+            self.write_scene_to_project_data()
+
+        entries = self.project_data.take_journal_entries()
+        if entries:
+            self.autosaver.enqueue_journal(self.loaded_proj_name, entries)
+
+    def recover_from_journal(self, project_name):
+        """
+        Восстановление изменений, не сохраненных из-за аварийного завершения, из журнала проекта
+        """
+        journal = ProjectJournal(project_name)
+        if not journal.exists():
+            return
+
+        entries = journal.read()
+        if not entries:
+            journal.remove()
+            return
+
+        msgbox = QMessageBox()
+        msgbox.setIcon(QMessageBox.Question)
+        msgbox.setWindowTitle("Восстановление проекта" if self.lang == 'RU' else "Project recovery")
+        msgbox.setText(
+            "Найдены несохраненные изменения проекта. Восстановить?" if self.lang == 'RU' else
+            "Unsaved project changes were found. Recover them?")
+        msgbox.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
+
+        if msgbox.exec() == QMessageBox.Yes:
+            self.project_data.apply_journal_entries(entries)
+            # журнал переписывается без оборванной записи, чтобы к нему можно было дописывать
+            journal.write(journal.read_header(), compact_entries(entries))
+        else:
+            journal.remove()
 
     def zoomIn(self):
         """
@@ -1868,23 +1984,22 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def add_image_shapes_to_view(self, im_project_data):
         if im_project_data:
+            shapes = im_project_data["shapes"]
 
-            for shape in im_project_data["shapes"]:
-                cls_num = shape["cls_num"]
-                cls_name = self.cls_combo.itemText(cls_num)
-                points = shape["points"]
-                alpha_tek = self.settings.read_alpha()
-                alpha_edge = self.settings.read_edges_alpha()
+            # настройки отображения читаются один раз на изображение
+            alpha_tek = self.settings.read_alpha()
+            alpha_edge = self.settings.read_edges_alpha()
+            label_text_params = self.settings.read_label_text_params()
 
-                color = self.project_data.get_label_color(cls_name)
+            colors = {}
+            texts = {}
+            for cls_num in set(shape["cls_num"] for shape in shapes):
+                cls_name = self.cls_combo.itemText(cls_num)
+                colors[cls_num] = self.project_data.get_label_color(cls_name)
+                texts[cls_num] = None if label_text_params['hide'] else cls_name
 
-                label_text_params = self.settings.read_label_text_params()
-                if label_text_params['hide']:
-                    text = None
-                else:
-                    text = cls_name
-                self.view.add_polygon_to_scene(cls_num, points, color=color, alpha=alpha_tek, id=shape["id"], text=text,
-                                               alpha_edge=alpha_edge)
+            self.view.add_polygons_to_scene(shapes, colors=colors, texts=texts, alpha=alpha_tek, alpha_edge=alpha_edge,
+                                            label_text_params=label_text_params)
 
     def load_image_data(self, image_name):
         # Проверка наличия записи о цветах полигонов
@@ -1960,7 +2075,7 @@ class MainWindow(QtWidgets.QMainWindow):
         if is_tek_image_changed:
             self.open_image(self.tek_image_path)
         else:
-            self.view.setPixmap(QtGui.QPixmap(self.tek_image_path))
+            self.set_view_image(self.tek_image_path)
 
         self.load_image_data(self.tek_image_name)
         self.save_view_to_project()
@@ -2014,6 +2129,7 @@ class MainWindow(QtWidgets.QMainWindow):
             self.tek_image_path = os.path.join(self.dataset_dir, next_im_name)
             self.reload_image(is_tek_image_changed=True)
             self.images_list_widget.move_next()
+            self.on_image_list_position_changed()
 
     def go_before(self):
 
@@ -2029,6 +2145,7 @@ class MainWindow(QtWidgets.QMainWindow):
             self.tek_image_path = os.path.join(self.dataset_dir, before_im_name)
             self.reload_image(is_tek_image_changed=True)
             self.images_list_widget.move_before()
+            self.on_image_list_position_changed()
 
     def copy_label(self):
         self.view.copy_active_item_to_buffer()
@@ -2044,6 +2161,9 @@ class MainWindow(QtWidgets.QMainWindow):
         self.hide()  # Скрываем окно
 
         self.write_size_pos()
+        if self.loaded_proj_name:
+            # изменения не сохраняются по выбору пользователя - журнал не нужен
+            self.autosaver.enqueue_discard(self.loaded_proj_name)
         self.close_project()
         self.is_asked_before_close = True
 
@@ -2055,6 +2175,10 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def closeEvent(self, event):
         if self.is_asked_before_close:
+            self.autosave_timer.stop()
+            self.autosaver.stop()  # дожидаемся окончания записи проекта
+            for builder in self.pyramid_builders:
+                builder.wait()
             hf.clear_temp_folder(os.getcwd())
             event.accept()
         else:
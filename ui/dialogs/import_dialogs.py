@@ -8,10 +8,17 @@ from PyQt5.QtCore import Qt
 from PyQt5.QtWidgets import QLabel, QFormLayout, QCheckBox, QMessageBox
 from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QProgressBar, QApplication
 
+try:
+    import ijson  # потоковая проверка больших COCO файлов
+except ImportError:
+    ijson = None
+
 from ui.custom_widgets.edit_with_button import EditWithButton
 from ui.custom_widgets.styled_widgets import StyledComboBox
 from utils.settings_handler import AppSettings
 
+COCO_STREAM_FILE_SIZE = 200 * 1024 * 1024  # COCO файлы больше этого размера читаются потоково
+
 
 def show_message(text, title):
     msgbox = QMessageBox()
@@ -482,6 +489,16 @@ class ImportFromCOCODialog(QWidget):
         coco_name = self.coco_edit_with_button.getEditText()
 
         if coco_name:
+            if ijson and os.path.getsize(coco_name) > COCO_STREAM_FILE_SIZE:
+                # большой файл целиком не загружаем, Importer прочитает его потоково
+                if self.check_coco_stream(coco_name):
+                    self.data['coco_json'] = None
+                    self.data['coco_name'] = coco_name
+                else:
+                    self.show_coco_error(coco_name)
+                    self.data = None
+                return
+
             with open(coco_name, 'r') as f:
 
                 data = ujson.load(f)
@@ -489,6 +506,7 @@ class ImportFromCOCODialog(QWidget):
                     self.data['coco_json'] = data
                     self.data['coco_name'] = coco_name
                 else:
+                    self.show_coco_error(coco_name)
                     self.data = None
 
     def get_coco_name(self):
@@ -514,6 +532,35 @@ class ImportFromCOCODialog(QWidget):
 
         return True
 
+    def check_coco_stream(self, coco_name):
+        """
+        Проверка check_coco без загрузки файла в память: ключи верхнего уровня читаются потоково через ijson
+        """
+        coco_keys = {'info', 'licenses', 'images', 'annotations', 'categories'}
+        found_keys = set()
+        try:
+            with open(coco_name, 'rb') as f:
+                for prefix, event, value in ijson.parse(f):
+                    if prefix == '' and event == 'map_key':
+                        found_keys.add(value)
+                        if coco_keys <= found_keys:
+                            return True
+        except (ijson.JSONError, ValueError, OSError):
+            return False
+
+        return False
+
+    def show_coco_error(self, coco_name):
+        if self.lang == 'RU':
+            text = f"Файл {os.path.basename(coco_name)} не является файлом разметки COCO.\n" \
+                   f"Нужны ключи: info, licenses, images, annotations, categories"
+            title = "Ошибка импорта"
+        else:
+            text = f"{os.path.basename(coco_name)} is not a valid COCO annotation file.\n" \
+                   f"Required keys: info, licenses, images, annotations, categories"
+            title = "Import error"
+        show_message(text, title)
+
     def showEvent(self, event):
         for lbl in self.labels:
             lbl.setMaximumWidth(self.labels[0].width())
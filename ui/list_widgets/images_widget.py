@@ -97,6 +97,26 @@ class ImagesWidget(QListWidget):
             return
         return self.item(before_idx).text()
 
+    def get_neighbour_names(self, next_num, before_num=1):
+        """
+        Имена изображений вокруг текущего в порядке вероятного перехода:
+        сначала next_num следующих, затем before_num предыдущих. Список замкнут, как в get_next_name
+        """
+        count = self.count()
+        if count < 2:
+            return []
+
+        current_idx = max(self.currentRow(), 0)
+        indexes = [(current_idx + k) % count for k in range(1, next_num + 1)]
+        indexes += [(current_idx - k) % count for k in range(1, before_num + 1)]
+
+        names = []
+        for idx in indexes:
+            name = self.item(idx).text()
+            if idx != current_idx and name not in names:
+                names.append(name)
+        return names
+
     def move_before(self):
         before_idx = self.get_idx_before()
         if before_idx == -1:
@@ -1,5 +1,6 @@
 import math
 
+import numpy as np
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtGui import QColor
 from PyQt5.QtGui import QPolygonF, QPen
@@ -38,8 +39,12 @@ def check_polygon_item(item):
     return False
 
 
-def make_label(text, text_pos, color):
-    label_text_params = settings.read_label_text_params()
+def make_label(text, text_pos, color, label_text_params=None):
+    """
+    label_text_params - параметры текста из settings.read_label_text_params(). Если None - читаются из настроек
+    """
+    if label_text_params is None:
+        label_text_params = settings.read_label_text_params()
     label = QtWidgets.QGraphicsTextItem()
     label.setHtml(
         f"<div style='background-color: rgba(0,0,0, 0.7)'>"
@@ -167,9 +172,17 @@ class GrEllipsLabel(QtWidgets.QGraphicsEllipseItem):
         self.text = text
         self.text_pos = text_pos
 
+        # ShapeHitIndex, в котором зарегистрирован эллипс
+        self.hit_index = None
+
         if text and text_pos:
             self.label = make_label(text, text_pos, self.color)
 
+    def setRect(self, *args):
+        super().setRect(*args)
+        if self.hit_index is not None:
+            self.hit_index.update(self)
+
     def set_cls_num(self, cls_num):
         self.cls_num = cls_num
 
@@ -285,7 +298,7 @@ class GrPolygonLabel(QtWidgets.QGraphicsPolygonItem):
     """
 
     def __init__(self, parent=None, cls_num=0, color=None, alpha_percent=50, id=0, text=None, text_pos=None,
-                 alpha_edge=None):
+                 alpha_edge=None, label_text_params=None):
 
         super().__init__(parent)
         self.cls_num = cls_num
@@ -303,8 +316,16 @@ class GrPolygonLabel(QtWidgets.QGraphicsPolygonItem):
         self.text = text
         self.text_pos = text_pos
 
+        # ShapeHitIndex, в котором зарегистрирован полигон
+        self.hit_index = None
+
         if text and text_pos:
-            self.label = make_label(text, text_pos, self.color)
+            self.label = make_label(text, text_pos, self.color, label_text_params=label_text_params)
+
+    def setPolygon(self, polygon):
+        super().setPolygon(polygon)
+        if self.hit_index is not None:
+            self.hit_index.update(self)
 
     def is_self_intersected(self):
         pol = self.polygon()
@@ -359,6 +380,213 @@ class GrPolygonLabel(QtWidgets.QGraphicsPolygonItem):
         return txt
 
 
+class ShapeItemsRegistry:
+    """
+    Индекс полигонов (GrPolygonLabel, GrEllipsLabel) сцены: id -> полигоны, номер класса -> полигоны
+    Заменяет перебор scene().items() при поиске по id и классу
+    Порядок items() и get_by_cls() - от последнего добавленного к первому, как у scene().items()
+    """
+
+    def __init__(self):
+        self.items_order = {}
+        self.by_id = {}
+        self.by_cls = {}
+        self.hit_index = ShapeHitIndex()
+
+    def __len__(self):
+        return len(self.items_order)
+
+    def __contains__(self, item):
+        return item in self.items_order
+
+    def add(self, item):
+        if item in self.items_order:
+            return
+        self.items_order[item] = item.cls_num
+        self.by_id.setdefault(item.id, []).append(item)
+        self.by_cls.setdefault(item.cls_num, {})[item] = None
+        self.hit_index.add(item)
+
+    def remove(self, item):
+        if item not in self.items_order:
+            return
+        cls_num = self.items_order.pop(item)
+        self.hit_index.remove(item)
+
+        same_id = self.by_id.get(item.id, [])
+        if item in same_id:
+            same_id.remove(item)
+        if not same_id:
+            self.by_id.pop(item.id, None)
+
+        cls_items = self.by_cls.get(cls_num, {})
+        cls_items.pop(item, None)
+        if not cls_items:
+            self.by_cls.pop(cls_num, None)
+
+    def update_cls(self, item):
+        """
+        Вызывается после смены номера класса полигона
+        """
+        if item not in self.items_order:
+            return
+
+        old_cls_num = self.items_order[item]
+        if old_cls_num == item.cls_num:
+            return
+
+        cls_items = self.by_cls.get(old_cls_num, {})
+        cls_items.pop(item, None)
+        if not cls_items:
+            self.by_cls.pop(old_cls_num, None)
+
+        self.items_order[item] = item.cls_num
+        self.by_cls.setdefault(item.cls_num, {})[item] = None
+
+    def get_by_id(self, item_id):
+        same_id = self.by_id.get(item_id)
+        if not same_id:
+            return None
+        return same_id[-1]
+
+    def get_all_by_id(self, item_id):
+        return list(reversed(self.by_id.get(item_id, [])))
+
+    def get_by_cls(self, cls_num):
+        return list(reversed(self.by_cls.get(cls_num, {})))
+
+    def items(self):
+        return list(reversed(self.items_order))
+
+    def clear(self):
+        self.items_order.clear()
+        self.by_id.clear()
+        self.by_cls.clear()
+        self.hit_index.clear()
+
+
+class ShapeHitIndex:
+    """
+    Пространственный индекс полигонов для поиска по точке (клик, наведение курсора)
+    Габариты полигонов раскладываются по ячейкам равномерной сетки cell_size x cell_size,
+    вершины хранятся в np.ndarray (N, 2). Полигоны, занимающие больше max_cells ячеек, проверяются всегда
+    Индекс обновляется при setPolygon / setRect зарегистрированного полигона
+    """
+
+    def __init__(self, cell_size=256, max_cells=256):
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        self.cells = {}
+        self.large_items = {}
+        self.item_cells = {}
+        self.item_points = {}
+        self.order = {}
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.order)
+
+    def add(self, item):
+        if item in self.order:
+            return
+        self.order[item] = self.counter
+        self.counter += 1
+        item.hit_index = self
+        self.update(item)
+
+    def remove(self, item):
+        if item not in self.order:
+            return
+        self.remove_from_cells(item)
+        self.item_points.pop(item, None)
+        self.order.pop(item)
+        item.hit_index = None
+
+    def remove_from_cells(self, item):
+        self.large_items.pop(item, None)
+        for cell in self.item_cells.pop(item, []):
+            cell_items = self.cells.get(cell)
+            if cell_items is None:
+                continue
+            cell_items.pop(item, None)
+            if not cell_items:
+                self.cells.pop(cell)
+
+    def update(self, item):
+        """
+        Пересчет вершин и ячеек полигона после изменения его формы
+        """
+        if item not in self.order:
+            return
+
+        self.remove_from_cells(item)
+        points = hf.polygon_to_array(item.polygon())
+        self.item_points[item] = points
+        if len(points) == 0:
+            return
+
+        x_min, y_min = np.floor(points.min(axis=0) / self.cell_size).astype(int)
+        x_max, y_max = np.floor(points.max(axis=0) / self.cell_size).astype(int)
+        if (x_max - x_min + 1) * (y_max - y_min + 1) > self.max_cells:
+            self.large_items[item] = None
+            return
+
+        cells = [(cx, cy) for cx in range(x_min, x_max + 1) for cy in range(y_min, y_max + 1)]
+        for cell in cells:
+            self.cells.setdefault(cell, {})[item] = None
+        self.item_cells[item] = cells
+
+    def get_points(self, item):
+        """
+        Вершины полигона (N, 2). Для незарегистрированного полигона считаются заново
+        """
+        points = self.item_points.get(item)
+        if points is None:
+            points = hf.polygon_to_array(item.polygon())
+        return points
+
+    def contains(self, item, x, y):
+        return hf.is_point_in_polygon(self.get_points(item), x, y)
+
+    def items_at(self, x, y):
+        """
+        Полигоны, содержащие точку (x, y), от последнего добавленного к первому
+        """
+        cell = (int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size)))
+        candidates = list(self.cells.get(cell, {})) + list(self.large_items)
+        candidates.sort(key=self.order.get, reverse=True)
+
+        return [item for item in candidates if self.contains(item, x, y)]
+
+    def item_at(self, x, y):
+        items = self.items_at(x, y)
+        if items:
+            return items[0]
+        return None
+
+    def distance_to_edge(self, item, x, y):
+        return hf.calc_distance_to_nearest_edge_np(self.get_points(item), x, y)
+
+    def nearest_vertex(self, item, x, y, max_dist):
+        """
+        Ближайшая вершина полигона на расстоянии меньше max_dist в виде QPointF или None
+        """
+        points = self.get_points(item)
+        idx = hf.find_nearest_vertex(points, x, y, max_dist)
+        if idx is None:
+            return None
+        return QtCore.QPointF(*points[idx])
+
+    def clear(self):
+        for item in self.order:
+            item.hit_index = None
+        self.cells.clear()
+        self.large_items.clear()
+        self.item_cells.clear()
+        self.item_points.clear()
+        self.order.clear()
+
+
 class ActiveHandler(list):
     def __init__(self, iterable):
         super().__init__(iterable)
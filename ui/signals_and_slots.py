@@ -36,6 +36,7 @@ class LabelsPanelCountConnection(Ps2Core.QObject):
 
 class LoadPercentConnection(Ps2Core.QObject):
     percent = Signal(int)
+    stats = Signal(dict)
 
 
 class ErrorConnection(Ps2Core.QObject):
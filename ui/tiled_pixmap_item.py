@@ -0,0 +1,91 @@
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from PyQt5 import QtCore, QtWidgets
+from PyQt5.QtGui import QImage, QPixmap, QPainter
+
+
+def cv2_to_pixmap(image):
+    """
+    np.ndarray в формате cv2 (BGR или оттенки серого) -> QPixmap
+    """
+    if image.ndim == 2:
+        rgb = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+    else:
+        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    rgb = np.ascontiguousarray(rgb)
+    height, width = rgb.shape[:2]
+    qimage = QImage(rgb.data, width, height, 3 * width, QImage.Format_RGB888)
+    # QPixmap.fromImage копирует данные, rgb можно освобождать
+    return QPixmap.fromImage(qimage)
+
+
+class TiledPixmapItem(QtWidgets.QGraphicsItem):
+    """
+    Изображение, отображаемое тайлами из ImagePyramid
+    При отрисовке выбирается уровень пирамиды под текущий масштаб и загружаются только видимые тайлы
+    Координаты элемента - пиксели исходного изображения, как у QGraphicsPixmapItem
+    """
+
+    def __init__(self, pyramid, max_tiles=256, parent=None):
+        """
+        max_tiles - сколько последних использованных тайлов хранить в виде QPixmap
+        """
+        super(TiledPixmapItem, self).__init__(parent)
+        self.pyramid = pyramid
+        self.max_tiles = max_tiles
+        self.tiles = OrderedDict()
+
+        self.setFlag(QtWidgets.QGraphicsItem.ItemUsesExtendedStyleOption, True)
+
+    def set_pyramid(self, pyramid):
+        """
+        Замена пирамиды того же изображения (временной на полную). Размер элемента не меняется,
+        поэтому сцена и дочерние элементы не затрагиваются
+        """
+        self.pyramid = pyramid
+        self.tiles.clear()
+        self.update()
+
+    def boundingRect(self):
+        return QtCore.QRectF(0, 0, self.pyramid.width, self.pyramid.height)
+
+    def size(self):
+        return QtCore.QSize(self.pyramid.width, self.pyramid.height)
+
+    def get_tile_pixmap(self, level, row, col):
+        key = (level, row, col)
+        if key in self.tiles:
+            self.tiles.move_to_end(key)
+            return self.tiles[key]
+
+        pixmap = cv2_to_pixmap(self.pyramid.get_tile(level, row, col))
+        self.tiles[key] = pixmap
+        while len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+
+        return pixmap
+
+    def paint(self, painter, option, widget=None):
+        view_scale = option.levelOfDetailFromTransform(painter.worldTransform())
+        level = self.pyramid.choose_level(view_scale)
+
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        if exposed.isEmpty():
+            return
+
+        if level > 0:
+            painter.setRenderHint(QPainter.SmoothPixmapTransform, True)
+
+        for row, col in self.pyramid.get_visible_tiles(level, exposed.left(), exposed.top(), exposed.right(),
+                                                       exposed.bottom()):
+            pixmap = self.get_tile_pixmap(level, row, col)
+            x, y, w, h = self.pyramid.get_tile_rect(level, row, col)
+            painter.drawPixmap(QtCore.QRectF(x, y, w, h), pixmap, QtCore.QRectF(pixmap.rect()))
+
+    def preview_pixmap(self, max_side=8192):
+        """
+        Уменьшенная копия всего изображения (для печати)
+        """
+        return cv2_to_pixmap(self.pyramid.get_preview(max_side))
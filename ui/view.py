@@ -6,10 +6,10 @@ from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtGui import QPolygonF, QColor, QPen, QPainter, QPixmap, QFont, QCursor
 from PyQt5.QtWidgets import QAction, QMenu, QGraphicsItem, QGraphicsSimpleTextItem
 from PyQt5.QtWidgets import QApplication
-from shapely import Polygon, Point
 
 from ui.polygons import GrPolygonLabel, GrEllipsLabel, ActiveHandler, AiPoint, FatPoint, RulerPoint, RulerLine, \
-    set_item_label, check_polygon_item
+    set_item_label, check_polygon_item, ShapeItemsRegistry
+from ui.tiled_pixmap_item import TiledPixmapItem, cv2_to_pixmap
 from ui.signals_and_slots import PolygonDeleteConnection, ViewMouseCoordsConnection, PolygonPressedConnection, \
     PolygonEndDrawing, MaskEndDrawing, PolygonChangeClsNumConnection, LoadIdProgress, InfoConnection, \
     ListOfPolygonsConnection
@@ -59,6 +59,9 @@ class GraphicsView(QtWidgets.QGraphicsView):
         self._pixmap_item = QtWidgets.QGraphicsPixmapItem()
         scene.addItem(self._pixmap_item)
 
+        # полигоны сцены по id и номеру класса
+        self.shapes_registry = ShapeItemsRegistry()
+
         self.buffer = []
         self.view_state = ViewState.normal
         self.init_objects_and_params()
@@ -266,13 +269,44 @@ class GraphicsView(QtWidgets.QGraphicsView):
         """
         Задать новую картинку
         """
+        pixmap_item = QtWidgets.QGraphicsPixmapItem()
+        pixmap_item.setPixmap(pixmap)
+        self.set_image_item(pixmap_item)
+
+    def setImage(self, image, pyramid=None):
+        """
+        Задать новую картинку из np.ndarray в формате cv2 (то же изображение, что и cv2_image)
+        pyramid - ImagePyramid. Если задана, картинка отображается тайлами нужного масштаба
+        """
+        if pyramid is None:
+            self.setPixmap(cv2_to_pixmap(image))
+        else:
+            self.set_image_item(TiledPixmapItem(pyramid))
+
+    def get_image_size(self):
+        """
+        Размер текущей картинки (QSize)
+        """
+        if isinstance(self._pixmap_item, TiledPixmapItem):
+            return self._pixmap_item.size()
+        return self._pixmap_item.pixmap().size()
+
+    def get_print_pixmap(self):
+        """
+        Картинка для печати. Для больших изображений - уменьшенная копия
+        """
+        if isinstance(self._pixmap_item, TiledPixmapItem):
+            return self._pixmap_item.preview_pixmap()
+        return self._pixmap_item.pixmap()
+
+    def set_image_item(self, pixmap_item):
         # scene = QtWidgets.QGraphicsScene(self)
         # self.setScene(scene)
         self.scene().clear()
+        self.shapes_registry.clear()
 
-        self._pixmap_item = QtWidgets.QGraphicsPixmapItem()
+        self._pixmap_item = pixmap_item
         self.scene().addItem(self._pixmap_item)
-        self.pixmap_item.setPixmap(pixmap)
 
         self.init_objects_and_params()
 
@@ -311,17 +345,10 @@ class GraphicsView(QtWidgets.QGraphicsView):
         self.setScene(scene)
         self._pixmap_item = QtWidgets.QGraphicsPixmapItem()
         scene.addItem(self._pixmap_item)
+        self.shapes_registry.clear()
 
     def activate_item_by_id(self, id_to_found):
-        found_item = None
-        for item in self.scene().items():
-            # ищем полигон с заданным id
-            try:
-                if item.id == id_to_found:
-                    found_item = item
-                    break
-            except:
-                pass
+        found_item = self.shapes_registry.get_by_id(id_to_found)
 
         self.active_group.reset_clicked_item(found_item, False)
 
@@ -329,7 +356,7 @@ class GraphicsView(QtWidgets.QGraphicsView):
         """
         Определение и установка толщины граней активного полигона и эллипса узловой точки активного полигона
         """
-        pixmap_width = self.pixmap_item.pixmap().width()
+        pixmap_width = self.get_image_size().width()
         scale = pixmap_width / 2000.0
 
         if fat_width_percent_new:
@@ -368,11 +395,10 @@ class GraphicsView(QtWidgets.QGraphicsView):
         return False
 
     def check_near_by_active_pressed(self, lp):
+        hit_index = self.shapes_registry.hit_index
+        scale = self._zoom / 3.0 + 1
         for active_item in self.active_group:
-            scale = self._zoom / 3.0 + 1
-            pol = active_item.polygon()
-
-            d = hf.calc_distance_to_nearest_edge(pol, lp)
+            d = hit_index.distance_to_edge(active_item, lp.x(), lp.y())
 
             if d < self.fat_width / scale:
                 self.polygon_clicked.id_pressed.emit(active_item.id)
@@ -381,11 +407,9 @@ class GraphicsView(QtWidgets.QGraphicsView):
         return False
 
     def check_active_pressed(self, pressed_point):
+        hit_index = self.shapes_registry.hit_index
         for active_item in self.active_group:
-            pol = active_item.polygon()
-            shapely_pol = Polygon([(p.x(), p.y()) for p in pol])
-
-            if shapely_pol.contains(Point(pressed_point.x(), pressed_point.y())):
+            if hit_index.contains(active_item, pressed_point.x(), pressed_point.y()):
                 self.polygon_clicked.id_pressed.emit(active_item.id)
                 return True
 
@@ -393,8 +417,9 @@ class GraphicsView(QtWidgets.QGraphicsView):
 
     def is_point_in_pixmap_size(self, point):
         is_in_range = True
-        pixmap_width = self.pixmap_item.pixmap().width()
-        pixmap_height = self.pixmap_item.pixmap().height()
+        pixmap_size = self.get_image_size()
+        pixmap_width = pixmap_size.width()
+        pixmap_height = pixmap_size.height()
         if point.x() > pixmap_width:
             is_in_range = False
         if point.x() < 0:
@@ -413,8 +438,9 @@ class GraphicsView(QtWidgets.QGraphicsView):
         # Активный полигон
         pol = item.polygon()
         # Полигон рабочей области
-        pixmap_width = self.pixmap_item.pixmap().width()
-        pixmap_height = self.pixmap_item.pixmap().height()
+        pixmap_size = self.get_image_size()
+        pixmap_width = pixmap_size.width()
+        pixmap_height = pixmap_size.height()
 
         if not hf.check_polygon_out_of_screen(pol, pixmap_width, pixmap_height):
             pol = hf.convert_item_polygon_to_shapely(pol)
@@ -432,18 +458,10 @@ class GraphicsView(QtWidgets.QGraphicsView):
         """
         Ищем полигон под точкой lp,
         Найдем - возвращаем полигон, не найдем - None.
+        Кандидаты берутся из пространственного индекса, а не перебором всей сцены
         """
 
-        for item in self.scene().items():
-            # ищем, не попали ли уже в нарисованный полигон
-            try:
-                pol = item.polygon()
-                if pol.containsPoint(pressed_point, QtCore.Qt.OddEvenFill):
-                    return item
-            except:
-                pass
-
-        return None
+        return self.shapes_registry.hit_index.item_at(pressed_point.x(), pressed_point.y())
 
     def set_ids_from_project(self, project_data, on_set_callback=None, percent_max=100):
         self.ids_worker = IdsSetterWorker(images_data=project_data['images'], percent_max=percent_max)
@@ -511,11 +529,70 @@ class GraphicsView(QtWidgets.QGraphicsView):
         self.crop_by_pixmap_size(polygon_new)
 
         self.scene().addItem(polygon_new)
+        self.shapes_registry.add(polygon_new)
         if text:
             self.scene().addItem(polygon_new.get_label())
 
         return id
 
+    def add_polygons_to_scene(self, shapes, colors=None, texts=None, alpha=50, alpha_edge=None,
+                              label_text_params=None):
+        """
+        Пакетное добавление полигонов разметки изображения на сцену (то же, что add_polygon_to_scene для каждого)
+        shapes - список словарей {'cls_num', 'points', 'id'} из проекта
+        colors, texts - словари номер класса -> цвет / подпись. Подпись None - без подписи
+        label_text_params - параметры подписей, чтобы не читать настройки для каждого полигона
+        Полигоны собираются из np.ndarray, обрезка рабочей областью - одним проходом для всех,
+        на время добавления индексация сцены отключена
+        """
+        if colors is None:
+            colors = {}
+        if texts is None:
+            texts = {}
+
+        shapes = [shape for shape in shapes if len(shape['points']) >= 3]
+        if not shapes:
+            return
+
+        point_masses = [np.asarray(shape['points'], dtype=np.float64).reshape(-1, 2) for shape in shapes]
+        image_size = self.get_image_size()
+        cropped_masses = hf.clip_point_masses(point_masses, image_size.width(), image_size.height())
+
+        brushes_and_pens = {}
+        scene = self.scene()
+        index_method = scene.itemIndexMethod()
+        scene.setItemIndexMethod(QtWidgets.QGraphicsScene.NoIndex)
+        try:
+            for shape, points, cropped in zip(shapes, point_masses, cropped_masses):
+                cls_num = shape['cls_num']
+                text = texts.get(cls_num)
+                shape_id = shape.get('id')
+                if shape_id is None:
+                    shape_id = self.labels_ids_handler.get_unique_label_id()
+
+                # то же, что hf.calc_label_pos: вторая точка контура исходного полигона
+                text_pos = [int(points[1][0]), int(points[1][1])]
+                polygon_new = GrPolygonLabel(None, color=colors.get(cls_num), cls_num=cls_num, alpha_percent=alpha,
+                                             id=shape_id, text=text, text_pos=text_pos, alpha_edge=alpha_edge,
+                                             label_text_params=label_text_params)
+
+                key = (tuple(polygon_new.color), tuple(polygon_new.edge_color))
+                if key not in brushes_and_pens:
+                    brushes_and_pens[key] = (QtGui.QBrush(QColor(*polygon_new.color), QtCore.Qt.SolidPattern),
+                                             QPen(QColor(*polygon_new.edge_color), self.line_width,
+                                                  QtCore.Qt.SolidLine))
+                brush, pen = brushes_and_pens[key]
+                polygon_new.setBrush(brush)
+                polygon_new.setPen(pen)
+                polygon_new.setPolygon(hf.array_to_polygon(cropped))
+
+                scene.addItem(polygon_new)
+                self.shapes_registry.add(polygon_new)
+                if text:
+                    scene.addItem(polygon_new.get_label())
+        finally:
+            scene.setItemIndexMethod(index_method)
+
     def add_point_to_active(self, lp):
 
         if len(self.active_group) == 1:
@@ -620,6 +697,7 @@ class GraphicsView(QtWidgets.QGraphicsView):
                 new_item.setPolygon(pol_new)
 
                 self.scene().addItem(new_item)
+                self.shapes_registry.add(new_item)
 
     def mousePressEvent(self, event: QtGui.QMouseEvent) -> None:
 
@@ -809,10 +887,8 @@ class GraphicsView(QtWidgets.QGraphicsView):
         if len(self.active_group) == 1:
             active_item = self.active_group[0]
             scale = self._zoom / 3.0 + 1
-            pol = active_item.polygon()
-            for p in pol:
-                if hf.distance(p, point) < self.fat_width / scale:
-                    return p
+            return self.shapes_registry.hit_index.nearest_vertex(active_item, point.x(), point.y(),
+                                                                 self.fat_width / scale)
 
         return None
 
@@ -1173,6 +1249,7 @@ class GraphicsView(QtWidgets.QGraphicsView):
 
                 # Self-intersection можно не проверять. Это эллипс
                 self.scene().addItem(polygon_new)
+                self.shapes_registry.add(polygon_new)
                 self.crop_by_pixmap_size(polygon_new)
 
                 self.polygon_end_drawing.on_end_drawing.emit(True)
@@ -1226,127 +1303,71 @@ class GraphicsView(QtWidgets.QGraphicsView):
         if text_label:
             self.scene().removeItem(text_label)
         self.scene().removeItem(item)
+        self.shapes_registry.remove(item)
 
     def remove_all_polygons(self):
         self.view_state = ViewState.normal
-        for item in self.scene().items():
-            # ищем, не попали ли уже в нарисованный полигон
-            try:
-                pol = item.polygon()
-                if pol:
-                    self.remove_item(item, is_delete_id=True)
-            except:
-                pass
+        for item in self.shapes_registry.items():
+            if item.polygon():
+                self.remove_item(item, is_delete_id=True)
 
-    def get_shapes_by_cls_num(self, cls_num, is_filter=True):
-        shapes = []
-        for item in self.scene().items():
-            # ищем, не попали ли уже в нарисованный полигон
-            try:
-                pol = item.polygon()
+    def get_item_shape(self, item):
+        shape = {"cls_num": item.cls_num, "id": item.id}
+        shape["points"] = [[p.x(), p.y()] for p in item.polygon()]
+        return shape
 
-                if pol:
-                    tek_cls = item.cls_num
-                    if tek_cls == cls_num:
-                        if is_filter and len(pol) < 3:
-                            self.remove_item(item, is_delete_id=True)
-                            continue
-
-                        shape = {"cls_num": item.cls_num, "id": item.id}
-                        points = []
-                        for p in pol:
-                            points.append([p.x(), p.y()])
-                        shape["points"] = points
-                        shapes.append(shape)
-            except:
-                pass
+    def filter_shape_items(self, items, is_filter=True):
+        """
+        Полигоны из items, у которых есть точки. При is_filter полигоны меньше чем из 3 точек удаляются со сцены
+        """
+        good_items = []
+        for item in items:
+            pol = item.polygon()
+            if not pol:
+                continue
+            if is_filter and len(pol) < 3:
+                self.remove_item(item, is_delete_id=True)
+                continue
+            good_items.append(item)
 
-        return shapes
+        return good_items
 
-    def remove_shape_by_id(self, shape_id):
-        for item in self.scene().items():
-            # ищем, не попали ли уже в нарисованный полигон
-            try:
-                pol = item.polygon()
+    def get_shapes_by_cls_num(self, cls_num, is_filter=True):
+        items = self.filter_shape_items(self.shapes_registry.get_by_cls(cls_num), is_filter=is_filter)
+        return [self.get_item_shape(item) for item in items]
 
-                if pol:
-                    tek_id = item.id
-                    if tek_id == shape_id:
-                        self.remove_item(item, is_delete_id=True)
-                        return True
-            except:
-                pass
+    def remove_shape_by_id(self, shape_id):
+        item = self.shapes_registry.get_by_id(shape_id)
+        if item is None or not item.polygon():
+            return False
 
-        return False
+        self.remove_item(item, is_delete_id=True)
+        return True
 
     def remove_shapes_by_cls(self, cls_num, is_filter=True):
         removed_count = 0
-        for item in self.scene().items():
-            # ищем, не попали ли уже в нарисованный полигон
-            try:
-                pol = item.polygon()
-
-                if pol:
-                    tek_cls = item.cls_num
-                    if tek_cls == cls_num:
-                        self.remove_item(item, is_delete_id=True)
-                        removed_count += 1
-            except:
-                pass
+        for item in self.shapes_registry.get_by_cls(cls_num):
+            if item.polygon():
+                self.remove_item(item, is_delete_id=True)
+                removed_count += 1
 
         return removed_count
 
     def get_shape_by_id(self, shape_id, is_filter=True):
-        for item in self.scene().items():
-            # ищем, не попали ли уже в нарисованный полигон
-            try:
-                pol = item.polygon()
+        items = self.filter_shape_items(self.shapes_registry.get_all_by_id(shape_id), is_filter=is_filter)
+        if not items:
+            return None
 
-                if pol:
-                    tek_id = item.id
-                    if tek_id == shape_id:
-                        if is_filter and len(pol) < 3:
-                            self.remove_item(item, is_delete_id=True)
-                            continue
-
-                        shape = {"cls_num": item.cls_num, "id": item.id}
-                        points = []
-                        for p in pol:
-                            points.append([p.x(), p.y()])
-                        shape["points"] = points
-                        return shape
-            except:
-                pass
-
-        return None
+        return self.get_item_shape(items[0])
 
     def get_all_shapes(self, is_filter=True):
-        shapes = []
-
-        for item in self.scene().items():
-            # ищем, не попали ли уже в нарисованный полигон
-            try:
-                pol = item.polygon()
-                if pol:
-
-                    if is_filter and len(pol) < 3:
-                        self.remove_item(item, is_delete_id=True)
-                        continue
-
-                    shape = {"cls_num": item.cls_num, "id": item.id}
-                    points = []
-                    for p in pol:
-                        points.append([p.x(), p.y()])
-                    shape["points"] = points
-                    shapes.append(shape)
-            except:
-                pass
-
-        return shapes
+        items = self.filter_shape_items(self.shapes_registry.items(), is_filter=is_filter)
+        return [self.get_item_shape(item) for item in items]
 
     def add_item_to_scene_as_active(self, item):
         self.active_group.append(item)
         self.scene().addItem(item)
+        self.shapes_registry.add(item)
 
     def start_drawing(self, draw_type=DrawState.polygon, cls_num=0, color=None, alpha=50, id=None, text=None,
                       alpha_edge=None):
@@ -1502,6 +1523,7 @@ class GraphicsView(QtWidgets.QGraphicsView):
 
                 active_item.set_color(color=color, alpha_percent=alpha_percent)
                 active_item.set_cls_num(cls_num)
+                self.shapes_registry.update_cls(active_item)
 
                 label = set_item_label(active_item, text, color)
                 if label:
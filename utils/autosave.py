@@ -0,0 +1,240 @@
+import os
+import queue
+
+import ujson
+from PyQt5 import QtCore
+
+from ui.signals_and_slots import ProjectSaveLoadConn
+from utils.packed_project import save_project_data
+
+JOURNAL_EXT = '.journal'
+JOURNAL_VERSION = 1
+
+
+def get_journal_path(project_path):
+    return project_path + JOURNAL_EXT
+
+
+def get_project_stamp(project_path):
+    """
+    Размер и время изменения файла проекта. По ним журнал привязывается к полному сохранению
+    """
+    stat = os.stat(project_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def compact_entries(entries):
+    """
+    Сжатие записей журнала: последнее состояние полей проекта и каждого изображения
+    """
+    meta = None
+    is_reset = False
+    images = {}
+    for entry in entries:
+        if 'meta' in entry:
+            meta = entry['meta']
+        elif entry.get('reset_images'):
+            is_reset = True
+            images.clear()
+        elif 'image' in entry:
+            images[entry['image']] = entry['data']
+
+    compacted = []
+    if meta is not None:
+        compacted.append({'meta': meta})
+    if is_reset:
+        compacted.append({'reset_images': True})
+    compacted.extend({'image': name, 'data': data} for name, data in images.items())
+    return compacted
+
+
+class ProjectJournal:
+    """
+    Журнал изменений проекта между полными сохранениями, лежит рядом с файлом проекта (JOURNAL_EXT)
+    Файл только дописывается, одна строка JSON на запись. Первая строка - заголовок
+    {'version': ..., 'project': [размер, mtime_ns]} файла проекта, к которому относится журнал
+    Записи:
+        {'meta': {...}} - поля проекта, кроме images
+        {'reset_images': True} - images заменяется следующими записями целиком
+        {'image': имя, 'data': данные изображения или None, если изображение удалено}
+    При превышении max_mb журнал переписывается, остается последнее состояние каждого изображения
+    """
+
+    def __init__(self, project_path, max_mb=64):
+        self.project_path = project_path
+        self.path = get_journal_path(project_path)
+        self.max_bytes = int(max_mb * 1024 * 1024)
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def write(self, header, entries=()):
+        """
+        Запись журнала целиком через временный файл
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            f.write(ujson.dumps(header) + '\n')
+            for entry in entries:
+                f.write(ujson.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def start(self):
+        """
+        Новый пустой журнал. Вызывается после полного сохранения проекта
+        """
+        self.write({'version': JOURNAL_VERSION, 'project': get_project_stamp(self.project_path)})
+
+    def is_terminated(self):
+        """
+        Последняя запись журнала дописана до конца строки (не оборвана при сбое)
+        """
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return False
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def append(self, entries):
+        if not self.exists() or not self.is_actual():
+            self.start()
+        elif not self.is_terminated():
+            # оборванную запись нужно убрать, иначе новая запись склеится с ней и не прочитается
+            self.compact()
+
+        # каждая запись сериализуется отдельно, чтобы не держать GIL на время сериализации всех
+        with open(self.path, 'a', encoding='utf8') as f:
+            for entry in entries:
+                f.write(ujson.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+        if os.path.getsize(self.path) > self.max_bytes:
+            self.compact()
+
+    def read_header(self):
+        try:
+            with open(self.path, 'r', encoding='utf8') as f:
+                return ujson.loads(f.readline())
+        except (OSError, ValueError):
+            return None
+
+    def is_actual(self):
+        """
+        Журнал относится к текущему файлу проекта (после него проект полностью не сохранялся)
+        """
+        header = self.read_header()
+        if not header or header.get('version', 0) > JOURNAL_VERSION:
+            return False
+        try:
+            return header.get('project') == get_project_stamp(self.project_path)
+        except OSError:
+            return False
+
+    def read(self):
+        """
+        Записи журнала или None, если журнала нет или он не относится к текущему файлу проекта
+        Оборванная при сбое последняя запись пропускается
+        """
+        if not self.exists() or not self.is_actual():
+            return None
+
+        entries = []
+        with open(self.path, 'r', encoding='utf8') as f:
+            f.readline()
+            for line in f:
+                try:
+                    entries.append(ujson.loads(line))
+                except ValueError:
+                    break
+        return entries
+
+    def compact(self):
+        entries = self.read()
+        if entries is None:
+            return
+        self.write(self.read_header(), compact_entries(entries))
+
+    def remove(self):
+        if self.exists():
+            os.remove(self.path)
+
+
+class AutosaveWorker(QtCore.QThread):
+    """
+    Фоновое сохранение проекта. Задачи выполняются по очереди в одном потоке:
+        полное сохранение - атомарная запись снимка проекта и новый пустой журнал
+        дозапись журнала - изменения, накопленные с прошлого автосохранения
+        удаление журнала - изменения не нужно восстанавливать
+    on_save.on_finished - окончание полного сохранения (True - успешно)
+    """
+
+    def __init__(self, journal_max_mb=64):
+        super(AutosaveWorker, self).__init__()
+        self.journal_max_mb = journal_max_mb
+        self.tasks = queue.Queue()
+        self.on_save = ProjectSaveLoadConn()
+
+    def enqueue(self, task):
+        self.tasks.put(task)
+        if not self.isRunning():
+            self.start()
+
+    def enqueue_snapshot(self, project_path, data):
+        """
+        data - снимок проекта (ProjectHandler.make_snapshot), который не меняется при дальнейшей работе
+        """
+        self.enqueue(('snapshot', project_path, data))
+
+    def enqueue_journal(self, project_path, entries):
+        self.enqueue(('journal', project_path, entries))
+
+    def enqueue_discard(self, project_path):
+        self.enqueue(('discard', project_path, None))
+
+    def process(self, kind, project_path, payload):
+        journal = ProjectJournal(project_path, max_mb=self.journal_max_mb)
+        if kind == 'snapshot':
+            save_project_data(payload, project_path)
+            journal.start()
+        elif kind == 'journal':
+            if os.path.exists(project_path):
+                journal.append(payload)
+        elif kind == 'discard':
+            journal.remove()
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                self.tasks.task_done()
+                break
+
+            kind, project_path, payload = task
+            is_ok = True
+            try:
+                self.process(kind, project_path, payload)
+            except Exception as e:
+                # исключение не должно выйти из QThread.run: PyQt5 завершает приложение
+                print(f"Autosave error ({kind}) for {project_path}: {e}")
+                is_ok = False
+            finally:
+                self.tasks.task_done()
+
+            if kind == 'snapshot':
+                self.on_save.on_finished.emit(is_ok)
+
+    def wait_saved(self):
+        """
+        Ожидание выполнения всех поставленных задач
+        """
+        if self.isRunning():
+            self.tasks.join()
+
+    def stop(self):
+        if self.isRunning():
+            self.tasks.put(None)
+            self.wait()
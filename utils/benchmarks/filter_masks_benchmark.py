@@ -0,0 +1,70 @@
+"""
+Сравнение filter_masks (попарный перебор) и filter_masks_indexed (STRtree + векторный IoU)
+Запуск из корня проекта:
+    python -m utils.benchmarks.filter_masks_benchmark
+"""
+import time
+
+import numpy as np
+
+from utils.help_functions import filter_masks, filter_masks_indexed
+
+SIZES = [1000, 10000, 100000]
+PAIRWISE_MAX_SIZE = 2000  # попарный перебор на больших размерах считается часами
+
+
+def create_masks_results(size, nc=5, dupl_part=0.3, seed=0):
+    """
+    Синтетические результаты детекции: многоугольники-"здания" на растре, часть из них с дубликатами,
+    смещенными на несколько пикселей (как при перекрытии фрагментов сканирующего окна)
+    """
+    rng = np.random.default_rng(seed)
+    side = int(np.sqrt(size) * 60)
+    base_num = int(size / (1.0 + dupl_part))
+
+    centers = rng.uniform(0, side, size=(base_num, 2))
+    radii = rng.uniform(8, 25, size=base_num)
+    cls_nums = rng.integers(0, nc, size=base_num)
+
+    dupl_idx = rng.choice(base_num, size=size - base_num, replace=True)
+    centers = np.concatenate([centers, centers[dupl_idx] + rng.normal(0, 3, size=(len(dupl_idx), 2))])
+    radii = np.concatenate([radii, radii[dupl_idx] * rng.uniform(0.9, 1.1, size=len(dupl_idx))])
+    cls_nums = np.concatenate([cls_nums, cls_nums[dupl_idx]])
+
+    order = rng.permutation(size)
+    angles = np.linspace(0, 2 * np.pi, 12, endpoint=False)
+
+    masks_results = []
+    for i in order:
+        xs = centers[i, 0] + radii[i] * np.cos(angles)
+        ys = centers[i, 1] + radii[i] * np.sin(angles)
+        masks_results.append({'cls_num': int(cls_nums[i]), 'points': np.stack([xs, ys], axis=1).tolist(),
+                              'conf': float(rng.uniform(0.1, 1.0))})
+
+    return masks_results
+
+
+def run_timed(func, *args, **kwargs):
+    start_time = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start_time
+
+
+def main():
+    for size in SIZES:
+        masks_results = create_masks_results(size)
+
+        indexed, indexed_time = run_timed(filter_masks_indexed, masks_results, conf_thres=0.2, iou_filter=0.3)
+        line = f"{size:>7} polygons: indexed {indexed_time:8.3f} s, {len(indexed)} left"
+
+        if size <= PAIRWISE_MAX_SIZE:
+            pairwise, pairwise_time = run_timed(filter_masks, masks_results, conf_thres=0.2, iou_filter=0.3,
+                                                method='pairwise')
+            is_same = [id(r) for r in pairwise] == [id(r) for r in indexed]
+            line += f"; pairwise {pairwise_time:8.3f} s, {len(pairwise)} left, same result: {is_same}"
+
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Сравнение группировки полигонов GrigStructs: прежний перебор ('pairwise') и STRtree + связные компоненты ('indexed')
+Запуск из корня проекта:
+    python -m utils.benchmarks.poly_union_benchmark
+"""
+import time
+
+import numpy as np
+from shapely import box
+
+from utils.calc_methods import GrigStructs
+
+SIZES = [500, 2000, 10000]
+PAIRWISE_MAX_SIZE = 500  # прежний алгоритм перезапускает перебор после каждого объединения
+MAX_DIST = 15.0
+BUF_DIST = 10
+
+
+def create_buildings(size, seed=0):
+    """
+    Синтетическая застройка: кварталы из прямоугольных "зданий" с разными промежутками,
+    часть зданий стоит вплотную или с перекрытием
+    """
+    rng = np.random.default_rng(seed)
+    side = int(np.sqrt(size))
+
+    buildings = []
+    for i in range(size):
+        row, col = divmod(i, side)
+        # кварталы 5x5 зданий, между кварталами широкие улицы
+        x = col * 40 + (col // 5) * 60 + rng.uniform(-8, 8)
+        y = row * 40 + (row // 5) * 60 + rng.uniform(-8, 8)
+        w, h = rng.uniform(15, 35, size=2)
+        buildings.append(box(x, y, x + w, y + h))
+
+    return buildings
+
+
+def normalize(polygons):
+    """
+    Набор полигонов в виде, не зависящем от порядка полигонов и порядка вершин
+    """
+    return sorted((round(p.area, 3), tuple(np.round(p.bounds, 3))) for p in polygons)
+
+
+def run_timed(func, *args, **kwargs):
+    start_time = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start_time
+
+
+def main():
+    for size in SIZES:
+        buildings = create_buildings(size)
+
+        union, union_time = run_timed(GrigStructs.PolyUnion, buildings, MAX_DIST)
+        bufs = [b.buffer(BUF_DIST) for b in buildings]
+        zones, zones_time = run_timed(GrigStructs.UnionOverlapped, bufs)
+
+        line = (f"{size:>6} buildings: PolyUnion indexed {union_time:8.3f} s ({len(union)} groups), "
+                f"buffer union indexed {zones_time:8.3f} s ({len(zones)} zones)")
+
+        if size <= PAIRWISE_MAX_SIZE:
+            union_old, union_old_time = run_timed(GrigStructs.PolyUnion, buildings, MAX_DIST, method='pairwise')
+            zones_old, zones_old_time = run_timed(GrigStructs.UnionOverlapped, bufs, method='pairwise')
+            line += (f"; pairwise {union_old_time:8.3f} s / {zones_old_time:8.3f} s, same result: "
+                     f"{normalize(union) == normalize(union_old)} / {normalize(zones) == normalize(zones_old)}")
+
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
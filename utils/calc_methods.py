@@ -1,6 +1,5 @@
 import math as mt
 import os
-import pickle
 import statistics as st
 
 import cv2 as cv
@@ -14,7 +13,8 @@ from sklearn.cluster import DBSCAN
 from sklearn.cluster import KMeans
 from ui.signals_and_slots import LoadPercentConnection, InfoConnection
 from utils.primitives import DNPoly, DNWPoint, DNWLine, DNWPoly, DNWPoly_s
-from utils.sam_fragment import create_masks, create_generator
+from utils.sam_fragment import create_generator, generate_masks_for_crops
+from utils.spatial_grouping import group_geometries
 
 
 class DNMathAdd:
@@ -439,8 +439,14 @@ class DNTheam:
                 "KofDispCls": KofDispCls, "KofDispCls2": KofDispCls2, "T": T}
 
     # Функция разделения результатов классификации на сегменты
+    # Сегмент - 4-связная область пикселей одного класса, пиксели -1 не обрабатываются
+    # Сегменты нумеруются по первому пикселю при обходе по строкам
+    # method='components' - разметка связных компонент LabelSegments, 'floodfill' - прежняя заливка по одному сегменту
     @classmethod
-    def ClsToSegments(cls, ClsMass: []):
+    def ClsToSegments(cls, ClsMass: [], method='components'):
+        if method == 'components':
+            return cls.LabelSegments(ClsMass)[0]
+
         # Формируем массив результата (необработанные пиксели: -5)
         W, H = np.shape(ClsMass)
         Res = np.full([W, H], -5)
@@ -473,9 +479,54 @@ class DNTheam:
 
         return Res
 
+    # Разметка сегментов за один проход по каждому классу (cv.connectedComponents, 4-связность)
+    # Возвращает массив сегментов (как ClsToSegments) и площади сегментов в пикселях
+    @classmethod
+    def LabelSegments(cls, ClsMass: []):
+        Img = np.asarray(ClsMass)
+        Res = np.full(Img.shape, -1, dtype=np.int64)
+
+        NLabels = 0
+        for Val in np.unique(Img):
+            if Val == -1:
+                continue
+            N, Labels = cv.connectedComponents((Img == Val).astype(np.uint8), connectivity=4, ltype=cv.CV_32S)
+            IsCls = Labels > 0
+            Res[IsCls] = Labels[IsCls] + (NLabels - 1)
+            NLabels += N - 1
+
+        if NLabels == 0:
+            return Res, np.zeros(0, dtype=np.int64)
+
+        # Перенумерация сегментов в порядке первого пикселя при обходе по строкам
+        Flat = Res.ravel()
+        IsSeg = Flat >= 0
+        _, First = np.unique(Flat[IsSeg], return_index=True)
+        Rank = np.empty(NLabels, dtype=np.int64)
+        Rank[np.argsort(First)] = np.arange(NLabels)
+        Flat[IsSeg] = Rank[Flat[IsSeg]]
+
+        return Res, np.bincount(Flat[IsSeg], minlength=NLabels)
+
     # Фильтрация сегментов по площади
+    # Сегменты вне диапазона становятся -1, затем все значения (включая -1) перенумеровываются по возрастанию с 0
+    # Площадь сравнивается как 2 * число пикселей (размер np.argwhere), как в прежней реализации
+    # method='bincount' - подсчет площадей одним np.bincount, 'loop' - прежний перебор сегментов
     @classmethod
-    def SegmentsAreaFilter(cls, SegMass: [], MinArea: int, MaxArea: int):
+    def SegmentsAreaFilter(cls, SegMass: [], MinArea: int, MaxArea: int, method='bincount'):
+        if method == 'bincount':
+            Seg = np.asarray(SegMass, dtype=np.int64)
+            Offset = min(int(Seg.min()), -1)
+            Idx = Seg - Offset
+
+            Areas = 2 * np.bincount(Idx.ravel())
+            Keep = (Areas >= MinArea) & (Areas <= MaxArea)
+            Idx = np.where(Keep[Idx], Idx, -1 - Offset)
+
+            IsPresent = np.bincount(Idx.ravel(), minlength=len(Areas)) > 0
+            Rank = np.cumsum(IsPresent) - 1
+            return Rank[Idx]
+
         W, H = np.shape(SegMass)
         Res = np.full([W, H], -1)
         np.copyto(Res, SegMass)
@@ -1954,10 +2005,14 @@ class DNTheam:
         return {'Bs': ContBuilds, 'Pol': np.array(PObjUnion.exterior.coords, int), 'Is': IndxOv}  # not len(IndxOv)==0
 
     # Расчет наименьшего расстояния между контурами
+    # method='indexed' - векторный расчет CalcMinDistConts, 'pairwise' - прежний перебор пар точек
     @classmethod
-    def CalcMinDistCont(cls, Contur1: [], Contur2: []):
+    def CalcMinDistCont(cls, Contur1: [], Contur2: [], method='indexed'):
         if len(Contur1) == 0 or len(Contur2) == 0:
             return -1
+        if method == 'indexed':
+            return cls.CalcMinDistConts([Contur1], [Contur2])[0][0]
+
         DMin = DNMathAdd.CalcEvkl(Contur1[0], Contur2[0])
         P1 = []
         P2 = []
@@ -1979,6 +2034,63 @@ class DNTheam:
 
         return [DMin, P1, P2, NDx1, NDx2]
 
+    # Минимальные расстояния между точками контуров двух наборов, каждый с каждым
+    # Возвращает Res[i][j] = [DMin, P1, P2, NDx1, NDx2] для Conturs1[i] и Conturs2[j], как CalcMinDistCont
+    # (-1 для пустых контуров)
+    # Расстояния от точек контура Conturs1[i] до всех точек Conturs2 считаются векторно,
+    # пачками по строкам, чтобы матрица расстояний не превышала MaxBlock элементов
+    @classmethod
+    def CalcMinDistConts(cls, Conturs1: [], Conturs2: [], MaxBlock=4000000):
+        Res = [[-1] * len(Conturs2) for _ in range(len(Conturs1))]
+
+        Pts2 = [np.asarray(C, dtype=np.float64).reshape(-1, 2) for C in Conturs2]
+        Lens2 = np.array([len(P) for P in Pts2])
+        NotEmpty2 = np.flatnonzero(Lens2 > 0)
+        if len(NotEmpty2) == 0:
+            return Res
+
+        AllPts2 = np.concatenate([Pts2[j] for j in NotEmpty2])
+        Starts = np.concatenate([[0], np.cumsum(Lens2[NotEmpty2])[:-1]])
+        Ends = Starts + Lens2[NotEmpty2]
+
+        for i, Contur1 in enumerate(Conturs1):
+            Pts1 = np.asarray(Contur1, dtype=np.float64).reshape(-1, 2)
+            if len(Pts1) == 0:
+                continue
+
+            # Для каждого контура Conturs2: минимум и первая (по строкам) пара точек, где он достигается
+            BestD = np.full(len(NotEmpty2), np.inf)
+            BestI = np.zeros(len(NotEmpty2), dtype=np.int64)
+            BestJ = np.zeros(len(NotEmpty2), dtype=np.int64)
+
+            Step = max(1, MaxBlock // len(AllPts2))
+            for Start in range(0, len(Pts1), Step):
+                Block = Pts1[Start:Start + Step]
+                Dx = AllPts2[None, :, 0] - Block[:, None, 0]
+                Dy = AllPts2[None, :, 1] - Block[:, None, 1]
+                D = np.sqrt(Dx * Dx + Dy * Dy)  # как в DNMathAdd.CalcEvkl
+
+                RowMin = np.minimum.reduceat(D, Starts, axis=1)  # (строки, контуры)
+                BlockMin = RowMin.min(axis=0)
+                IsBetter = BlockMin < BestD
+                for k in np.flatnonzero(IsBetter):
+                    Row = int(np.argmax(RowMin[:, k] == BlockMin[k]))
+                    BestD[k] = BlockMin[k]
+                    BestI[k] = Start + Row
+                    BestJ[k] = int(np.argmin(D[Row, Starts[k]:Ends[k]]))
+
+            for k, j in enumerate(NotEmpty2):
+                # Начальное значение - расстояние между первыми точками, обновляется только строго меньшим
+                D00 = DNMathAdd.CalcEvkl(Contur1[0], Conturs2[j][0])
+                if BestD[k] < D00:
+                    # NDx2 - сквозной номер пары точек: счетчик j в прежнем двойном цикле не сбрасывался
+                    Res[i][j] = [BestD[k], Contur1[BestI[k]], Conturs2[j][BestJ[k]], int(BestI[k]),
+                                 int(BestI[k] * Lens2[j] + BestJ[k])]
+                else:
+                    Res[i][j] = [D00, [], [], 0, 0]
+
+        return Res
+
     # Рабочая функция по отрисовке контура и линий
     @classmethod
     def PrintContLines(cls, Contur: [], Lines: []):
@@ -2608,13 +2720,17 @@ class DNTheam:
         # 2. Фильтрация по минимальному расстоянию от РО до предполагаемого
         CopNumCMZ = NumCMZ.copy()
         RezIndx = []
-        for ContRO in ContursRO:
+        # Расстояния от всех кандидатов до всех РО одним вызовом
+        DistCMZ = DNTheam.CalcMinDistConts([ContursAll[i] for i in CopNumCMZ], ContursRO)
+        for r, ContRO in enumerate(ContursRO):
             DMin = 100000
             P1 = []
             P2 = []
             IndxMin = -1
-            for i in CopNumCMZ:
-                D = DNTheam.CalcMinDistCont(ContursAll[i], ContRO)
+            for k, i in enumerate(CopNumCMZ):
+                D = DistCMZ[k][r]
+                if D == -1:
+                    continue
                 if D[0] < DMin:
                     DMin = D[0]
                     IndxMin = i
@@ -2741,21 +2857,94 @@ def read_yolo(path_to_yolo_reults: str):
     return Elements
 
 
-class GrigStructs:
-    def __init__(self, LRM: float, PathToImgFile: str, PathToCNNFile, PathToModelFile: str):
-        # Задаем ЛРМ
-        self.lrm = LRM
+class DNAnalysisContext:
+    # Общие данные анализа одного изображения: изображение, результаты СНС, таблица ребер
+    # Загружаются один раз и используются всеми объектами DNToQGis и GrigStructs этого изображения
+    def __init__(self, PathToImg: str, PathToCNNRes: str, PathToModelFile: str):
+        self.PathToImg = PathToImg
+        self.PathToCNNRes = PathToCNNRes
+        self.PathToModelFile = PathToModelFile
 
-        # Читаем картинку
-        self.image = Image.open(PathToImgFile)
+        self.image = Image.open(PathToImg)
         self.HImg = self.image.height
         self.WImg = self.image.width
 
-        # Читаем файл результатов СНС
-        self.Elements = read_yolo(PathToCNNFile)
+        # Результаты СНС и их полигоны (пиксельные и шейп) в порядке NumElem
+        self.Elements = read_yolo(PathToCNNRes)
+        self.PolysPT = []
+        self.PolysSH = []
+        for Elem in self.Elements:
+            pts = self.ElemToPts(Elem)
+            self.PolysPT.append(pts)
+            self.PolysSH.append(Polygon(pts))
+
+        self._RGBMass = None
+        self._rebra_data = None
+        self._GObjs = {}
+
+    # Пиксельные координаты элемента результатов НС
+    def ElemToPts(self, Elem):
+        pts = np.zeros([len(Elem['x']), 2], dtype=np.int32)
+        pts[:, 0] = np.array(Elem['x'] * self.WImg, int)
+        pts[:, 1] = np.array(Elem['y'] * self.HImg, int)
+        return pts
+
+    # Изображение в виде массива uint8, только для чтения
+    @property
+    def RGBMass(self):
+        if self._RGBMass is None:
+            self._RGBMass = np.array(self.image).astype("uint8")
+            self._RGBMass.setflags(write=False)
+        return self._RGBMass
+
+    # Таблица ребер, созданная по эталонам
+    @property
+    def rebra_data(self):
+        if self._rebra_data is None:
+            self._rebra_data = pd.read_csv(self.PathToModelFile, delimiter=';', encoding='utf_8',
+                                           encoding_errors='replace')
+        return self._rebra_data
 
-        # Читаем таблицу ребер, созданную по эталонам
-        self.rebra_data = pd.read_csv(PathToModelFile, delimiter=';', encoding='utf_8', encoding_errors='replace')
+    # Преобразование результатов НС в полигоны Шейп и пиксельные
+    # Для элементов этого контекста берутся заранее построенные полигоны
+    def ElemsToPoly(self, Elems: []):
+        PolysPT = []
+        PolysSH = []
+        NumCl = []
+        for Elem in Elems:
+            NumElem = Elem['NumElem']
+            if 0 <= NumElem < len(self.Elements) and self.Elements[NumElem] is Elem:
+                PolysPT.append(self.PolysPT[NumElem].copy())
+                PolysSH.append(self.PolysSH[NumElem])
+            else:
+                pts = self.ElemToPts(Elem)
+                PolysPT.append(pts)
+                PolysSH.append(Polygon(pts))
+            NumCl.append(Elem['NumCls'])
+
+        return {'PolysPT': PolysPT, 'PolysSH': PolysSH, 'NumCl': NumCl}
+
+    # Объект GrigStructs для заданного ЛРМ (создается один раз)
+    def GetGrigStructs(self, LRM: float):
+        if LRM not in self._GObjs:
+            self._GObjs[LRM] = GrigStructs(LRM, self.PathToImg, self.PathToCNNRes, self.PathToModelFile, Context=self)
+        return self._GObjs[LRM]
+
+
+class GrigStructs:
+    def __init__(self, LRM: float, PathToImgFile: str, PathToCNNFile, PathToModelFile: str, Context=None):
+        # Задаем ЛРМ
+        self.lrm = LRM
+
+        # Изображение, результаты СНС и таблица ребер (общие для всех объектов одного изображения)
+        if Context is None:
+            Context = DNAnalysisContext(PathToImgFile, PathToCNNFile, PathToModelFile)
+        self.Context = Context
+
+        self.image = Context.image
+        self.HImg = Context.HImg
+        self.WImg = Context.WImg
+        self.Elements = Context.Elements
 
         # Определяем номера классоов в результатах НС
         self.ClassNums = {'RO_P': 0,
@@ -2771,22 +2960,14 @@ class GrigStructs:
                           'Disch': 10,
                           'Disel': 11}
 
+    # Таблица ребер, созданная по эталонам (читается при первом обращении)
+    @property
+    def rebra_data(self):
+        return self.Context.rebra_data
+
     # Преобразование результатов НС в полигоны Шейп и пиксельные
     def ElemsToPoly(self, Elems):
-        PolysPT = []
-        PolysSH = []
-        NumCl = []
-        for i in range(len(Elems)):
-            CoordX = np.array(Elems[i]['x'] * self.WImg, int)
-            CoordY = np.array(Elems[i]['y'] * self.HImg, int)
-            pts = np.zeros([len(Elems[i]['x']), 2], dtype=np.int32)
-            pts[:, 0] = CoordX
-            pts[:, 1] = CoordY
-            PolysPT.append(pts)
-            PolysSH.append(Polygon(pts))
-            NumCl.append(Elems[i]['NumCls'])
-
-        return {'PolysPT': PolysPT, 'PolysSH': PolysSH, 'NumCl': NumCl}
+        return self.Context.ElemsToPoly(Elems)
 
     # Преобразование шейп полигонов в пиксельные
     def SHPToPol(self, PolsSHP: []):
@@ -2833,8 +3014,12 @@ class GrigStructs:
 
     # Объединение полигонов по критерию близости друг к другу
     # MaxDist - без учета ЛРМ (в пикселях)
+    # method - 'indexed' (STRtree и связные компоненты) или 'pairwise' (прежний перебор после каждого объединения)
     @classmethod
-    def PolyUnion(cls, PolsSHP: [], MaxDist: float):
+    def PolyUnion(cls, PolsSHP: [], MaxDist: float, method='indexed'):
+        if method == 'indexed':
+            return group_geometries(PolsSHP, max_dist=MaxDist, merge='convex_hull')
+
         GrP_C = PolsSHP.copy()
         while True:
             IsUnion = False  # Произошло ли объединение:
@@ -2875,7 +3060,7 @@ class GrigStructs:
         return Res
 
     # Функция создания буферных зон вокуруг полигонов
-    def CreateBufZone(self, Pols: [], Dist: int):
+    def CreateBufZone(self, Pols: [], Dist: int, method='indexed'):
         Bufs = []
 
         # Строим буфер полигонов
@@ -2883,6 +3068,18 @@ class GrigStructs:
             Bufs.append(Pol.buffer(Dist))
 
         # Объединяем пересекающиеся полигоны
+        Res = self.UnionOverlapped(Bufs, method=method)
+
+        # Получаем координаты точек полигонов, не выходящие за пределы изображения
+        return self.SHPToPol(Res)
+
+    # Объединение перекрывающихся полигонов
+    # method - 'indexed' (STRtree и связные компоненты) или 'pairwise' (прежний перебор после каждого объединения)
+    @classmethod
+    def UnionOverlapped(cls, Bufs: [], method='indexed'):
+        if method == 'indexed':
+            return group_geometries(Bufs, merge='union')
+
         Res = Bufs.copy()
         while 1:
             IsPolUnion = False
@@ -2901,31 +3098,14 @@ class GrigStructs:
             if not IsPolUnion:
                 break
 
-        # Получаем координаты точек полигонов
-        ResPT = []
-        for Pol in Res:
-            ResPT.append(np.array(Pol.exterior.coords, int))
-
-        # Проверка, не выходят ли координаты точек буферной зоны за пределы изображения
-        for i in range(len(ResPT)):
-            for j in range(len(ResPT[i])):
-                if ResPT[i][j, 0] < 0:
-                    ResPT[i][j, 0] = 0
-                if ResPT[i][j, 1] < 0:
-                    ResPT[i][j, 1] = 0
-                if ResPT[i][j, 0] >= self.WImg:
-                    ResPT[i][j, 0] = self.WImg - 1
-                if ResPT[i][j, 1] >= self.HImg:
-                    ResPT[i][j, 1] = self.HImg - 1
-
-        return ResPT
+        return Res
 
     # Функция создания мини-картинок из указанных полигонов
     def CreateZoneImgs(self, Conturs: []):
 
         # CroppImg = PilImg.crop((Mask['XMin'],Mask['YMin'],Mask['XMin']+Mask['WPol'],Mask['YMin']+Mask['HPol']))
         # Преобразование картинки в массив данных
-        RGBMAss = np.array(self.image).astype("uint8")
+        RGBMAss = self.Context.RGBMass
 
         # Формирование маску всех зон
         mask = np.zeros([self.HImg, self.WImg], dtype=bool)
@@ -3103,27 +3283,9 @@ class GrigStructs:
             return None
 
         # Преобразуем найденные объекты в набор полигонов
-        RO_Polys = []
-        RO_PolysSH = []
-        for i in range(len(ElemsRO)):
-            ElemsRO[i]['x'] = np.array(ElemsRO[i]['x'] * self.WImg, int)
-            ElemsRO[i]['y'] = np.array(ElemsRO[i]['y'] * self.HImg, int)
-            pts = np.zeros([len(ElemsRO[i]['x']), 2], dtype=np.int32)
-            pts[:, 0] = ElemsRO[i]['x']
-            pts[:, 1] = ElemsRO[i]['y']
-            RO_Polys.append(pts)
-            RO_PolysSH.append(Polygon(pts))
-
-        MZ_Polys = []
-        MZ_PolysSH = []
-        for i in range(len(ElemsMZ)):
-            ElemsMZ[i]['x'] = np.array(ElemsMZ[i]['x'] * self.WImg, int)
-            ElemsMZ[i]['y'] = np.array(ElemsMZ[i]['y'] * self.HImg, int)
-            pts = np.zeros([len(ElemsMZ[i]['x']), 2], dtype=np.int32)
-            pts[:, 0] = ElemsMZ[i]['x']
-            pts[:, 1] = ElemsMZ[i]['y']
-            MZ_Polys.append(pts)
-            MZ_PolysSH.append(Polygon(pts))
+        # (элементы общие для всего изображения, поэтому координаты в них не перезаписываются)
+        RO_PolysSH = self.ElemsToPoly(ElemsRO)['PolysSH']
+        MZ_PolysSH = self.ElemsToPoly(ElemsMZ)['PolysSH']
 
         Zoes = self.CreateBufZone(MZ_PolysSH, MaxR)
         return self.CreateZoneImgs(Zoes)
@@ -3142,31 +3304,9 @@ class GrigStructs:
             return None
 
         # Преобразуем найденные объекты в набор полигонов
-        RO_Polys = []
-        RO_PolysSH = []
-
-        # Преобразуем полигоны РО
-        for i in range(len(ElemsRO)):
-            ElemsRO[i]['x'] = np.array(ElemsRO[i]['x'] * self.WImg, int)
-            ElemsRO[i]['y'] = np.array(ElemsRO[i]['y'] * self.HImg, int)
-            pts = np.zeros([len(ElemsRO[i]['x']), 2], dtype=np.int32)
-            pts[:, 0] = ElemsRO[i]['x']
-            pts[:, 1] = ElemsRO[i]['y']
-            RO_Polys.append(pts)
-            RO_PolysSH.append(Polygon(pts))
-
-        MZ_Polys = []
-        MZ_PolysSH = []
-
-        # Преобразуем полигоны МЗ
-        for i in range(len(ElemsMZ)):
-            ElemsMZ[i]['x'] = np.array(ElemsMZ[i]['x'] * self.WImg, int)
-            ElemsMZ[i]['y'] = np.array(ElemsMZ[i]['y'] * self.HImg, int)
-            pts = np.zeros([len(ElemsMZ[i]['x']), 2], dtype=np.int32)
-            pts[:, 0] = ElemsMZ[i]['x']
-            pts[:, 1] = ElemsMZ[i]['y']
-            MZ_Polys.append(pts)
-            MZ_PolysSH.append(Polygon(pts))
+        # (элементы общие для всего изображения, поэтому координаты в них не перезаписываются)
+        RO_PolysSH = self.ElemsToPoly(ElemsRO)['PolysSH']
+        MZ_PolysSH = self.ElemsToPoly(ElemsMZ)['PolysSH']
 
         # Для каждого найденного по сети МЗ  определяем его группу реакторов
         IndxGRO = list(range(len(ElemsRO)))
@@ -3290,7 +3430,7 @@ class DNProgressBar:
 
 # Класс для встраивания в QGis
 class DNToQGis:
-    def __init__(self, PathToImg: str, PathToCNNRes: str, PathToModelFile: str, MinArea=150, MinL=10):
+    def __init__(self, PathToImg: str, PathToCNNRes: str, PathToModelFile: str, MinArea=150, MinL=10, Context=None):
 
         # Начальные параметры для детектирования зданий (в пикселях)
         self.MinArea = MinArea  # Минимальная площадь сегмента
@@ -3310,34 +3450,22 @@ class DNToQGis:
                           'Gr_B_Act': 10,
                           'Disch': 11}
 
-        self.image = Image.open(PathToImg)
-        self.HImg = self.image.height
-        self.WImg = self.image.width
-
-        # Читаем файл результатов СНС
+        # Изображение и результаты СНС загружаются один раз и используются всеми этапами обработки
+        if Context is None:
+            Context = DNAnalysisContext(PathToImg, PathToCNNRes, PathToModelFile)
+        self.Context = Context
 
-        self.Elements = read_yolo(PathToCNNRes)
+        self.image = Context.image
+        self.HImg = Context.HImg
+        self.WImg = Context.WImg
+        self.Elements = Context.Elements
 
-    # Преобразование результатов НС в полигоны Шейп и пиксельные
     # Преобразование результатов НС в полигоны Шейп и пиксельные
     def ElemsToPoly(self, Elems: []):
         if Elems == None:
             return {'PolysPT': None, 'PolysSH': None, 'NumCl': None}
 
-        PolysPT = []
-        PolysSH = []
-        NumCl = []
-        for i in range(len(Elems)):
-            CoordX = np.array(Elems[i]['x'] * self.WImg, int)
-            CoordY = np.array(Elems[i]['y'] * self.HImg, int)
-            pts = np.zeros([len(Elems[i]['x']), 2], dtype=np.int32)
-            pts[:, 0] = CoordX
-            pts[:, 1] = CoordY
-            PolysPT.append(pts)
-            PolysSH.append(Polygon(pts))
-            NumCl.append(Elems[i]['NumCls'])
-
-        return {'PolysPT': PolysPT, 'PolysSH': PolysSH, 'NumCl': NumCl}
+        return self.Context.ElemsToPoly(Elems)
 
     # Удаление накладывающихся друг на друга полигонов (удаление из списка Targ)
     def PolyInterSecDel(self, PolysPTSrc: [], PolysPTTarg, IntersPart=0.5):
@@ -3379,7 +3507,7 @@ class DNToQGis:
     ####### Функции отрисовки результатов распознавания объектов по НС
     # Вывод контуров на изображение
     def PrintConturs(self, Conturs: []):
-        RGBMAss = np.array(self.image).astype("uint8")
+        RGBMAss = self.Context.RGBMass.copy()
 
         for Contur in Conturs:
             for i in range(len(Contur)):
@@ -3412,7 +3540,7 @@ class DNToQGis:
             return None
 
         DistP = Dist / LRMImg
-        GObj = GrigStructs(LRMImg, self.PathToImg, self.PathToCNNRes, self.PathToModelFile)
+        GObj = self.Context.GetGrigStructs(LRMImg)
         Pols = self.ElemsToPoly(Elems)
         Zones = GObj.CreateBufZone(Pols['PolysSH'], DistP)
         return GObj.CreateZoneImgs(Zones)
@@ -3624,7 +3752,7 @@ class DNToQGis:
     def MZ_FinedRO(self, LRMImg: float, MinDist=0.0, MaxDist=70.0, DistPor=12.0):
         MZ_Elems = self.MZ_FilterArea(LRMImg)
         RO_Elems = self.RO_FilterArea(LRMImg)
-        GObj = GrigStructs(LRMImg, self.PathToImg, self.PathToCNNRes, self.PathToModelFile)
+        GObj = self.Context.GetGrigStructs(LRMImg)
         ElemsROMZ = GObj.MZ_FinedRO(RO_Elems, MZ_Elems, MinDist, MaxDist, DistPor)
         return ElemsROMZ
 
@@ -3654,7 +3782,7 @@ class DNToQGis:
                 'PolysPT': self.ElemsToPoly(Elems['RO'])['PolysPT']}
 
     def LocalZoneBNS(self, LRMImg: float, MaxDistGroupGR=190, MaxDistGroupObj=70):
-        GObj = GrigStructs(LRMImg, self.PathToImg, self.PathToCNNRes, self.PathToModelFile)
+        GObj = self.Context.GetGrigStructs(LRMImg)
         Res = GObj.LocalZoneBNSGR(MaxDistGroupGR, MaxDistGroupObj)
         return Res
 
@@ -3845,20 +3973,21 @@ class DNToQGis:
 
 
 class DNTheamProc:
-    def __init__(self, PathToImg: str, PathToCNNRes: str, PathToModelFile: str, LRM: float, sam_model):
-        self.ToQGisObj = DNToQGis(PathToImg, PathToCNNRes, PathToModelFile)
+    def __init__(self, PathToImg: str, PathToCNNRes: str, PathToModelFile: str, LRM: float, sam_model, Context=None):
+        # Все этапы AESProc используют один контекст изображения (изображение, результаты СНС, полигоны)
+        self.ToQGisObj = DNToQGis(PathToImg, PathToCNNRes, PathToModelFile, Context=Context)
         self.LRM = LRM
         self.sam_model = sam_model
 
         self.psnt_connection = LoadPercentConnection()
         self.info_connection = InfoConnection()
 
-    def AESProc(self, save_folder=""):
+    # debug - сохранять кропы, визуализацию и маски SAM в save_folder
+    # max_workers - число зон, обрабатываемых SAM одновременно
+    def AESProc(self, save_folder="", debug=False, max_workers=1):
 
-        if save_folder == "":
+        if debug and save_folder == "":
             save_folder = os.path.join(os.getcwd(), 'sam_results')
-            if not os.path.exists(save_folder):
-                os.makedirs(save_folder)
 
         # Этап 1: Фильтрация элементов по площади
         print("Фильтрация результатов распознавания по геометрическим признакам")
@@ -3927,37 +4056,30 @@ class DNTheamProc:
 
             Imgs = Res['Imgs']
             MZConts = []
-            crop_names = []
-            for i in range(len(Imgs['Imgs'])):
-                Img = Imgs['Imgs'][i]
-
-                crop_name = os.path.join(save_folder, f'crop{i}.jpg')
-                crop_names.append(crop_name)
-                Img.save(crop_name)
-
-                pkl_name = os.path.join(save_folder, f'crop{i}.pkl')
-
-                create_masks(generator, crop_name, output_path=None,
-                             one_image_name=os.path.join(save_folder, f'crop{i}_sam.jpg'),
-                             pickle_name=pkl_name)
 
-                with open(pkl_name, 'rb') as f:
+            # Кропы и маски передаются в памяти, файлы сохраняются только для отладки
+            MassList = generate_masks_for_crops(generator, Imgs['Imgs'], max_workers=max_workers,
+                                                debug_folder=save_folder if debug else None,
+                                                on_crop_finished=lambda n: self.psnt_connection.percent.emit(
+                                                    int(60 + 25 * n / len(Imgs['Imgs']))))
 
-                    Mass = pickle.load(f)
+            for i, Mass in enumerate(MassList):
+                if len(Mass) == 0:
+                    continue
 
-                    # Поиск Машинного зала в локализованной области
-                    MZContsImg = self.ToQGisObj.MZ_Fined(Mass, Res['PolysPT'], Imgs['Coords'][i], self.LRM)
+                # Поиск Машинного зала в локализованной области
+                MZContsImg = self.ToQGisObj.MZ_Fined(Mass, Res['PolysPT'], Imgs['Coords'][i], self.LRM)
 
-                    if MZContsImg == None:
-                        print("ЛРМ изображения недостаточно для поиска МЗ")
-                        self.info_connection.info_message.emit(
-                            f"ЛРМ изображения недостаточно для поиска МЗ")
+                if MZContsImg == None:
+                    print("ЛРМ изображения недостаточно для поиска МЗ")
+                    self.info_connection.info_message.emit(
+                        f"ЛРМ изображения недостаточно для поиска МЗ")
 
-                        continue
+                    continue
 
-                    elif not len(MZContsImg) == 0:
-                        for MZContImg in MZContsImg:
-                            MZConts.append(MZContImg)
+                elif not len(MZContsImg) == 0:
+                    for MZContImg in MZContsImg:
+                        MZConts.append(MZContImg)
 
             self.psnt_connection.percent.emit(90)
             if len(MZConts) == 0:
@@ -1,28 +1,36 @@
 import math
 import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import torch
 from PySide2 import QtCore
 
 import utils.help_functions as hf
-from ui.signals_and_slots import LoadPercentConnection
-from utils.detect_yolo8 import predict_and_return_masks, predict_and_return_mask_openvino
+from ui.signals_and_slots import LoadPercentConnection, InfoConnection
+from utils.detect_yolo8 import predict_and_return_masks, predict_and_return_mask_openvino, \
+    predict_and_return_masks_batch
 from utils.edges_from_mask import yolo8masks2points
 from utils.project import create_blank_image
+from utils.tile_reader import WindowedImageReader
+from utils.tiled_inference import run_tiled_inference
 
 
 class CNN_worker(QtCore.QThread):
 
     def __init__(self, model, conf_thres=0.7, iou_thres=0.5,
                  img_name="selected_area.png", img_path=None, model_name="YOLOv8",
-                 scanning=False, linear_dim=0.0923, images_list=None, simplify_factor=1.0, nc=12):
+                 scanning=False, linear_dim=0.0923, images_list=None, simplify_factor=1.0, nc=12,
+                 pipelined=False, batch_size=4, decode_workers=4, polygon_workers=4, fast_contours=True):
 
         super(CNN_worker, self).__init__()
 
         self.conf_thres = float(conf_thres)
         self.iou_thres = float(iou_thres)
         self.simplify_factor = float(simplify_factor)
+        self.fast_contours = fast_contours  # контуры масок через cv2 без Shapely, см. yolo8masks2points
         self.model = model
 
         self.img_name = img_name
@@ -36,19 +44,31 @@ class CNN_worker(QtCore.QThread):
         self.img_ld = linear_dim
         self.train_ld = 0.11
         self.train_img_px = 8000  # в реальности - 1280, но это ужатые 8000 с ld = 0.0923
+        self.overview_size = 2560  # размер уменьшенной копии для прохода по всему изображению при сканировании
 
         self.psnt_connection = LoadPercentConnection()
+        self.info_conn = InfoConnection()
         self.model_name = model_name
 
         self.nc = nc
 
+        # Конвейерный режим для списка изображений: чтение, детекция и построение полигонов в разных потоках
+        self.pipelined = pipelined
+        self.batch_size = max(1, int(batch_size))
+        self.decode_workers = max(1, int(decode_workers))
+        self.polygon_workers = max(1, int(polygon_workers))
+        self.stage_stats = {}
+
     def run(self):
 
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
 
         if self.image_list:
-            self.run_yolo8_image_list(self.image_list)
+            if self.pipelined:
+                self.run_yolo8_image_list_pipelined(self.image_list)
+            else:
+                self.run_yolo8_image_list(self.image_list)
             return
 
         if self.img_path == None:
@@ -93,8 +113,7 @@ class CNN_worker(QtCore.QThread):
                 shapes = []
                 for res in results:
                     for i, mask in enumerate(res['masks']):
-                        points_mass = yolo8masks2points(mask, simplify_factor=self.simplify_factor, width=image_width,
-                                                        height=image_height)
+                        points_mass = self.mask_to_points(mask, image_width, image_height)
                         for points in points_mass:
                             cls_num = res['classes'][i]
 
@@ -110,97 +129,199 @@ class CNN_worker(QtCore.QThread):
 
         self.psnt_connection.percent.emit(100)
 
-    def run_yolo8(self, img_path_full, is_scanning, is_progress_show=True, filter_obj_on_edges=True):
-        img = cv2.imread(img_path_full)
-        shape = img.shape
+    def mask_to_points(self, mask, width, height):
+        points_mass = yolo8masks2points(mask, simplify_factor=self.simplify_factor, width=width, height=height,
+                                        fast=self.fast_contours)
+        if self.fast_contours:
+            return [points.tolist() for points in points_mass]
+        return points_mass
+
+    def run_yolo8_image_list_pipelined(self, image_list):
+        """
+        Конвейерный вариант run_yolo8_image_list.
+        Изображения читаются заранее в пуле потоков decode_workers, в модель подаются пачками по batch_size,
+        маски преобразуются в полигоны в отдельном пуле polygon_workers.
+        Статистика по стадиям отправляется через psnt_connection.stats
+        """
+        self.psnt_connection.percent.emit(0)
+        self.all_images_results = {}
+        self.stage_stats = {stage: {'items': 0, 'time': 0.0} for stage in ('decode', 'predict', 'polygons')}
 
-        if is_scanning:
+        if self.model_name not in ('YOLOv8', 'YOLOv8_openvino'):
+            self.info_conn.info_message.emit(f"Unsupported model {self.model_name} for pipelined detection")
+            self.psnt_connection.percent.emit(100)
+            return
 
-            if is_progress_show:
-                self.psnt_connection.percent.emit(0)
+        images_num = len(image_list)
+        # openvino модель скомпилирована под один кадр
+        batch_size = self.batch_size if self.model_name == 'YOLOv8' else 1
+        prefetch_size = 2 * batch_size + self.decode_workers
 
-            self.run_yolo8(img_path_full, is_scanning=False, is_progress_show=False)
+        id_tek = 0
+        done_num = 0
+
+        with ThreadPoolExecutor(max_workers=self.decode_workers) as decode_pool, \
+                ThreadPoolExecutor(max_workers=self.polygon_workers) as polygon_pool:
+
+            decode_futures = deque()
+            polygon_futures = deque()
+            next_to_decode = 0
+
+            for batch_start in range(0, images_num, batch_size):
+                batch_end = min(batch_start + batch_size, images_num)
+
+                # держим очередь чтения заполненной на prefetch_size изображений вперед
+                while next_to_decode < images_num and next_to_decode < batch_start + prefetch_size:
+                    decode_futures.append(decode_pool.submit(self.decode_image, image_list[next_to_decode]))
+                    next_to_decode += 1
+
+                batch = []
+                for _ in range(batch_end - batch_start):
+                    img_path_full, img, decode_time = decode_futures.popleft().result()
+                    self.add_stage_stats('decode', 1, decode_time)
+                    if img is None:
+                        print(f"Can't read image {img_path_full}. Skip it")
+                        done_num += 1
+                        continue
+                    batch.append((img_path_full, img))
+
+                if batch:
+                    start_time = time.perf_counter()
+                    batch_results = self.predict_batch([img for _, img in batch])
+                    self.add_stage_stats('predict', len(batch), time.perf_counter() - start_time)
+
+                    for (img_path_full, img), results in zip(batch, batch_results):
+                        polygon_futures.append(
+                            (os.path.basename(img_path_full),
+                             polygon_pool.submit(self.results_to_shapes, results, img.shape[1], img.shape[0])))
+
+                # забираем готовые полигоны, сохраняя порядок изображений
+                while polygon_futures and polygon_futures[0][1].done():
+                    id_tek = self.collect_image_shapes(polygon_futures.popleft(), id_tek)
+                    done_num += 1
+
+                self.psnt_connection.percent.emit(int(done_num * 100.0 / images_num))
+                self.psnt_connection.stats.emit(self.get_stage_stats())
+
+            while polygon_futures:
+                id_tek = self.collect_image_shapes(polygon_futures.popleft(), id_tek)
+
+        self.psnt_connection.stats.emit(self.get_stage_stats())
+        self.psnt_connection.percent.emit(100)
 
-            if self.img_ld:
-                frag_size = int(self.train_img_px * self.train_ld / self.img_ld)
+    @staticmethod
+    def decode_image(img_path_full):
+        start_time = time.perf_counter()
+        img = cv2.imread(img_path_full)
+        return img_path_full, img, time.perf_counter() - start_time
+
+    def predict_batch(self, images):
+        if self.model_name == 'YOLOv8_openvino':
+            return [predict_and_return_mask_openvino(self.model, img, conf=self.conf_thres, iou=self.iou_thres,
+                                                     save_txt=False, nc=self.nc) for img in images]
+
+        return predict_and_return_masks_batch(self.model, images, conf=self.conf_thres, iou=self.iou_thres,
+                                              save_txt=False)
+
+    def results_to_shapes(self, results, image_width, image_height):
+        """
+        Результаты модели для одного изображения -> список (cls_num, points, conf).
+        Выполняется в пуле polygon_workers
+        """
+        start_time = time.perf_counter()
+        shapes = []
+
+        if self.model_name == 'YOLOv8_openvino':
+            boxes = results["det"]
+            masks = results.get("segment")
+            for idx, (*xyxy, conf, lbl) in enumerate(boxes):
+                shapes.append((int(lbl), masks[idx].astype(int), conf))
+
+        elif results:
+            for i, mask in enumerate(results['masks']):
+                points_mass = self.mask_to_points(mask, image_width, image_height)
+                for points in points_mass:
+                    shapes.append((results['classes'][i], points, results['confs'][i]))
+
+        return shapes, time.perf_counter() - start_time
+
+    def collect_image_shapes(self, filename_and_future, id_tek):
+        filename, future = filename_and_future
+        shapes_tuples, polygons_time = future.result()
+        self.add_stage_stats('polygons', 1, polygons_time)
+
+        shapes = []
+        for cls_num, points, conf in shapes_tuples:
+            if self.model_name == 'YOLOv8_openvino':
+                shapes.append({'cls_num': cls_num, 'points': points, 'conf': conf})
             else:
-                frag_size = 1280
-
-            if math.fabs(frag_size - 1280) < 300:
-                if is_progress_show:
-                    self.psnt_connection.percent.emit(100)
-                return
-
-            scanning_results = [res for res in self.mask_results]
-
-            parts = hf.split_into_fragments(img, frag_size)
-            crop_x_y_sizes, x_parts_num, y_parts_num = hf.calc_parts(shape[1], shape[0], frag_size)
-
-            print(f'Crop image into {x_parts_num}x{y_parts_num}')
-
-            part_tek = 0
-            for part, part_size in zip(parts, crop_x_y_sizes):
-
-                if self.model_name == 'YOLOv8_openvino':
-                    part_mask_results = predict_and_return_mask_openvino(self.model, part, conf=self.conf_thres,
-                                                                         iou=self.iou_thres, save_txt=False, nc=self.nc)
-
-                    x_min, x_max = part_size[0]
-                    y_min, y_max = part_size[1]
-
-                    boxes = part_mask_results["det"]
-                    masks = part_mask_results.get("segment")
-
-                    for idx, (*xyxy, conf, lbl) in enumerate(boxes):
-                        points = masks[idx].astype(int)
+                shapes.append({'id': id_tek, 'cls_num': cls_num, 'points': points})
+                id_tek += 1
+
+        im_blank = create_blank_image()  # return  {"shapes": [], "lrm": None, 'status': 'empty'}
+        im_blank['shapes'] = shapes
+        self.all_images_results[filename] = im_blank
+
+        return id_tek
+
+    def add_stage_stats(self, stage, items, stage_time):
+        self.stage_stats[stage]['items'] += items
+        self.stage_stats[stage]['time'] += stage_time
+
+    def get_stage_stats(self):
+        """
+        Пропускная способность стадий конвейера, изображений в секунду
+        {stage: {'items': int, 'time': float, 'throughput': float}}
+        """
+        stats = {}
+        for stage, stat in self.stage_stats.items():
+            throughput = stat['items'] / stat['time'] if stat['time'] > 0 else 0.0
+            stats[stage] = {'items': stat['items'], 'time': stat['time'], 'throughput': throughput}
+        return stats
 
-                        if filter_obj_on_edges:
-                            points_filtered = hf.filter_edged_points(points, x_max - x_min, y_max - y_min, 5)
-                            if len(points_filtered) != len(points):
-                                continue
-                            else:
-                                points = points_filtered
+    def run_yolo8(self, img_path_full, is_scanning, is_progress_show=True, filter_obj_on_edges=True):
 
-                        points_shifted = []
-                        for x, y in points:
-                            points_shifted.append([x + x_min, y + y_min])
-                        scanning_results.append({'cls_num': int(lbl), 'points': points_shifted, 'conf': conf})
+        if is_scanning:
 
+            if is_progress_show:
+                self.psnt_connection.percent.emit(0)
 
-                elif self.model_name == 'YOLOv8':
+            # изображение читается по окнам, целиком в память не загружается
+            with WindowedImageReader(img_path_full) as reader:
 
-                    part_mask_results = predict_and_return_masks(self.model, part, conf=self.conf_thres,
-                                                                 iou=self.iou_thres, save_txt=False)
-                    x_min, x_max = part_size[0]
-                    y_min, y_max = part_size[1]
+                overview, (scale_x, scale_y) = reader.read_overview(self.overview_size)
+                self.mask_results = self.detect_on_image(overview, is_progress_show=False)
+                if scale_x != 1.0 or scale_y != 1.0:
+                    for res in self.mask_results:
+                        res['points'] = [[x * scale_x, y * scale_y] for x, y in res['points']]
+                del overview
 
-                    for res in part_mask_results:
-                        for i, mask in enumerate(res['masks']):
-                            points_mass = yolo8masks2points(mask, simplify_factor=self.simplify_factor,
-                                                            width=x_max - x_min,
-                                                            height=y_max - y_min)
+                if self.img_ld:
+                    frag_size = int(self.train_img_px * self.train_ld / self.img_ld)
+                else:
+                    frag_size = 1280
 
-                            for points in points_mass:
+                if math.fabs(frag_size - 1280) < 300:
+                    if is_progress_show:
+                        self.psnt_connection.percent.emit(100)
+                    return
 
-                                if filter_obj_on_edges:
-                                    points_filtered = hf.filter_edged_points(points, x_max - x_min, y_max - y_min, 5)
-                                    if len(points_filtered) != len(points):
-                                        continue
-                                    else:
-                                        points = points_filtered
+                crop_x_y_sizes, x_parts_num, y_parts_num = hf.calc_parts(reader.width, reader.height, frag_size)
 
-                                points_shifted = []
-                                for x, y in points:
-                                    points_shifted.append([x + x_min, y + y_min])
-                                cls_num = res['classes'][i]
-                                conf = res['confs'][i]
-                                scanning_results.append({'cls_num': cls_num, 'points': points_shifted, 'conf': conf})
+                print(f'Crop image into {x_parts_num}x{y_parts_num}')
 
-                part_tek += 1
-                if is_progress_show:
-                    self.psnt_connection.percent.emit(90.0 * part_tek / len(parts))
+                def on_progress(done_num, fragments_num):
+                    if is_progress_show:
+                        self.psnt_connection.percent.emit(int(90.0 * done_num / fragments_num))
 
-            self.mask_results = hf.filter_masks(scanning_results, conf_thres=self.conf_thres, iou_filter=0.05)
+                self.mask_results = run_tiled_inference(self.model, reader.iterate_fragments(frag_size),
+                                                        model_name=self.model_name, conf=self.conf_thres,
+                                                        iou=self.iou_thres, nc=self.nc,
+                                                        simplify_factor=self.simplify_factor,
+                                                        fast_contours=self.fast_contours,
+                                                        batch_size=self.batch_size, base_results=self.mask_results,
+                                                        filter_obj_on_edges=filter_obj_on_edges, merge_iou=0.05,
+                                                        fragments_num=len(crop_x_y_sizes), on_progress=on_progress)
 
             if is_progress_show:
                 self.psnt_connection.percent.emit(100)
@@ -209,39 +330,44 @@ class CNN_worker(QtCore.QThread):
             if is_progress_show:
                 self.psnt_connection.percent.emit(0)
 
-            if self.model_name == 'YOLOv8_openvino':
-                results = predict_and_return_mask_openvino(self.model, img, conf=self.conf_thres,
-                                                           iou=self.iou_thres, save_txt=False, nc=self.nc)
+            img = cv2.imread(img_path_full)
+            self.mask_results = self.detect_on_image(img, is_progress_show=is_progress_show)
 
-                boxes = results["det"]
-                masks = results.get("segment")
+            if is_progress_show:
+                self.psnt_connection.percent.emit(100)
 
-                mask_results = []
+    def detect_on_image(self, img, is_progress_show=True):
+        """
+        Детекция на изображении целиком
+        Возвращает список {'cls_num', 'points', 'conf'}
+        """
+        shape = img.shape
+        mask_results = []
 
-                for idx, (*xyxy, conf, lbl) in enumerate(boxes):
-                    mask_results.append({'cls_num': int(lbl), 'points': masks[idx].astype(int), 'conf': conf})
+        if self.model_name == 'YOLOv8_openvino':
+            results = predict_and_return_mask_openvino(self.model, img, conf=self.conf_thres,
+                                                       iou=self.iou_thres, save_txt=False, nc=self.nc)
 
-                self.mask_results = mask_results
+            boxes = results["det"]
+            masks = results.get("segment")
 
-            elif self.model_name == 'YOLOv8':
+            for idx, (*xyxy, conf, lbl) in enumerate(boxes):
+                mask_results.append({'cls_num': int(lbl), 'points': masks[idx].astype(int), 'conf': conf})
 
-                results = predict_and_return_masks(self.model, img, conf=self.conf_thres,
-                                                   iou=self.iou_thres, save_txt=False)
+        elif self.model_name == 'YOLOv8':
 
-                if is_progress_show:
-                    self.psnt_connection.percent.emit(50)
+            results = predict_and_return_masks(self.model, img, conf=self.conf_thres,
+                                               iou=self.iou_thres, save_txt=False)
 
-                mask_results = []
-                for res in results:
-                    for i, mask in enumerate(res['masks']):
-                        points_mass = yolo8masks2points(mask, simplify_factor=self.simplify_factor, width=shape[1],
-                                                        height=shape[0])
-                        for points in points_mass:
-                            cls_num = res['classes'][i]
-                            conf = res['confs'][i]
-                            mask_results.append({'cls_num': cls_num, 'points': points, 'conf': conf})
+            if is_progress_show:
+                self.psnt_connection.percent.emit(50)
 
-                self.mask_results = mask_results
+            for res in results:
+                for i, mask in enumerate(res['masks']):
+                    points_mass = self.mask_to_points(mask, shape[1], shape[0])
+                    for points in points_mass:
+                        cls_num = res['classes'][i]
+                        conf = res['confs'][i]
+                        mask_results.append({'cls_num': cls_num, 'points': points, 'conf': conf})
 
-            if is_progress_show:
-                self.psnt_connection.percent.emit(100)
+        return mask_results
@@ -1,8 +1,10 @@
 from collections import namedtuple
+from functools import lru_cache
 from PIL import Image
 from utils.pil_translate import get_extent, GeoTIFF
 
 import cv2
+import numpy as np
 import os
 
 Coords = namedtuple('Coords', ['latitude', 'longitude'])
@@ -427,6 +429,80 @@ def get_lrm(coords_net, img_height):
     return meters / img_height
 
 
+class GeoReference:
+    """
+    Геопривязка изображения: размер, охват (lat_min, lat_max, lon_min, lon_max) и ЛРМ
+    Считается один раз на изображение, см. get_geo_reference
+    Преобразования пиксели <-> гео-координаты работают сразу с массивами точек
+    """
+
+    def __init__(self, image_name, from_crs='epsg:3395', to_crs='epsg:4326'):
+        self.image_name = image_name
+
+        Image.MAX_IMAGE_PIXELS = None
+        with Image.open(image_name) as img:
+            self.width, self.height = img.size
+
+        self.extent = get_geo_extent(image_name, from_crs=from_crs, to_crs=to_crs)
+        self.lrm = self.calc_lrm(from_crs=from_crs, to_crs=to_crs)
+
+    def calc_lrm(self, from_crs='epsg:3395', to_crs='epsg:4326'):
+        ext = get_ext(self.image_name)
+        name_without_ext = self.image_name[:-len(ext)]
+        for map_ext in ['dat', 'map']:
+            map_name = name_without_ext + map_ext
+            if os.path.exists(map_name):
+                return get_lrm(load_coords(map_name), self.height)
+
+        if ext == 'tif' or ext == 'tiff':
+            if self.extent is None:
+                return lrm_from_pil_data(self.image_name, from_crs=from_crs, to_crs=to_crs)
+            lat_min, lat_max, lon_min, lon_max = self.extent
+            return abs(lat_max - lat_min) * 111.32 * 1000 / self.height
+
+    @property
+    def is_georeferenced(self):
+        return self.extent is not None
+
+    def pixels_to_geo(self, points):
+        """
+        points - массив (N, 2) координат в пикселях [x, y]
+        Возвращает np.ndarray (N, 2) [lon, lat]
+        """
+        lat_min, lat_max, lon_min, lon_max = self.extent
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+        geo = np.empty_like(points)
+        geo[:, 0] = lon_min + (points[:, 0] / self.width) * abs(lon_max - lon_min)
+        geo[:, 1] = lat_min + (1.0 - points[:, 1] / self.height) * abs(lat_max - lat_min)
+        return geo
+
+    def geo_to_pixels(self, geo_points):
+        """
+        geo_points - массив (N, 2) [lon, lat]
+        Возвращает np.ndarray (N, 2) координат в пикселях [x, y]
+        """
+        lat_min, lat_max, lon_min, lon_max = self.extent
+        geo_points = np.asarray(geo_points, dtype=np.float64).reshape(-1, 2)
+
+        points = np.empty_like(geo_points)
+        points[:, 0] = (geo_points[:, 0] - lon_min) / abs(lon_max - lon_min) * self.width
+        points[:, 1] = (1.0 - (geo_points[:, 1] - lat_min) / abs(lat_max - lat_min)) * self.height
+        return points
+
+
+@lru_cache(maxsize=64)
+def _load_geo_reference(image_name, mtime, from_crs, to_crs):
+    return GeoReference(image_name, from_crs=from_crs, to_crs=to_crs)
+
+
+def get_geo_reference(image_name, from_crs='epsg:3395', to_crs='epsg:4326'):
+    """
+    Геопривязка изображения из кэша. Изображение, измененное на диске, читается заново
+    """
+    return _load_geo_reference(image_name, os.path.getmtime(image_name), from_crs, to_crs)
+
+
 if __name__ == "__main__":
     # Получаем список географических координат углов изображения.
     # Поддерживаемые форматы .map, .kml, .dat
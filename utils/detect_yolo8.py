@@ -118,27 +118,53 @@ def predict_and_return_masks(model, source, conf=0.25, iou=0.7, save_txt=False):
     mask_results = []
     for res in results:  # res for each image
         if res.masks:
-            masks_mass = res.masks.cpu().numpy()
+            mask_results.append(yolo8_result_to_masks(res))
 
-            boxes_mass = res.boxes.cpu().numpy()
-            cls_nums = []
-            confs = []
-            for box in boxes_mass:
-                cls = int(box.cls[0])
-                cls_nums.append(cls)
-                confs.append(box.conf[0])
+    return mask_results
 
-            masks = []
-            for i, mask in enumerate(masks_mass):
-                mask = mask.data
-                mask[mask == 1] = 255
-                masks.append(mask)
 
-            mask_results.append({'masks': masks, 'confs': confs, 'classes': cls_nums})
+def predict_and_return_masks_batch(model, sources, conf=0.25, iou=0.7, save_txt=False):
+    """
+    Пакетный вариант predict_and_return_masks
+    sources - список изображений (np.ndarray), подаются в модель за один вызов
+    Возвращает список той же длины, что и sources. Для изображений без масок - None
+    """
+    results = model.predict(source=list(sources), save_conf=True, conf=float(conf), iou=float(iou),
+                            save_txt=save_txt, save=True)
+
+    mask_results = []
+    for res in results:
+        if res.masks:
+            mask_results.append(yolo8_result_to_masks(res))
+        else:
+            mask_results.append(None)
 
     return mask_results
 
 
+def yolo8_result_to_masks(res):
+    """
+    Результат YOLOv8 для одного изображения -> {'masks': [...], 'confs': [...], 'classes': [...]}
+    """
+    masks_mass = res.masks.cpu().numpy()
+
+    boxes_mass = res.boxes.cpu().numpy()
+    cls_nums = []
+    confs = []
+    for box in boxes_mass:
+        cls = int(box.cls[0])
+        cls_nums.append(cls)
+        confs.append(box.conf[0])
+
+    masks = []
+    for i, mask in enumerate(masks_mass):
+        mask = mask.data
+        mask[mask == 1] = 255
+        masks.append(mask)
+
+    return {'masks': masks, 'confs': confs, 'classes': cls_nums}
+
+
 def predict_and_return_mask_openvino(model, source, conf=0.25, iou=0.7, save_txt=False, nc=12):
     detections = detect(source, model, nms_iou_threshold=iou, min_conf_threshold=conf, nc=nc)[0]
 
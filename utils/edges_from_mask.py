@@ -284,7 +284,19 @@ def mask_results_to_yolo_txt(mask_results, image_path, yolo_txt_file_name, with_
             f.write(f"{line}\n")
 
 
-def yolo8masks2points(yolo_mask, simplify_factor=0.4, width=1280, height=1280):
+def yolo8masks2points(yolo_mask, simplify_factor=0.4, width=1280, height=1280, fast=False):
+    """
+    Маска YOLOv8 -> список полигонов в координатах изображения width x height
+    fast - быстрый режим: маска uint8, контуры cv2 без копирования в списки, упрощение cv2.approxPolyDP.
+           Полигоны возвращаются как np.ndarray (N, 2) float32.
+           Без fast - прежний путь через Shapely, списки [[x1, y1], ...]
+    """
+    if fast:
+        mask_height, mask_width = yolo_mask[0].shape
+        contours = mask_to_contours(yolo_mask[0] > 128, simplify_factor=simplify_factor)
+        scale = np.array([width / mask_width, height / mask_height], dtype=np.float32)
+        return [contour * scale for contour in contours]
+
     img_data = yolo_mask[0] > 128
     shape = img_data.shape
 
@@ -476,6 +488,43 @@ def test_cv2():
             shapes.append(Polygon(coords))
 
 
+def remove_small_components(mask, min_size=80):
+    """
+    Быстрый аналог hf.clean_mask(type='remove') для бинарной маски uint8
+    Убирает 8-связные компоненты площадью меньше min_size пикселей
+    """
+    labels_num, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    keep = stats[:, cv2.CC_STAT_AREA] >= min_size
+    keep[0] = False  # фон
+    return keep.astype(np.uint8)[labels] * np.uint8(255)
+
+
+def mask_to_contours(mask, simplify_factor=None, is_clear=True, min_size=80):
+    """
+    Быстрое преобразование маски в контуры, без Shapely
+    mask - бинарная маска, numpy array (bool или uint8)
+    simplify_factor - допуск cv2.approxPolyDP в пикселях. None или 0 - без упрощения
+    Возвращает список np.ndarray (N, 2) float32, последняя точка совпадает с первой, как в boundary Shapely
+    """
+    mask = np.asarray(np.squeeze(mask) > 0, dtype=np.uint8) * np.uint8(255)
+
+    if is_clear:
+        mask = remove_small_components(mask, min_size=min_size)
+
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+
+    results = []
+    for contour in contours:
+        if simplify_factor:
+            contour = cv2.approxPolyDP(contour, float(simplify_factor), True)
+        if len(contour) < 3:
+            continue
+        points = contour[:, 0, :]
+        results.append(np.concatenate([points, points[:1]]).astype(np.float32))
+
+    return results
+
+
 def mask_to_polygons_layer(mask, method='cv2', is_clear=True, min_size=80):
     """
     Преобразует маску в набор полигонов Shapely Polygon
@@ -494,17 +543,12 @@ def mask_to_polygons_layer(mask, method='cv2', is_clear=True, min_size=80):
                                             transform=rasterio.Affine(1.0, 0, 0, 0, 1.0, 0)):
             shapes.append(shapely.geometry.shape(shape))
     elif method == 'cv2':
-        polygons = []
         mask = mask * 255
         mask = mask.astype(np.uint8)
         contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
         for obj in contours:
-            coords = []
-            for point in obj:
-                coords.append([int(point[0][0]), int(point[0][1])])
-            polygons.append(coords)
-            if len(coords) > 2:
-                shapes.append(Polygon(coords))
+            if len(obj) > 2:
+                shapes.append(Polygon(obj[:, 0, :]))
 
     elif method == 'skimage':
         contours = find_contours(mask)
@@ -1,5 +1,7 @@
 import datetime
+import hashlib
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import cv2
 import numpy as np
@@ -16,11 +18,122 @@ from utils.dataset_preprocessing.splitter import train_test_val_splitter
 from utils import config
 
 
+def yolo_seg_line(points, im_shape, cls_num):
+    line = f"{cls_num}"
+    for point in points:
+        line += f" {point[0] / im_shape[1]} {point[1] / im_shape[0]}"
+    return f"{line}\n"
+
+
+def yolo_box_line(points, im_shape, cls_num):
+    xs = []
+    ys = []
+    for point in points:
+        xs.append(point[0])
+        ys.append(point[1])
+    min_x = min(xs)
+    max_x = max(xs)
+    min_y = min(ys)
+    max_y = max(ys)
+    w = abs(max_x - min_x)
+    h = abs(max_y - min_y)
+
+    x_center = min_x + w / 2
+    y_center = min_y + h / 2
+
+    return f"{cls_num} {x_center / im_shape[1]} {y_center / im_shape[0]} {w / im_shape[1]} {h / im_shape[0]}\n"
+
+
+def save_export_image(fullname, save_path, new_image_size=None, blur_txt_name=None):
+    """
+    Копирование изображения в датасет. При необходимости - размытие по разметке blur_txt_name и resize
+    """
+    if blur_txt_name:
+        mask = get_mask_from_yolo_txt(fullname, blur_txt_name, [0])
+        blurred_image_cv2 = blur_image_by_mask(fullname, mask)
+        if new_image_size:
+            blurred_image_cv2 = cv2.resize(blurred_image_cv2, new_image_size)
+
+        cv2.imwrite(save_path, blurred_image_cv2)
+    else:
+
+        if new_image_size:
+            img = cv2.imread(fullname)
+            new_img = cv2.resize(img, new_image_size)
+            cv2.imwrite(save_path, new_img)
+        else:
+            shutil.copy(fullname, save_path)
+
+
+def export_yolo_image(fullname, txt_names, image_save_paths, shapes, type, new_image_size=None, blur_txt_name=None):
+    """
+    Экспорт одного изображения в YOLO. Выполняется в пуле процессов
+    txt_names, image_save_paths - пути для каждой выборки, в которую входит изображение
+    shapes - [(export_cls_num или 'blur', points), ...]
+    """
+    im_shape = list(reversed(hf.read_image_size(fullname)))
+    write_line = yolo_seg_line if type == "seg" else yolo_box_line
+
+    lines = []
+    blur_lines = []
+    for export_cls_num, points in shapes:
+        if export_cls_num == 'blur':
+            blur_lines.append(write_line(points, im_shape, 0))
+        else:
+            lines.append(write_line(points, im_shape, export_cls_num))
+
+    labels_text = "".join(lines)
+    for txt_name in txt_names:
+        with open(txt_name, 'w') as f:
+            f.write(labels_text)
+
+    if blur_txt_name:
+        with open(blur_txt_name, 'w') as blur_f:
+            blur_f.write("".join(blur_lines))
+
+    for save_path in image_save_paths:
+        save_export_image(fullname, save_path, new_image_size=new_image_size, blur_txt_name=blur_txt_name)
+
+
+EXPORT_MANIFEST_NAME = 'sama_export_manifest.json'
+
+
+def calc_hash(data):
+    return hashlib.md5(ujson.dumps(data).encode('utf8')).hexdigest()
+
+
+def calc_file_hash(file_name, chunk_size=1 << 20):
+    md5 = hashlib.md5()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def load_export_manifest(export_dir):
+    manifest_name = os.path.join(export_dir, EXPORT_MANIFEST_NAME)
+    if os.path.exists(manifest_name):
+        try:
+            with open(manifest_name, 'r', encoding='utf8') as f:
+                return ujson.load(f)
+        except ValueError:
+            print(f"Can't read export manifest {manifest_name}. Full export")
+    return {"settings": None, "split_settings": None, "images": {}}
+
+
+def save_export_manifest(export_dir, manifest):
+    manifest_name = os.path.join(export_dir, EXPORT_MANIFEST_NAME)
+    temp_name = manifest_name + '.tmp'
+    with open(temp_name, 'w', encoding='utf8') as f:
+        ujson.dump(manifest, f)
+    os.replace(temp_name, manifest_name)
+
+
 class Exporter(QtCore.QThread):
 
     def __init__(self, project_data, export_dir, format='yolo_seg', export_map=None, dataset_name='dataset',
                  variant_idx=0, splits=None, split_method='names', sim=0,
-                 is_filter_null=False, new_image_size=None):
+                 is_filter_null=False, new_image_size=None, parallel=True, workers=None, incremental=False):
         """
         variant_idx = 0 Train/Val/Test
         1 - Train/Val
@@ -31,6 +144,10 @@ class Exporter(QtCore.QThread):
         format - формат экспорта. Варианты: "yolo_seg", "yolo_box", "coco", "mm_seg"
                         0 - "YOLO Seg", 1 - "YOLO Box", 2 - 'COCO', 3 - 'MM Segmentation'
 
+        parallel - экспорт YOLO в пуле процессов из workers процессов (None - по числу ядер)
+        incremental - экспорт YOLO только измененных изображений. В export_dir хранится манифест с хэшами
+            изображений, разметки и настроек экспорта, файлы удаленных из экспорта изображений удаляются
+
         """
         super(Exporter, self).__init__()
 
@@ -57,11 +174,21 @@ class Exporter(QtCore.QThread):
 
         self.data = project_data
 
+        self.parallel = parallel or incremental
+        self.workers = workers
+        self.incremental = incremental
+
     def run(self):
         if self.format == 'yolo_seg':
-            self.exportToYOLO(type="seg")
+            if self.parallel:
+                self.exportToYOLOParallel(type="seg")
+            else:
+                self.exportToYOLO(type="seg")
         elif self.format == 'yolo_box':
-            self.exportToYOLO(type="box")
+            if self.parallel:
+                self.exportToYOLOParallel(type="box")
+            else:
+                self.exportToYOLO(type="box")
         elif self.format == 'mm_seg':
             self.exportMMSeg()
         else:
@@ -149,12 +276,7 @@ class Exporter(QtCore.QThread):
         Пишет одну запись в txt YOLO
         shape - [ [x1, y1], ... ] в абс координатах
         """
-        points = shape["points"]
-        line = f"{cls_num}"
-        for point in points:
-            line += f" {point[0] / im_shape[1]} {point[1] / im_shape[0]}"
-
-        f.write(f"{line}\n")
+        f.write(yolo_seg_line(shape["points"], im_shape, cls_num))
 
     def get_split_image_names(self):
         """
@@ -201,24 +323,7 @@ class Exporter(QtCore.QThread):
             return {"test": test_names}
 
     def write_yolo_box_line(self, shape, im_shape, f, cls_num):
-        points = shape["points"]
-        xs = []
-        ys = []
-        for point in points:
-            xs.append(point[0])
-            ys.append(point[1])
-        min_x = min(xs)
-        max_x = max(xs)
-        min_y = min(ys)
-        max_y = max(ys)
-        w = abs(max_x - min_x)
-        h = abs(max_y - min_y)
-
-        x_center = min_x + w / 2
-        y_center = min_y + h / 2
-
-        f.write(
-            f"{cls_num} {x_center / im_shape[1]} {y_center / im_shape[0]} {w / im_shape[1]} {h / im_shape[0]}\n")
+        f.write(yolo_box_line(shape["points"], im_shape, cls_num))
 
     def create_mmseg_readme(self, yaml_short_name, save_folder, label_names, dataset_name='Dataset', palette=None):
         label_names = {k: v + 1 for v, k in enumerate(label_names)}
@@ -305,6 +410,8 @@ class Exporter(QtCore.QThread):
 
         for split_folder, image_names in split_names.items():
 
+            image_names = set(image_names)
+
             for filename, image in self.data["images"].items():
 
                 if filename not in image_names:
@@ -435,6 +542,8 @@ class Exporter(QtCore.QThread):
 
         for split_folder, image_names in split_names.items():
 
+            image_names = set(image_names)
+
             for filename, image in self.data["images"].items():
 
                 if filename not in image_names:
@@ -502,6 +611,178 @@ class Exporter(QtCore.QThread):
                 im_num += 1
                 self.export_percent_conn.percent.emit(int(100 * im_num / (len(self.data['images']))))
 
+    def get_image_splits(self, split_names):
+        """
+        {filename: [split_folder, ...]} - в какие выборки входит изображение
+        """
+        image_splits = {}
+        for split_folder, image_names in split_names.items():
+            for filename in image_names:
+                image_splits.setdefault(filename, []).append(split_folder)
+        return image_splits
+
+    def exportToYOLOParallel(self, type):
+        """
+        То же, что exportToYOLO, но выборка изображения определяется по словарю,
+        а запись разметки, копирование, resize и размытие изображений выполняются в пуле процессов
+        """
+        export_dir = self.export_dir
+        export_map = self.export_map
+
+        if not os.path.isdir(export_dir):
+            return
+
+        self.clear_not_existing_images()
+        labels_names = self.get_labels()
+
+        if not export_map:
+            export_map = self.get_export_map(labels_names)
+
+        images_dir, labels_dir = self.create_images_labels_subdirs(export_dir)
+        is_blur = self.is_blurred_classes(export_map)
+
+        if is_blur:
+            blur_dir = self.create_blur_dir(export_dir)
+
+        export_label_names = {}
+        unique_values = []
+        for k, v in export_map.items():
+            if v != 'del' and v != 'blur' and v not in unique_values:
+                export_label_names[k] = v
+                unique_values.append(v)
+
+        use_test = True if self.variant_idx == 0 else False
+        create_yaml(f"{self.dataset_name}.yaml", export_dir, list(export_label_names.keys()),
+                    dataset_name=self.dataset_name, use_test=use_test)
+
+        image_splits = self.get_image_splits(self.get_split_image_names())
+        images_num = len(self.data['images'])
+        im_num = 0
+
+        if self.incremental:
+            old_manifest = load_export_manifest(export_dir)
+            image_splits = self.keep_previous_splits(image_splits, old_manifest)
+            manifest = {"settings": calc_hash([type, export_map, labels_names, self.new_image_size]),
+                        "split_settings": self.get_split_settings(), "images": {}}
+
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            futures = []
+            for filename, image in self.data["images"].items():
+
+                if filename not in image_splits:
+                    continue
+
+                if not len(image["shapes"]) and self.is_filter_null:  # чтобы не создавать пустых файлов
+                    continue
+
+                fullname = os.path.join(self.data["path_to_images"], filename)
+
+                txt_yolo_name = hf.convert_image_name_to_txt_name(filename)
+
+                shapes = []
+                for shape in image["shapes"]:
+                    cls_num = shape["cls_num"]  # Shape - в абсолютных координатах
+
+                    if cls_num == -1 or cls_num > len(labels_names) - 1:
+                        continue
+
+                    export_cls_num = export_map[labels_names[cls_num]]
+
+                    if export_cls_num == 'del':
+                        continue
+
+                    shapes.append((export_cls_num, shape["points"]))
+
+                splits = image_splits[filename]
+                txt_names = [os.path.join(labels_dir, split_folder, txt_yolo_name) for split_folder in splits]
+                image_save_paths = [os.path.join(images_dir, split_folder, filename) for split_folder in splits]
+                blur_txt_name = os.path.join(blur_dir, txt_yolo_name) if is_blur else None
+
+                if self.incremental:
+                    record = self.create_manifest_record(fullname, filename, shapes, splits, txt_names,
+                                                         image_save_paths, blur_txt_name, old_manifest)
+                    manifest["images"][filename] = record
+                    if self.is_export_actual(filename, record, old_manifest, manifest):
+                        im_num += 1
+                        continue
+
+                futures.append(pool.submit(export_yolo_image, fullname, txt_names, image_save_paths, shapes, type,
+                                           new_image_size=self.new_image_size, blur_txt_name=blur_txt_name))
+
+            if self.incremental:
+                print(f"Incremental export: {len(futures)} of {images_num} images changed")
+
+            for future in as_completed(futures):
+                future.result()
+                im_num += 1
+                self.export_percent_conn.percent.emit(int(100 * im_num / images_num))
+
+        if self.incremental:
+            self.remove_orphaned_files(old_manifest, manifest)
+            save_export_manifest(export_dir, manifest)
+
+        self.export_percent_conn.percent.emit(100)
+
+    def get_split_settings(self):
+        return [self.variant_idx, self.splits, self.sim]
+
+    def keep_previous_splits(self, image_splits, old_manifest):
+        """
+        При тех же настройках разбиения изображения из прошлого экспорта остаются в своих выборках,
+        иначе случайное разбиение перемещало бы их при каждом экспорте
+        """
+        if old_manifest["split_settings"] != self.get_split_settings():
+            return image_splits
+
+        kept_splits = {}
+        for filename, splits in image_splits.items():
+            old_record = old_manifest["images"].get(filename)
+            kept_splits[filename] = old_record["splits"] if old_record else splits
+        return kept_splits
+
+    def create_manifest_record(self, fullname, filename, shapes, splits, txt_names, image_save_paths, blur_txt_name,
+                               old_manifest):
+        stat = os.stat(fullname)
+        file_stat = [stat.st_size, stat.st_mtime_ns]
+
+        # хэш содержимого пересчитывается только если файл изменился
+        old_record = old_manifest["images"].get(filename)
+        if old_record and old_record["file_stat"] == file_stat:
+            image_hash = old_record["image_hash"]
+        else:
+            image_hash = calc_file_hash(fullname)
+
+        files = txt_names + image_save_paths
+        if blur_txt_name:
+            files.append(blur_txt_name)
+
+        return {"file_stat": file_stat, "image_hash": image_hash, "shapes_hash": calc_hash(shapes),
+                "splits": splits, "files": files}
+
+    def is_export_actual(self, filename, record, old_manifest, manifest):
+        if old_manifest["settings"] != manifest["settings"]:
+            return False
+
+        old_record = old_manifest["images"].get(filename)
+        if not old_record:
+            return False
+
+        for key in ["image_hash", "shapes_hash", "splits", "files"]:
+            if old_record[key] != record[key]:
+                return False
+
+        return all(os.path.exists(file_name) for file_name in record["files"])
+
+    def remove_orphaned_files(self, old_manifest, manifest):
+        actual_files = set()
+        for record in manifest["images"].values():
+            actual_files.update(record["files"])
+
+        for record in old_manifest["images"].values():
+            for file_name in record["files"]:
+                if file_name not in actual_files and os.path.exists(file_name):
+                    os.remove(file_name)
+
     def emit_percent(self, value):
         self.export_percent_conn.percent.emit(value)
 
@@ -527,6 +808,7 @@ class Exporter(QtCore.QThread):
         for split_folder, image_names in split_names.items():
 
             # split folder - one of [train, val, test]
+            image_names = set(image_names)
 
             export_json = {}
             export_json["info"] = {"year": datetime.date.today().year, "version": "1.0",
@@ -693,4 +975,5 @@ class Exporter(QtCore.QThread):
             else:
                 print(f"Checking files: image {filename} doesn't exist")
 
-        self.data['images'] = images
+        # self.data - словарь проекта (ProjectHandler.data), его не меняем: экспорт работает со своей копией
+        self.data = dict(self.data, images=images)
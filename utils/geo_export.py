@@ -0,0 +1,129 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from utils import coords_calc
+from utils import ml_config
+
+GEO_EXPORT_DRIVERS = {'shp': 'ESRI Shapefile', 'gpkg': 'GPKG', 'geojson': 'GeoJSON'}
+
+
+def get_geo_driver(out_path):
+    ext = coords_calc.get_ext(out_path).lower()
+    return GEO_EXPORT_DRIVERS.get(ext)
+
+
+def shapes_to_geo_frame(shapes, geo_ref, cls_names=None, image_name=None, crs='epsg:4326'):
+    """
+    Полигоны одного изображения -> GeoDataFrame с полями class, conf (и image, если задано image_name)
+    Все вершины переводятся в гео-координаты одним вызовом, геометрии создаются одним вызовом Shapely
+    Полигоны меньше чем из трех точек пропускаются
+    """
+    if cls_names is None:
+        cls_names = ml_config.CLASSES_ENG
+
+    shapes = [shape for shape in shapes if len(shape['points']) >= 3]
+
+    columns = {'class': [cls_names[shape['cls_num']] for shape in shapes],
+               'conf': np.array([float(shape.get('conf', 1.0)) for shape in shapes], dtype=np.float64)}
+    if image_name is not None:
+        columns['image'] = [image_name] * len(shapes)
+
+    if not shapes:
+        return gpd.GeoDataFrame(columns, geometry=[], crs=crs)
+
+    lengths = np.array([len(shape['points']) for shape in shapes])
+    points = np.concatenate([np.asarray(shape['points'], dtype=np.float64).reshape(-1, 2) for shape in shapes])
+
+    geo_points = geo_ref.pixels_to_geo(points)
+    rings = shapely.linearrings(geo_points, indices=np.repeat(np.arange(len(shapes)), lengths))
+    polygons = shapely.polygons(rings)
+
+    return gpd.GeoDataFrame(columns, geometry=polygons, crs=crs)
+
+
+def iterate_geo_frames(images, path_to_images, cls_names=None, chunk_size=50000, per_image=False,
+                       crs='epsg:4326', override_shapes=None):
+    """
+    Генератор (имя изображения или None, GeoDataFrame) по всем изображениям проекта с геопривязкой
+    images - словарь images проекта {image_name: {'shapes': [...]}, ...}
+    per_image=False - объекты нескольких изображений собираются в куски примерно по chunk_size объектов
+    per_image=True - отдельный GeoDataFrame на каждое изображение
+    override_shapes - {image_name: shapes}, разметка, которая используется вместо разметки из images
+    """
+    if override_shapes is None:
+        override_shapes = {}
+
+    items = images.plain_items() if hasattr(images, 'plain_items') else images.items()
+
+    frames = []
+    objects_num = 0
+    for image_name, image_data in items:
+        shapes = override_shapes.get(image_name, image_data.get('shapes', []))
+        if not shapes:
+            continue
+
+        image_path = os.path.join(path_to_images, image_name)
+        if not os.path.exists(image_path):
+            continue
+
+        geo_ref = coords_calc.get_geo_reference(image_path)
+        if not geo_ref.is_georeferenced:
+            continue
+
+        frame = shapes_to_geo_frame(shapes, geo_ref, cls_names=cls_names, image_name=image_name, crs=crs)
+        if per_image:
+            yield image_name, frame
+            continue
+
+        frames.append(frame)
+        objects_num += len(frame)
+        if objects_num >= chunk_size:
+            yield None, pd.concat(frames, ignore_index=True)
+            frames = []
+            objects_num = 0
+
+    if frames:
+        yield None, pd.concat(frames, ignore_index=True)
+
+
+def export_to_geo(images, path_to_images, out_path, cls_names=None, per_image=False, chunk_size=50000,
+                  crs='epsg:4326', override_shapes=None):
+    """
+    Экспорт разметки всех изображений с геопривязкой в ESRI Shapefile (.shp), GeoPackage (.gpkg) или GeoJSON
+    per_image=False - один слой, куски по chunk_size объектов дописываются в файл
+    per_image=True - для GeoPackage слой на каждое изображение, для остальных форматов - файл на изображение
+    GeoJSON не поддерживает дозапись, поэтому для одного слоя собирается целиком в памяти
+    Возвращает число экспортированных объектов
+    """
+    driver = get_geo_driver(out_path)
+    if not driver:
+        raise ValueError(f"Unsupported geo export format {out_path}. Use one of {list(GEO_EXPORT_DRIVERS)}")
+
+    if driver == 'GeoJSON' and not per_image:
+        chunk_size = np.inf
+
+    base_name, ext = os.path.splitext(out_path)
+    objects_num = 0
+    is_first = True
+    for image_name, frame in iterate_geo_frames(images, path_to_images, cls_names=cls_names, chunk_size=chunk_size,
+                                                per_image=per_image, crs=crs,
+                                                override_shapes=override_shapes):
+        if len(frame) == 0:
+            # пустой слой не записываем, чтобы не создавать файл без объектов
+            continue
+
+        if per_image and driver == 'GPKG':
+            frame.to_file(out_path, driver=driver, layer=os.path.splitext(image_name)[0])
+        elif per_image:
+            frame.to_file(f"{base_name}_{os.path.splitext(image_name)[0]}{ext}", driver=driver)
+        else:
+            frame.to_file(out_path, driver=driver, mode='w' if is_first else 'a')
+
+        is_first = False
+        objects_num += len(frame)
+
+    return objects_num
@@ -12,12 +12,16 @@ import yaml
 from PIL import Image
 from PyQt5 import QtCore
 from PyQt5.QtGui import QPolygonF
-from shapely import Polygon, unary_union
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+import shapely
+from shapely import Polygon, STRtree, unary_union
 from skimage.morphology import binary_opening, binary_closing, remove_small_objects, square, label
 
 from utils import ml_config
 from utils import config
 from utils import coords_calc
+from utils.geo_export import shapes_to_geo_frame
 from rasterio import features
 
 
@@ -107,21 +111,7 @@ def is_polygon_self_intersected(pol):
 
 
 def try_read_lrm(image_name, from_crs='epsg:3395', to_crs='epsg:4326'):
-    ext = coords_calc.get_ext(image_name)
-    name_without_ext = image_name[:-len(ext)]
-    for map_ext in ['dat', 'map']:
-        map_name = name_without_ext + map_ext
-        if os.path.exists(map_name):
-            coords_net = coords_calc.load_coords(map_name)
-            Image.MAX_IMAGE_PIXELS = None
-            img = Image.open(image_name)
-
-            img_width, img_height = img.size
-
-            return coords_calc.get_lrm(coords_net, img_height)
-
-    if ext == 'tif' or ext == 'tiff':
-        return coords_calc.lrm_from_pil_data(image_name, from_crs=from_crs, to_crs=to_crs)
+    return coords_calc.get_geo_reference(image_name, from_crs=from_crs, to_crs=to_crs).lrm
 
 
 def clear_temp_folder(cwd=None):
@@ -230,17 +220,21 @@ def calc_width_proportions(percent):
 
 
 def convert_point_coords_to_geo(point_x, point_y, image_name, from_crs='epsg:3395', to_crs='epsg:4326'):
-    img = Image.open(image_name)
+    geo_ref = coords_calc.get_geo_reference(image_name, from_crs=from_crs, to_crs=to_crs)
+    if not geo_ref.is_georeferenced:
+        return 0, 0
 
-    img_width, img_height = img.size
+    x, y = geo_ref.pixels_to_geo([[point_x, point_y]])[0]
 
-    geo_extent = coords_calc.get_geo_extent(image_name, from_crs=from_crs, to_crs=to_crs)
+    return float(x), float(y)
 
-    lat_min, lat_max, lon_min, lon_max = geo_extent
-    x = lon_min + (float(point_x) / img_width) * abs(lon_max - lon_min)
-    y = lat_min + (1.0 - float(point_y) / img_height) * abs(lat_max - lat_min)
 
-    return x, y
+def read_image_size(image_path):
+    """
+    Размер изображения (width, height) по заголовку файла, без декодирования пикселей
+    """
+    with Image.open(image_path) as img:
+        return img.size
 
 
 def is_dicts_equals(dict1, dict2):
@@ -248,38 +242,12 @@ def is_dicts_equals(dict1, dict2):
 
 
 def convert_shapes_to_esri(shapes, image_name, crs='epsg:4326', out_shapefile='esri_shapefile.shp'):
-    img = Image.open(image_name)
+    geo_ref = coords_calc.get_geo_reference(image_name)
 
-    img_width, img_height = img.size
-
-    geo_extent = coords_calc.get_geo_extent(image_name)
-
-    if not geo_extent:
+    if not geo_ref.is_georeferenced:
         return
 
-    lat_min, lat_max, lon_min, lon_max = geo_extent
-
-    gdf = gpd.GeoDataFrame()
-    gdf["geometry"] = None
-    cls_names = ml_config.CLASSES_ENG
-    for i, shape in enumerate(shapes):
-        geo_polygon = []
-        polygon = shape["points"]
-        for point in polygon:
-            x = lon_min + (float(point[0]) / img_width) * abs(lon_max - lon_min)
-            y = lat_min + (1.0 - float(point[1]) / img_height) * abs(lat_max - lat_min)
-            geo_polygon.append((x, y))
-
-        pol = Polygon(geo_polygon)
-
-        gdf.loc[i, 'geometry'] = pol
-        gdf.loc[i, 'class'] = cls_names[shape['cls_num']]
-        if 'conf' in shape:
-            gdf.loc[i, 'conf'] = float(shape['conf'])
-        else:
-            gdf.loc[i, 'conf'] = 1.0
-
-    gdf.crs = crs
+    gdf = shapes_to_geo_frame(shapes, geo_ref, crs=crs)
     gdf.to_file(out_shapefile)
 
 
@@ -474,6 +442,148 @@ def calc_distance_to_nearest_edge(polygon, point):
     return d_min
 
 
+def polygon_to_array(polygon):
+    """
+    QPolygonF -> np.ndarray (N, 2) float64
+    Точки читаются одним куском из памяти полигона, без перебора в Python
+    """
+    size = len(polygon)
+    if size == 0:
+        return np.zeros((0, 2), dtype=np.float64)
+
+    ptr = polygon.data()
+    ptr.setsize(size * 2 * np.dtype(np.float64).itemsize)
+    return np.frombuffer(ptr, dtype=np.float64).reshape(size, 2).copy()
+
+
+def array_to_polygon(points):
+    """
+    np.ndarray (N, 2) -> QPolygonF
+    Точки записываются одним куском в память полигона, без добавления по одной
+    """
+    points = np.ascontiguousarray(points, dtype=np.float64).reshape(-1, 2)
+    size = len(points)
+    polygon = QPolygonF()
+    if size == 0:
+        return polygon
+
+    polygon.fill(QtCore.QPointF(), size)
+    ptr = polygon.data()
+    ptr.setsize(size * 2 * np.dtype(np.float64).itemsize)
+    np.frombuffer(ptr, dtype=np.float64)[:] = points.ravel()
+    return polygon
+
+
+def clip_point_masses(point_masses, width, height):
+    """
+    Обрезка полигонов (список np.ndarray (N, 2)) рабочей областью 0..width, 0..height
+    Выход за границы проверяется сразу для всех вершин, пересечение считается одним вызовом Shapely
+    только для выходящих за границы полигонов. Как и в GraphicsView.crop_by_pixmap_size,
+    от MultiPolygon остается первая часть, а контур замкнут повторением первой точки
+    Возвращает новый список
+    """
+    if not point_masses:
+        return []
+
+    lengths = np.array([len(points) for points in point_masses])
+    all_points = np.concatenate(point_masses)
+    is_out = (all_points[:, 0] < 0) | (all_points[:, 0] > width) | (all_points[:, 1] < 0) | (
+            all_points[:, 1] > height)
+    starts = np.r_[0, np.cumsum(lengths)[:-1]]
+    out_idx = np.flatnonzero(np.logical_or.reduceat(is_out, starts))
+
+    result = list(point_masses)
+    if len(out_idx) == 0:
+        return result
+
+    out_points = [point_masses[i] for i in out_idx]
+    rings = shapely.linearrings(np.concatenate(out_points),
+                                indices=np.repeat(np.arange(len(out_idx)), lengths[out_idx]))
+    polygons = shapely.polygons(rings)
+    pixmap_box = make_shapely_box(width, height)
+    try:
+        cropped = shapely.intersection(pixmap_box, polygons)
+    except shapely.errors.GEOSException:
+        # при некорректных полигонах обрезаются по одному, необрезаемые остаются как есть
+        cropped = []
+        for pol in polygons:
+            try:
+                cropped.append(pixmap_box.intersection(pol))
+            except shapely.errors.GEOSException:
+                cropped.append(None)
+
+    for i, cropped_polygon in zip(out_idx, cropped):
+        if cropped_polygon is None:
+            continue
+        if cropped_polygon.geom_type == 'MultiPolygon':
+            cropped_polygon = cropped_polygon.geoms[0]
+        if cropped_polygon.geom_type == 'Polygon':
+            result[i] = np.array(cropped_polygon.exterior.coords, dtype=np.float64).reshape(-1, 2)
+
+    return result
+
+
+def calc_distances_to_edges(points, x, y):
+    """
+    Расстояния от точки (x, y) до всех ребер замкнутого полигона points (N, 2) сразу
+    Ребра нулевой длины пропускаются, как в calc_distance_to_nearest_edge
+    """
+    p1 = points
+    p2 = np.roll(points, -1, axis=0)
+    seg = p2 - p1
+    len_sq = (seg * seg).sum(axis=1)
+    is_edge = len_sq != 0
+    p1, seg, len_sq = p1[is_edge], seg[is_edge], len_sq[is_edge]
+
+    param = ((x - p1[:, 0]) * seg[:, 0] + (y - p1[:, 1]) * seg[:, 1]) / len_sq
+    param = np.clip(param, 0, 1)
+    dx = x - (p1[:, 0] + param * seg[:, 0])
+    dy = y - (p1[:, 1] + param * seg[:, 1])
+
+    return np.sqrt(dx * dx + dy * dy)
+
+
+def calc_distance_to_nearest_edge_np(points, x, y):
+    """
+    То же, что calc_distance_to_nearest_edge, для полигона в виде np.ndarray (N, 2)
+    """
+    distances = calc_distances_to_edges(points, x, y)
+    if len(distances) == 0:
+        return 1e12
+    return distances.min()
+
+
+def find_nearest_vertex(points, x, y, max_dist):
+    """
+    Индекс ближайшей к (x, y) вершины полигона points (N, 2) на расстоянии меньше max_dist или None
+    """
+    if len(points) == 0:
+        return None
+
+    distances = np.hypot(points[:, 0] - x, points[:, 1] - y)
+    idx = int(distances.argmin())
+    if distances[idx] < max_dist:
+        return idx
+    return None
+
+
+def is_point_in_polygon(points, x, y):
+    """
+    Попадание точки (x, y) в полигон points (N, 2) по правилу четности пересечений (как Qt.OddEvenFill)
+    """
+    if len(points) < 3:
+        return False
+
+    xs, ys = points[:, 0], points[:, 1]
+    xs_next, ys_next = np.roll(xs, -1), np.roll(ys, -1)
+
+    crosses = (ys > y) != (ys_next > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = xs + (y - ys) * (xs_next - xs) / (ys_next - ys)
+
+    return bool(np.count_nonzero(crosses & (x < x_cross)) % 2)
+
+
 def density_slider_to_value(value, min_value=config.MIN_DENSITY_VALUE, max_value=config.MAX_DENSITY_VALUE):
     b = 0.01 * math.log(max_value / min_value)
     return min_value * math.exp(b * value)
@@ -617,12 +727,17 @@ def convert_text_name_to_image_name(text_name):
     return img_name + ".txt"
 
 
-def filter_masks(masks_results, conf_thres=0.2, iou_filter=0.3):
+def filter_masks(masks_results, conf_thres=0.2, iou_filter=0.3, method='indexed'):
     """
     Фильтрация боксов
     conf_tresh - убираем все боксы с вероятностями ниже заданной
     iou_filter - убираем дубликаты боксов, дубликатами считаются те, значение IoU которых выше этого порога
+    method - 'indexed' - через пространственный индекс (filter_masks_indexed),
+             'pairwise' - попарное сравнение всех масок
     """
+    if method == 'indexed':
+        return filter_masks_indexed(masks_results, conf_thres=conf_thres, iou_filter=iou_filter)
+
     unique_results = []
     skip_nums = []
     for i in range(len(masks_results)):
@@ -670,6 +785,81 @@ def filter_masks(masks_results, conf_thres=0.2, iou_filter=0.3):
     return unique_results
 
 
+def filter_masks_indexed(masks_results, conf_thres=0.2, iou_filter=0.3):
+    """
+    Аналог попарной filter_masks с тем же результатом
+    Полигоны строятся один раз, кандидаты в дубликаты ищутся по STRtree своего класса,
+    IoU с кандидатами считается сразу для всех векторными операциями Shapely
+    """
+    size = len(masks_results)
+    if size == 0:
+        return []
+
+    polygons = np.array([Polygon(res['points']) for res in masks_results], dtype=object)
+    areas = shapely.area(polygons)
+    cls_nums = np.array([res['cls_num'] for res in masks_results])
+
+    cls_trees = {}
+    for cls_num in np.unique(cls_nums):
+        cls_idx = np.nonzero(cls_nums == cls_num)[0]
+        cls_trees[cls_num] = (STRtree(polygons[cls_idx]), cls_idx)
+
+    skipped = np.zeros(size, dtype=bool)
+
+    def query_candidates(pol_num, after_num):
+        # маски того же класса после after_num, у которых пересекаются рамки с pol_num
+        tree, cls_idx = cls_trees[cls_nums[pol_num]]
+        candidates = np.sort(cls_idx[tree.query(polygons[pol_num])])
+        candidates = candidates[candidates > after_num]
+        return candidates[~skipped[candidates]]
+
+    unique_results = []
+    for i in range(size):
+        if float(masks_results[i]['conf']) < conf_thres:
+            continue
+
+        if skipped[i]:
+            continue
+
+        biggest = i
+        candidates = query_candidates(i, i)
+
+        while len(candidates):
+            inter = shapely.area(shapely.intersection(polygons[biggest], polygons[candidates]))
+            union = areas[biggest] + areas[candidates] - inter
+            iou = np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+            is_changed = False
+            for j in candidates[iou > iou_filter]:
+                skipped[j] = True
+                if areas[biggest] < areas[j]:
+                    # дальше сравниваем с новой наибольшей маской
+                    biggest = j
+                    is_changed = True
+                    break
+
+            if not is_changed:
+                break
+
+            candidates = query_candidates(biggest, biggest)
+
+        unique_results.append(masks_results[biggest])
+
+    return unique_results
+
+
+def group_pairs(size, left, right):
+    """
+    Разбиение size объектов на связные группы по парам (left[k], right[k])
+    Возвращает np.ndarray номеров групп для каждого объекта
+    """
+    left = np.asarray(left, dtype=np.int64)
+    right = np.asarray(right, dtype=np.int64)
+    graph = coo_matrix((np.ones(len(left), dtype=np.int8), (left, right)), shape=(size, size))
+    groups_num, groups = connected_components(graph, directed=False)
+    return groups
+
+
 def calc_area_by_points(points, lrm):
     pol = Polygon(points)
 
@@ -1,5 +1,6 @@
 from PySide2 import QtCore
 from ui.signals_and_slots import LoadIdProgress
+from utils.packed_project import PackedImages
 
 
 class IdsSetterWorker(QtCore.QThread):
@@ -15,6 +16,11 @@ class IdsSetterWorker(QtCore.QThread):
         self.load_ids_conn.percent.emit(0)
         i = 0
         self.labels_size = 0
+        if isinstance(self.images_data, PackedImages):
+            self.labels_size = self.images_data.get_shapes_num()
+            self.load_ids_conn.percent.emit(100)
+            return
+
         for im_name, im in self.images_data.items():
             self.labels_size += len(im['shapes'])
             i += 1
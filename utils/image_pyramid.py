@@ -0,0 +1,275 @@
+import hashlib
+import os
+import shutil
+
+import cv2
+import numpy as np
+
+TILE_SIZE = 512
+# Изображения, у которых большая сторона больше, отображаются тайлами из пирамиды
+TILED_MIN_SIDE = 8192
+
+
+def get_pyramid_key(image_path):
+    """
+    Ключ пирамиды изображения: путь, время изменения и размер файла
+    """
+    stat = os.stat(image_path)
+    key_str = f"{os.path.abspath(image_path)}_{stat.st_mtime_ns}_{stat.st_size}"
+    return hashlib.md5(key_str.encode('utf8')).hexdigest()
+
+
+def build_levels(image, tile_size=TILE_SIZE):
+    """
+    Уровни пирамиды: исходное изображение и уменьшенные вдвое копии,
+    пока большая сторона не станет не больше tile_size
+    """
+    levels = [image]
+    while max(levels[-1].shape[:2]) > tile_size:
+        height, width = levels[-1].shape[:2]
+        size = (max(1, (width + 1) // 2), max(1, (height + 1) // 2))
+        levels.append(cv2.resize(levels[-1], size, interpolation=cv2.INTER_AREA))
+    return levels
+
+
+class ImagePyramid:
+    """
+    Многомасштабное представление изображения (np.ndarray в формате cv2) с доступом по тайлам
+    Уровень 0 - исходное изображение, каждый следующий уровень меньше вдвое
+    Координаты тайлов возвращаются в пикселях уровня 0
+    """
+
+    def __init__(self, levels, tile_size=TILE_SIZE):
+        self.levels = levels
+        self.tile_size = tile_size
+        self.height, self.width = levels[0].shape[:2]
+
+    @property
+    def image(self):
+        return self.levels[0]
+
+    def get_level_scale(self, level):
+        """
+        Сколько пикселей уровня 0 в одном пикселе уровня level (по x и по y)
+        """
+        height, width = self.levels[level].shape[:2]
+        return self.width / width, self.height / height
+
+    def choose_level(self, view_scale):
+        """
+        Самый грубый уровень, в котором на пиксель экрана приходится не меньше одного пикселя уровня
+        view_scale - масштаб отображения (пикселей экрана на пиксель уровня 0)
+        """
+        level = 0
+        while level + 1 < len(self.levels) and max(self.get_level_scale(level + 1)) * view_scale <= 1:
+            level += 1
+        return level
+
+    def get_visible_tiles(self, level, x_min, y_min, x_max, y_max):
+        """
+        Номера (row, col) тайлов уровня level, пересекающих прямоугольник в координатах уровня 0
+        """
+        height, width = self.levels[level].shape[:2]
+        scale_x, scale_y = self.get_level_scale(level)
+
+        col_min = max(0, int(x_min / scale_x) // self.tile_size)
+        row_min = max(0, int(y_min / scale_y) // self.tile_size)
+        col_max = min((width - 1) // self.tile_size, int(x_max / scale_x) // self.tile_size)
+        row_max = min((height - 1) // self.tile_size, int(y_max / scale_y) // self.tile_size)
+
+        return [(row, col) for row in range(row_min, row_max + 1) for col in range(col_min, col_max + 1)]
+
+    def get_tile_bounds(self, level, row, col):
+        """
+        Границы тайла в пикселях уровня level (x0, y0, x1, y1)
+        Тайл захватывает один лишний пиксель справа и снизу, чтобы между тайлами не было щелей при масштабировании
+        """
+        height, width = self.levels[level].shape[:2]
+        x0 = col * self.tile_size
+        y0 = row * self.tile_size
+        x1 = min(width, x0 + self.tile_size + 1)
+        y1 = min(height, y0 + self.tile_size + 1)
+        return x0, y0, x1, y1
+
+    def get_tile(self, level, row, col):
+        x0, y0, x1, y1 = self.get_tile_bounds(level, row, col)
+        return np.ascontiguousarray(self.levels[level][y0:y1, x0:x1])
+
+    def get_tile_rect(self, level, row, col):
+        """
+        Прямоугольник тайла (x, y, w, h) в координатах уровня 0
+        """
+        x0, y0, x1, y1 = self.get_tile_bounds(level, row, col)
+        scale_x, scale_y = self.get_level_scale(level)
+        return x0 * scale_x, y0 * scale_y, (x1 - x0) * scale_x, (y1 - y0) * scale_y
+
+    def get_preview(self, max_side):
+        """
+        Наиболее детальный уровень, у которого большая сторона не больше max_side
+        """
+        for level in self.levels:
+            if max(level.shape[:2]) <= max_side:
+                return level
+        return self.levels[-1]
+
+
+class PyramidDiskCache:
+    """
+    Кэш пирамид на диске: папка на изображение, уровни в файлах .npy
+    При чтении уровни открываются через np.load(mmap_mode=...), в память загружаются только нужные тайлы
+    При превышении max_mb удаляются давно не использованные пирамиды
+    """
+
+    def __init__(self, cache_dir, max_mb=8192):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        if self.cache_dir and self.max_bytes > 0:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        else:
+            self.cache_dir = None
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key):
+        """
+        Уровни пирамиды или None
+        Уровень 0 открывается в режиме copy-on-write: изменения массива не попадают в кэш
+        """
+        if not self.cache_dir:
+            return None
+
+        path = self.get_path(key)
+        if not os.path.isdir(path):
+            return None
+
+        levels = []
+        level = 0
+        try:
+            while os.path.exists(os.path.join(path, f"{level}.npy")):
+                levels.append(np.load(os.path.join(path, f"{level}.npy"), mmap_mode='c' if level == 0 else 'r'))
+                level += 1
+        except (OSError, ValueError) as e:
+            print(f"Can't read image pyramid {path}: {e}")
+            return None
+
+        if not levels:
+            return None
+
+        # время доступа для вытеснения давно не использованных
+        os.utime(path)
+        return levels
+
+    def save(self, key, levels):
+        if not self.cache_dir:
+            return
+
+        path = self.get_path(key)
+        tmp_path = path + '.tmp'
+        try:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            os.makedirs(tmp_path)
+            for level, array in enumerate(levels):
+                np.save(os.path.join(tmp_path, f"{level}.npy"), array)
+            shutil.rmtree(path, ignore_errors=True)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Can't save image pyramid {path}: {e}")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+
+        self.evict()
+
+    def evict(self):
+        """
+        Удаление давно не использованных пирамид, пока кэш больше max_mb
+        """
+        dirs = []
+        total_size = 0
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.tmp') or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                dirs.append((os.stat(path).st_mtime, size, path))
+            except OSError:
+                continue
+            total_size += size
+
+        dirs.sort()
+        # последняя (только что сохраненная) пирамида не удаляется
+        for mtime, size, path in dirs[:-1]:
+            if total_size <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
+
+
+def make_preview_pyramid(image, preview_side=2048, tile_size=TILE_SIZE):
+    """
+    Временная пирамида из двух уровней: исходное изображение и грубая копия (ближайший сосед, без усреднения)
+    Строится за доли секунды, пока полная пирамида строится в фоне
+    """
+    height, width = image.shape[:2]
+    scale = preview_side / max(height, width)
+    size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    preview = cv2.resize(image, size, interpolation=cv2.INTER_NEAREST)
+    return ImagePyramid([image, preview], tile_size=tile_size)
+
+
+def build_cached_pyramid(image_path, image, cache=None, tile_size=TILE_SIZE):
+    """
+    Построение полной пирамиды и сохранение в cache
+    Если пирамида сохранена, уровни открываются из кэша через mmap и исходный массив в памяти больше не нужен
+    """
+    levels = build_levels(image, tile_size=tile_size)
+    if cache is not None and cache.cache_dir:
+        key = get_pyramid_key(image_path)
+        cache.save(key, levels)
+        cached_levels = cache.load(key)
+        if cached_levels is not None:
+            levels = cached_levels
+
+    return ImagePyramid(levels, tile_size=tile_size)
+
+
+def open_image_pyramid(image_path, cache=None, min_side=TILED_MIN_SIDE, tile_size=TILE_SIZE):
+    """
+    Декодирование изображения без построения полной пирамиды
+    Возвращает (image, pyramid, is_complete):
+        image - np.ndarray в формате cv2 или None, если cv2 не может прочитать файл
+        pyramid - ImagePyramid для изображений с большей стороной больше min_side, иначе None
+        is_complete - False, если pyramid временная (make_preview_pyramid) и полную нужно построить
+        build_cached_pyramid
+    При повторном открытии изображение и пирамида читаются из кэша без декодирования
+    """
+    if cache is not None and cache.cache_dir:
+        levels = cache.load(get_pyramid_key(image_path))
+        if levels is not None:
+            return levels[0], ImagePyramid(levels, tile_size=tile_size), True
+
+    image = cv2.imread(image_path)
+    if image is None or max(image.shape[:2]) <= min_side:
+        return image, None, True
+
+    return image, make_preview_pyramid(image, tile_size=tile_size), False
+
+
+def load_image_pyramid(image_path, cache=None, min_side=TILED_MIN_SIDE, tile_size=TILE_SIZE):
+    """
+    Одно декодирование изображения и для отображения, и для обработки (cv2_image)
+    Возвращает (image, pyramid):
+        image - np.ndarray в формате cv2 или None, если cv2 не может прочитать файл
+        pyramid - ImagePyramid для изображений с большей стороной больше min_side, иначе None
+    Пирамида строится один раз и сохраняется в cache (PyramidDiskCache), при повторном открытии
+    изображение и пирамида читаются из кэша без декодирования
+    Построение идет в вызывающем потоке, для GUI - open_image_pyramid и PyramidBuilder
+    """
+    image, pyramid, is_complete = open_image_pyramid(image_path, cache=cache, min_side=min_side,
+                                                     tile_size=tile_size)
+    if not is_complete:
+        pyramid = build_cached_pyramid(image_path, image, cache=cache, tile_size=tile_size)
+        image = pyramid.image
+
+    return image, pyramid
@@ -1,21 +1,70 @@
 import os
 import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 import cv2
 import numpy as np
+import ujson
 from PIL import Image
 from PySide2 import QtCore
 
+try:
+    import ijson  # потоковый разбор больших COCO файлов
+except ImportError:
+    ijson = None
+
 from ui.signals_and_slots import LoadPercentConnection, ErrorConnection, InfoConnection
 from utils import help_functions as hf
-from utils.sam_predictor import mask_to_seg, predict_by_box
+from utils.sam_predictor import masks_to_polygons, predict_batch
+
+
+def parse_yolo_label_file(image_path, label_path, is_seg):
+    """
+    Разбор txt-файла разметки YOLO для одного изображения. Выполняется в пуле процессов
+    Размер изображения читается из заголовка файла
+    Возвращает список {'cls_num', 'points'} в абсолютных координатах или None, если файла разметки нет
+    """
+    if not os.path.exists(label_path):
+        return None
+
+    width, height = hf.read_image_size(image_path)
+    scale = np.array([width, height], dtype=np.float64)
+
+    with open(label_path, 'r') as f:
+        lines = [line.split() for line in f if line.strip()]
+
+    shapes = []
+    if is_seg:
+        for cls_data in lines:
+            coords = np.array(cls_data[1:], dtype=np.float64).reshape(-1, 2)
+            # astype отбрасывает дробную часть, как int()
+            points = (coords * scale).astype(np.int64).tolist()
+            shapes.append({"cls_num": int(cls_data[0]), "points": points})
+
+    elif lines:
+        boxes = np.array([cls_data[:5] for cls_data in lines], dtype=np.float64)
+        xs = (boxes[:, 1] * width).astype(np.int64)
+        ys = (boxes[:, 2] * height).astype(np.int64)
+        ws = (boxes[:, 3] * width).astype(np.int64)
+        hs = (boxes[:, 4] * height).astype(np.int64)
+
+        x_min = (xs - ws / 2).tolist()
+        x_max = (xs + ws / 2).tolist()
+        y_min = (ys - hs / 2).tolist()
+        y_max = (ys + hs / 2).tolist()
+
+        for k, cls_data in enumerate(lines):
+            points = [[x_min[k], y_min[k]], [x_max[k], y_min[k]], [x_max[k], y_max[k]], [x_min[k], y_max[k]]]
+            shapes.append({"cls_num": int(cls_data[0]), "points": points})
+
+    return shapes
 
 
 class Importer(QtCore.QThread):
 
     def __init__(self, coco_data=None, alpha=120, yaml_data=None, is_seg=False, copy_images_path=None,
                  is_coco=True, dataset="train", coco_name=None, convert_to_masks=False,
-                 sam_predictor=None):
+                 sam_predictor=None, copy_workers=8, parse_workers=None):
         super(Importer, self).__init__()
 
         # SIGNALS
@@ -34,6 +83,8 @@ class Importer(QtCore.QThread):
         self.coco_name = coco_name
         self.convert_to_masks = convert_to_masks
         self.sam_predictor = sam_predictor
+        self.copy_workers = copy_workers
+        self.parse_workers = parse_workers
 
     def get_project(self):
         return self.project
@@ -74,65 +125,112 @@ class Importer(QtCore.QThread):
 
         return data_annotations_new
 
-    def import_from_coco(self):
+    def read_coco_items(self, key):
+        """
+        Потоковое чтение массива key ('images', 'annotations', ...) из файла coco_name
+        """
+        with open(self.coco_name, 'rb') as f:
+            for item in ijson.items(f, f'{key}.item', use_float=True):
+                yield item
+
+    def get_coco_parts(self):
+        """
+        Возвращает (categories, images, annotations)
+        Если coco_data не задан, файл coco_name читается потоково (при наличии ijson),
+        annotations в этом случае - генератор
+        """
+        if self.coco_data is None:
+            if ijson:
+                return list(self.read_coco_items('categories')), list(self.read_coco_items('images')), \
+                    self.read_coco_items('annotations')
+
+            with open(self.coco_name, 'r') as f:
+                self.coco_data = ujson.load(f)
 
-        self.info_conn.info_message.emit(f"Start import data from {self.coco_name}")
         data = self.coco_data
-        alpha = self.alpha
+        return data["categories"], data["images"], data["annotations"]
 
-        label_names = [d["name"] for d in data["categories"]]
+    def group_coco_annotations(self, annotations, cls_size):
+        """
+        Группировка аннотаций по image_id за один проход
+        Аннотации с category_id >= cls_size отбрасываются, как в filter_data_annotations_by_cls_size
+        Возвращает {image_id: [(cls_num, segmentation), ...]}
+        """
+        annotations_by_image = {}
+        for seg in annotations:
+            if seg["category_id"] >= cls_size:
+                self.info_conn.info_message.emit(f'Filtered seg with category_id {seg["category_id"]}')
+                continue
 
-        data["annotations"] = self.filter_data_annotations_by_cls_size(data["annotations"], len(label_names))
+            annotations_by_image.setdefault(seg["image_id"], []).append(
+                (seg["category_id"] - 1, seg["segmentation"][0]))
 
-        label_colors = hf.get_label_colors(label_names, alpha=alpha)
+        return annotations_by_image
 
-        if self.copy_images_path:
-            # change paths
-            images = {}
-
-            for i, im in enumerate(data["images"]):
-                im_copy = im
-                # make sense copy from real folder, not from flickr_url
-                save_images_folder = self.copy_images_path
-                if os.path.exists(im['flickr_url']):
-                    shutil.copy(im['flickr_url'], os.path.join(save_images_folder, im["file_name"]))
-
-                elif os.path.exists(os.path.join(os.path.dirname(self.coco_name), im["file_name"])):
-                    shutil.copy(os.path.join(os.path.dirname(self.coco_name), im["file_name"]),
-                                os.path.join(save_images_folder, im["file_name"]))
-                else:
-                    continue
+    def copy_coco_image(self, im):
+        # make sense copy from real folder, not from flickr_url
+        save_path = os.path.join(self.copy_images_path, im["file_name"])
+        if os.path.exists(im['flickr_url']):
+            shutil.copy(im['flickr_url'], save_path)
+
+        elif os.path.exists(os.path.join(os.path.dirname(self.coco_name), im["file_name"])):
+            shutil.copy(os.path.join(os.path.dirname(self.coco_name), im["file_name"]), save_path)
+        else:
+            return None
+
+        im['flickr_url'] = save_path
+        im['coco_url'] = save_path
+        return im
+
+    def copy_coco_images(self, images):
+        """
+        Копирование изображений в copy_images_path в пуле потоков
+        Возвращает изображения, которые удалось скопировать, в исходном порядке
+        """
+        copied = [None] * len(images)
+        with ThreadPoolExecutor(max_workers=self.copy_workers) as pool:
+            futures = {pool.submit(self.copy_coco_image, im): i for i, im in enumerate(images)}
+            for done_num, future in enumerate(as_completed(futures)):
+                copied[futures[future]] = future.result()
+                self.load_percent_conn.percent.emit(int(done_num * 100.0 / len(images)))
+
+        return [im for im in copied if im]
+
+    def import_from_coco(self):
+
+        self.info_conn.info_message.emit(f"Start import data from {self.coco_name}")
+        alpha = self.alpha
 
-                im_copy['flickr_url'] = os.path.join(save_images_folder, im["file_name"])
-                im_copy['coco_url'] = os.path.join(save_images_folder, im["file_name"])
-                images[im["file_name"]] = im_copy
+        categories, images, annotations = self.get_coco_parts()
 
-                self.load_percent_conn.percent.emit(int(i * 100.0 / len(data["images"])))
+        label_names = [d["name"] for d in categories]
 
-            data["images"] = images
+        annotations_by_image = self.group_coco_annotations(annotations, len(label_names))
 
-        project_path = os.path.dirname(self.coco_name)
+        label_colors = hf.get_label_colors(label_names, alpha=alpha)
+
+        if self.copy_images_path:
+            images = self.copy_coco_images(images)
+            project_path = self.copy_images_path
+        else:
+            project_path = os.path.dirname(self.coco_name)
 
         project = {'path_to_images': project_path,
                    "images":  {}, 'labels': label_names, 'labels_color': label_colors}
 
         id_num = 0
-        for i, im in enumerate(data["images"]):
-            im_id = im["id"]
+        for i, im in enumerate(images):
             filename = im["file_name"]
             proj_im = {'shapes': []}
-            for seg in data["annotations"]:
-                if seg["image_id"] == im_id:
-                    cls = seg["category_id"] - 1
-                    points = [[seg["segmentation"][0][i], seg["segmentation"][0][i + 1]] for i in
-                              range(0, len(seg["segmentation"][0]), 2)]
-                    shape = {"id": id_num, "cls_num": cls, 'points': points}
-                    id_num += 1
-                    proj_im["shapes"].append(shape)
+            for cls, segmentation in annotations_by_image.get(im["id"], []):
+                points = [[segmentation[j], segmentation[j + 1]] for j in range(0, len(segmentation), 2)]
+                shape = {"id": id_num, "cls_num": cls, 'points': points}
+                id_num += 1
+                proj_im["shapes"].append(shape)
 
             project['images'][filename] = proj_im
 
-            self.load_percent_conn.percent.emit(int(i * 100.0 / len(data["images"])))
+            self.load_percent_conn.percent.emit(int(i * 100.0 / len(images)))
 
         self.project = project
 
@@ -169,58 +267,76 @@ class Importer(QtCore.QThread):
             labels_names = yaml_data["names"]
             label_colors = hf.get_label_colors(labels_names, alpha=alpha)
 
-            if is_seg:
-                self.import_from_yolo_seg(path_to_labels, path_to_images, labels_names, label_colors)
-            else:
+            if self.convert_to_masks and self.sam_predictor and not is_seg:
+                # SAM обрабатывает изображения последовательно
                 self.import_from_yolo_box(path_to_labels, path_to_images, labels_names, label_colors,
                                           convert_to_masks=self.convert_to_masks, sam_predictor=self.sam_predictor)
+            else:
+                self.import_from_yolo_bulk(path_to_labels, path_to_images, labels_names, label_colors, is_seg)
 
-    def import_from_yolo_box(self, path_to_labels, path_to_images, labels_names, labels_color, convert_to_masks=False,
-                             sam_predictor=None):
+    def import_from_yolo_bulk(self, path_to_labels, path_to_images, labels_names, labels_color, is_seg):
+        """
+        То же, что import_from_yolo_seg / import_from_yolo_box без SAM,
+        но файлы разметки разбираются в пуле процессов, координаты пересчитываются векторно
+        """
         project = {'path_to_images': path_to_images, 'images': {}, "labels": labels_names, "labels_color": labels_color}
         images = [im for im in os.listdir(path_to_images) if hf.is_im_path(im)]
-        id_num = 0
-        for i, filename in enumerate(images):
 
-            if convert_to_masks and sam_predictor:
-                sam_predictor.set_image(cv2.imread(os.path.join(path_to_images, filename)))
+        image_paths = [os.path.join(path_to_images, filename) for filename in images]
+        label_paths = [os.path.join(path_to_labels, hf.convert_image_name_to_txt_name(filename)) for filename in
+                       images]
 
-            width, height = Image.open(os.path.join(path_to_images, filename)).size
-            im_shape = [height, width]
-
-            txt_name = hf.convert_image_name_to_txt_name(filename)
-            image_data = {'shapes': []}
+        id_num = 0
+        with ProcessPoolExecutor(max_workers=self.parse_workers) as pool:
+            chunksize = max(1, len(images) // 256)
+            results = pool.map(parse_yolo_label_file, image_paths, label_paths, [is_seg] * len(images),
+                               chunksize=chunksize)
 
-            if not os.path.exists(os.path.join(path_to_labels, txt_name)):
+            for i, (filename, shapes) in enumerate(zip(images, results)):
                 self.load_percent_conn.percent.emit(int(i * 100.0 / len(images)))
-                continue
 
-            with open(os.path.join(path_to_labels, txt_name), 'r') as f:
-                for line in f:
-                    shape = {}
-                    cls_data = line.strip().split(' ')
+                if shapes is None:
+                    if is_seg:
+                        self.info_conn.info_message.emit(f"Can't find labels for {filename}")
+                    continue
 
-                    shape["cls_num"] = int(cls_data[0])
-                    shape["id"] = int(id_num)
+                for shape in shapes:
+                    shape["id"] = id_num
                     id_num += 1
 
-                    x = int(float(cls_data[1]) * im_shape[1])
-                    y = int(float(cls_data[2]) * im_shape[0])
-                    w = int(float(cls_data[3]) * im_shape[1])
-                    h = int(float(cls_data[4]) * im_shape[0])
+                project['images'][filename] = {'shapes': shapes}
+
+        self.project = project
+
+    def import_from_yolo_box(self, path_to_labels, path_to_images, labels_names, labels_color, convert_to_masks=False,
+                             sam_predictor=None):
+        project = {'path_to_images': path_to_images, 'images': {}, "labels": labels_names, "labels_color": labels_color}
+        images = [im for im in os.listdir(path_to_images) if hf.is_im_path(im)]
+        id_num = 0
+        for i, filename in enumerate(images):
+            image_path = os.path.join(path_to_images, filename)
+            label_path = os.path.join(path_to_labels, hf.convert_image_name_to_txt_name(filename))
+
+            shapes = parse_yolo_label_file(image_path, label_path, is_seg=False)
+            if shapes is None:
+                self.load_percent_conn.percent.emit(int(i * 100.0 / len(images)))
+                continue
 
-                    shape["points"] = [[x - w / 2, y - h / 2], [x + w / 2, y - h / 2], [x + w / 2, y + h / 2],
-                                       [x - w / 2, y + h / 2]]
+            for shape in shapes:
+                shape["id"] = id_num
+                id_num += 1
 
-                    if convert_to_masks and sam_predictor:
-                        input_box = np.array([shape["points"][0][0], shape["points"][0][1], shape["points"][2][0],
-                                              shape["points"][2][1]])
-                        masks = predict_by_box(sam_predictor, input_box)
-                        shape["points"] = mask_to_seg(masks)[0]
+            if convert_to_masks and sam_predictor and shapes:
+                sam_predictor.set_image(cv2.imread(image_path))
 
-                    image_data["shapes"].append(shape)
+                # все боксы изображения декодируются SAM за один вызов
+                input_boxes = np.array([shape["points"][0] + shape["points"][2] for shape in shapes])
+                masks, _ = predict_batch(sam_predictor, boxes=input_boxes, multimask_output=True)
+                for shape, polygons in zip(shapes, masks_to_polygons(masks, simplify_factor=2, min_size=0)):
+                    if polygons:
+                        shape["points"] = polygons[0]
 
-            project['images'][filename] = image_data
+            project['images'][filename] = {'shapes': shapes}
             self.load_percent_conn.percent.emit(int(i * 100.0 / len(images)))
 
         self.project = project
@@ -1,13 +1,12 @@
 import math
 import os
-import pickle
 
 from PIL import Image
 from PySide2 import QtCore
 
 from ui.signals_and_slots import LoadPercentConnection, InfoConnection
 from utils.calc_methods import DNToQGis, DNTheamProc
-from utils.sam_fragment import create_masks, create_generator
+from utils.sam_fragment import create_generator, generate_masks_for_crops
 from utils.settings_handler import AppSettings
 
 
@@ -30,6 +29,8 @@ class PostProcessingWorker(QtCore.QThread):
         self.save_folder = save_folder
         self.settings = AppSettings()
         self.sam_model = sam_model
+        self.debug_artifacts = self.settings.read_post_debug_artifacts()
+        self.crop_workers = self.settings.read_sam_crop_workers()
 
         self.polygons = []
 
@@ -59,25 +60,19 @@ class PostProcessingWorker(QtCore.QThread):
 
         self.psnt_connection.percent.emit(30)
 
-        crop_names = []
         if not bns_zones:
             self.psnt_connection.percent.emit(100)
             info_message = f"Зоны для поиска БНС не найдены" if self.settings.read_lang() == 'RU' else f"Can't find BNS local zone"
             self.info_connection.info_message.emit(info_message)
             return
 
-        for i, im in enumerate(bns_zones['Imgs']):
-            crop_name = os.path.join(self.save_folder, f'crop{i}.jpg')
-            crop_names.append(crop_name)
-            im.save(crop_name)
-
         self.psnt_connection.percent.emit(40)
 
         info_message = f"Зона расположения БНС найдена. Начинаю кластеризацию методом SAM" if self.settings.read_lang() == 'RU' else f"Found BNS local zone. Start clustering with SAM.."
         self.info_connection.info_message.emit(info_message)
 
-        step = 0
-        steps = len(crop_names) * 2
+        crops_num = len(bns_zones['Imgs'])
+        steps = crops_num * 2
         points_per_side = 16  # self.calc_points_per_side(min_obj_width_meters=80)
         print(f"Points per side = {points_per_side}")
 
@@ -86,29 +81,28 @@ class PostProcessingWorker(QtCore.QThread):
                                      crop_nms_thresh=0.7,
                                      output_mode="binary_mask")
 
-        for i, crop_name in enumerate(crop_names):
-            pkl_name = os.path.join(self.save_folder, f'crop{i}.pkl')
-
-            create_masks(generator, crop_name, output_path=None,
-                         one_image_name=os.path.join(self.save_folder, f'crop{i}_sam.jpg'),
-                         pickle_name=pkl_name)
+        # Кропы и маски передаются в памяти, файлы сохраняются только для отладки
+        masks_list = generate_masks_for_crops(generator, bns_zones['Imgs'], max_workers=self.crop_workers,
+                                              debug_folder=self.save_folder if self.debug_artifacts else None,
+                                              on_crop_finished=lambda n: self.psnt_connection.percent.emit(
+                                                  int(40 + 60 * float(n) / steps)))
 
-            step += 1
-            self.psnt_connection.percent.emit(40 + 60 * float(step) / steps)
+        for i, masks in enumerate(masks_list):
+            if len(masks) == 0:
+                # прогресс идет и по пустым кропам, иначе полоса не доходит до 100
+                self.psnt_connection.percent.emit(int(40 + 60 * float(crops_num + i + 1) / steps))
+                continue
 
-            with open(pkl_name, 'rb') as f:
-                Mass = pickle.load(f)
-                ContBNS = ToQGisObj.FinedBNS(Mass, bns_zones['Coords'][i], self.lrm)
+            ContBNS = ToQGisObj.FinedBNS(masks, bns_zones['Coords'][i], self.lrm)
 
-                info_message = f"Кластеризация методом SAM завершена. Создаю контуры БНС..." if self.settings.read_lang() == 'RU' else f"SAM finished. Start building contours..."
-                self.info_connection.info_message.emit(info_message)
+            info_message = f"Кластеризация методом SAM завершена. Создаю контуры БНС..." if self.settings.read_lang() == 'RU' else f"SAM finished. Start building contours..."
+            self.info_connection.info_message.emit(info_message)
 
-                for points in ContBNS:
-                    cls_num = 5  # bns
-                    self.polygons.append({'cls_num': cls_num, 'points': points})
+            for points in ContBNS or []:
+                cls_num = 5  # bns
+                self.polygons.append({'cls_num': cls_num, 'points': points})
 
-            step += 1
-            self.psnt_connection.percent.emit(40 + 60 * float(step) / steps)
+            self.psnt_connection.percent.emit(int(40 + 60 * float(crops_num + i + 1) / steps))
 
     def mz_detection(self):
         post_proc = DNTheamProc(self.tek_image_path, self.yolo_txt_name, self.edges_stats, self.lrm,
@@ -116,7 +110,8 @@ class PostProcessingWorker(QtCore.QThread):
         post_proc.info_connection.info_message.connect(self.info_connection.info_message)
         post_proc.psnt_connection.percent.connect(self.psnt_connection.percent)
 
-        self.polygons = post_proc.AESProc(self.save_folder)
+        self.polygons = post_proc.AESProc(self.save_folder, debug=self.debug_artifacts,
+                                          max_workers=self.crop_workers)
 
     def run(self):
         # self.bns_detection()
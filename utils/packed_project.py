@@ -0,0 +1,422 @@
+import copy
+import json
+import os
+import struct
+from collections.abc import MutableMapping
+
+import numpy as np
+import ujson
+
+PACKED_PROJECT_EXT = '.sama'
+PACKED_MAGIC = b'SAMAPACK'
+PACKED_VERSION = 1
+PACKED_ALIGN = 64
+
+# magic, версия, резерв, длина json-заголовка
+_PREFIX = struct.Struct('<8sIIQ')
+
+# поля полигона, которые хранятся в массивах. Остальные поля ('conf' и т.п.) - в заголовке
+_SHAPE_ARRAY_FIELDS = ('cls_num', 'id', 'points')
+
+
+def is_packed_project(path):
+    """
+    Проверка, что файл - упакованный проект (по сигнатуре, а не по расширению)
+    """
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(PACKED_MAGIC)) == PACKED_MAGIC
+
+
+def _json_default(obj):
+    # numpy-скаляры (например, conf из результатов детекции)
+    if hasattr(obj, 'item'):
+        return obj.item()
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError(f"{type(obj)} is not JSON serializable")
+
+
+def _align(pos):
+    return (pos + PACKED_ALIGN - 1) // PACKED_ALIGN * PACKED_ALIGN
+
+
+class PackedImages(MutableMapping):
+    """
+    Словарь images проекта поверх упакованных массивов:
+        coords - np.float32 (points_num, 2), координаты всех полигонов подряд
+        shape_offsets - np.int64 (shapes_num + 1), начало точек каждого полигона в coords
+        cls_nums, ids - np.int32 / np.int64 (shapes_num)
+        image_offsets - np.int64 (images_num + 1), начало полигонов каждого изображения
+    Данные изображения {'shapes': [...], 'lrm':..., 'status':...} собираются при первом обращении
+    и дальше хранятся как обычный dict, поэтому их можно изменять как раньше
+    Не тронутые изображения при сохранении копируются из массивов без перевода в dict
+    """
+
+    def __init__(self, names, infos, arrays, shape_extras=None, source_path=None):
+        self.source_path = source_path
+        self.infos = infos
+        self.coords = arrays['coords']
+        self.shape_offsets = arrays['shape_offsets']
+        self.cls_nums = arrays['cls_nums']
+        self.ids = arrays['ids']
+        self.image_offsets = arrays['image_offsets']
+        self.shape_extras = shape_extras or {}
+
+        # имя -> номер изображения в массивах, -1 для добавленных после загрузки. Порядок как в проекте
+        self.index = {name: i for i, name in enumerate(names)}
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(list(self.index))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        if name in self.cache:
+            return self.cache[name]
+
+        image_num = self.index[name]
+        im = self.build_image(image_num)
+        self.cache[name] = im
+        return im
+
+    def __setitem__(self, name, image_data):
+        if name not in self.index:
+            self.index[name] = -1
+        self.cache[name] = image_data
+
+    def __delitem__(self, name):
+        del self.index[name]
+        self.cache.pop(name, None)
+
+    def build_image(self, image_num):
+        """
+        Данные изображения из массивов в формате проекта
+        """
+        im = dict(self.infos[image_num])
+
+        first, last = int(self.image_offsets[image_num]), int(self.image_offsets[image_num + 1])
+        offsets = self.shape_offsets[first:last + 1].tolist()
+        cls_nums = self.cls_nums[first:last].tolist()
+        ids = self.ids[first:last].tolist()
+        points = self.coords[offsets[0]:offsets[-1]].tolist() if offsets else []
+
+        shapes = []
+        start = offsets[0] if offsets else 0
+        for k in range(last - first):
+            shape = {'cls_num': cls_nums[k], 'id': ids[k],
+                     'points': points[offsets[k] - start:offsets[k + 1] - start]}
+            extras = self.shape_extras.get(first + k)
+            if extras:
+                shape.update(extras)
+            shapes.append(shape)
+
+        im['shapes'] = shapes
+        return im
+
+    def plain_items(self):
+        """
+        Пары (имя, данные изображения) без сохранения собранных dict в кэше
+        Для выгрузки в JSON больших проектов
+        """
+        for name, image_num in self.index.items():
+            if name in self.cache:
+                yield name, self.cache[name]
+            else:
+                yield name, self.build_image(image_num)
+
+    def packed_segments(self):
+        """
+        Генератор (имя, image_num, image_data) в порядке проекта
+        Для не тронутых изображений image_data = None, для остальных image_num = -1
+        """
+        for name, image_num in self.index.items():
+            if name in self.cache:
+                yield name, -1, self.cache[name]
+            else:
+                yield name, image_num, None
+
+    def get_shapes_num(self):
+        shapes_num = 0
+        for name, image_num, im in self.packed_segments():
+            if im is None:
+                shapes_num += int(self.image_offsets[image_num + 1] - self.image_offsets[image_num])
+            else:
+                shapes_num += len(im['shapes'])
+        return shapes_num
+
+    def get_cls_nums(self):
+        """
+        Номера классов всех полигонов проекта одним массивом
+        """
+        parts = []
+        for name, image_num, im in self.packed_segments():
+            if im is None:
+                parts.append(self.cls_nums[self.image_offsets[image_num]:self.image_offsets[image_num + 1]])
+            else:
+                parts.append(np.array([shape['cls_num'] for shape in im['shapes']], dtype=np.int32))
+        if not parts:
+            return np.zeros(0, dtype=np.int32)
+        return np.concatenate(parts)
+
+    def update_ids(self):
+        """
+        Сквозная нумерация полигонов, как ProjectHandler.update_ids, но без сборки dict
+        """
+        self.ids = np.array(self.ids)  # memmap открыт только на чтение
+        id_num = 0
+        for name, image_num, im in self.packed_segments():
+            if im is None:
+                first, last = self.image_offsets[image_num], self.image_offsets[image_num + 1]
+                self.ids[first:last] = np.arange(id_num, id_num + last - first)
+                id_num += int(last - first)
+            else:
+                for shape in im['shapes']:
+                    shape['id'] = id_num
+                    id_num += 1
+
+    def snapshot(self):
+        """
+        Копия словаря для сохранения из фонового потока
+        Массивы общие (они только читаются), index и cache копируются, поэтому дальнейшие
+        изменения проекта не попадают в копию
+        """
+        images = copy.copy(self)
+        images.index = dict(self.index)
+        images.cache = dict(self.cache)
+        return images
+
+    def load_to_memory(self):
+        """
+        Копирование массивов в память и закрытие отображения файла.
+        Нужно перед перезаписью файла, из которого проект был загружен
+        """
+        self.coords = np.array(self.coords)
+        self.shape_offsets = np.array(self.shape_offsets)
+        self.cls_nums = np.array(self.cls_nums)
+        self.ids = np.array(self.ids)
+        self.image_offsets = np.array(self.image_offsets)
+        self.source_path = None
+
+
+def _pack_images(images):
+    """
+    Перевод словаря images (dict или PackedImages) в массивы упакованного формата
+    """
+    names = []
+    infos = []
+    shape_extras = {}
+    coords_parts = []
+    lengths_parts = []
+    cls_parts = []
+    ids_parts = []
+    shapes_counts = []
+    shapes_num = 0
+
+    if isinstance(images, PackedImages):
+        segments = images.packed_segments()
+    else:
+        segments = ((name, -1, im) for name, im in images.items())
+
+    for name, image_num, im in segments:
+        names.append(name)
+
+        if im is None:
+            # изображение не изменялось - срезы исходных массивов
+            first, last = int(images.image_offsets[image_num]), int(images.image_offsets[image_num + 1])
+            offsets = images.shape_offsets[first:last + 1]
+            infos.append(images.infos[image_num])
+            coords_parts.append(images.coords[offsets[0]:offsets[-1]])
+            lengths_parts.append(np.diff(offsets))
+            cls_parts.append(images.cls_nums[first:last])
+            ids_parts.append(images.ids[first:last])
+            for k in range(first, last):
+                if k in images.shape_extras:
+                    shape_extras[shapes_num + k - first] = images.shape_extras[k]
+            shapes_counts.append(last - first)
+            shapes_num += last - first
+            continue
+
+        infos.append({k: v for k, v in im.items() if k != 'shapes'})
+        shapes = im.get('shapes', [])
+        lengths = np.zeros(len(shapes), dtype=np.int64)
+        for k, shape in enumerate(shapes):
+            points = np.asarray(shape['points'], dtype=np.float32).reshape(-1, 2)
+            coords_parts.append(points)
+            lengths[k] = len(points)
+            extras = {key: v for key, v in shape.items() if key not in _SHAPE_ARRAY_FIELDS}
+            if extras:
+                shape_extras[shapes_num + k] = extras
+
+        lengths_parts.append(lengths)
+        cls_parts.append(np.array([shape['cls_num'] for shape in shapes], dtype=np.int32))
+        ids_parts.append(np.array([shape.get('id', -1) for shape in shapes], dtype=np.int64))
+        shapes_counts.append(len(shapes))
+        shapes_num += len(shapes)
+
+    def concat(parts, dtype, shape=(0,)):
+        if not parts:
+            return np.zeros(shape, dtype=dtype)
+        return np.concatenate(parts).astype(dtype, copy=False)
+
+    lengths = concat(lengths_parts, np.int64)
+    arrays = {
+        'coords': concat(coords_parts, np.float32, (0, 2)).reshape(-1, 2),
+        'shape_offsets': np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+        'cls_nums': concat(cls_parts, np.int32),
+        'ids': concat(ids_parts, np.int64),
+        'image_offsets': np.concatenate([[0], np.cumsum(shapes_counts, dtype=np.int64)]).astype(np.int64),
+    }
+
+    return names, infos, shape_extras, arrays
+
+
+def save_packed_project(data, path):
+    """
+    Сохранение проекта в упакованном формате
+    data - данные проекта {'path_to_images', 'images', 'labels', 'labels_color', ...}
+    Запись идет во временный файл, который затем заменяет старый
+    """
+    images = data['images']
+    names, infos, shape_extras, arrays = _pack_images(images)
+
+    header = {
+        'meta': {k: v for k, v in data.items() if k != 'images'},
+        'images': names,
+        'infos': infos,
+        'shape_extras': {str(k): v for k, v in shape_extras.items()},
+        'arrays': {}
+    }
+
+    # смещения массивов зависят от длины заголовка, поэтому заголовок считается дважды
+    offsets_known = False
+    while True:
+        header_bytes = json.dumps(header, default=_json_default, ensure_ascii=False).encode('utf8')
+        pos = _align(_PREFIX.size + len(header_bytes) + PACKED_ALIGN)
+        arrays_info = {}
+        for name, arr in arrays.items():
+            arrays_info[name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': pos}
+            pos = _align(pos + arr.nbytes)
+        if offsets_known and arrays_info == header['arrays']:
+            break
+        header['arrays'] = arrays_info
+        offsets_known = True
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_PREFIX.pack(PACKED_MAGIC, PACKED_VERSION, 0, len(header_bytes)))
+        f.write(header_bytes)
+        for name, arr in arrays.items():
+            f.seek(header['arrays'][name]['offset'])
+            f.write(np.ascontiguousarray(arr).tobytes())
+        f.truncate(pos)
+        f.flush()
+        os.fsync(f.fileno())
+
+    if isinstance(images, PackedImages) and images.source_path and os.path.exists(path) and os.path.samefile(
+            images.source_path, path):
+        # на Windows нельзя заменить файл, отображенный в память
+        images.load_to_memory()
+
+    os.replace(tmp_path, path)
+
+
+def load_packed_project(path, use_mmap=True):
+    """
+    Загрузка упакованного проекта
+    При use_mmap массивы отображаются в память и читаются с диска по мере обращения
+    Возвращает данные проекта, где images - PackedImages
+    """
+    with open(path, 'rb') as f:
+        magic, version, _, header_len = _PREFIX.unpack(f.read(_PREFIX.size))
+        if magic != PACKED_MAGIC:
+            raise ValueError(f"{path} is not a packed SAMA project")
+        if version > PACKED_VERSION:
+            raise ValueError(f"Packed project version {version} is not supported")
+        header = ujson.loads(f.read(header_len).decode('utf8'))
+
+    arrays = {}
+    for name, info in header['arrays'].items():
+        shape = tuple(info['shape'])
+        dtype = np.dtype(info['dtype'])
+        if use_mmap and int(np.prod(shape)) > 0:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=info['offset'], shape=shape)
+        else:
+            count = int(np.prod(shape))
+            with open(path, 'rb') as f:
+                f.seek(info['offset'])
+                arrays[name] = np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+
+    shape_extras = {int(k): v for k, v in header['shape_extras'].items()}
+
+    data = dict(header['meta'])
+    data['images'] = PackedImages(header['images'], header['infos'], arrays, shape_extras,
+                                  source_path=path if use_mmap else None)
+    return data
+
+
+def to_json_data(data):
+    """
+    Данные проекта в виде обычных dict для сохранения в JSON
+    """
+    images = data['images']
+    if not isinstance(images, PackedImages):
+        return data
+
+    json_data = dict(data)
+    json_data['images'] = dict(images.plain_items())
+    return json_data
+
+
+def save_json_project(data, path):
+    """
+    Сохранение проекта в JSON
+    Изображения сериализуются по одному: при записи из фонового потока GUI не ждет сериализации всего проекта
+    Запись идет во временный файл, который затем заменяет старый
+    """
+    images = data['images']
+    items = images.plain_items() if isinstance(images, PackedImages) else images.items()
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        f.write('{')
+        for key, value in data.items():
+            if key != 'images':
+                f.write(f"{ujson.dumps(key)}:{ujson.dumps(value)},")
+        f.write('"images":{')
+        for i, (name, image_data) in enumerate(items):
+            if i:
+                f.write(',')
+            f.write(f"{ujson.dumps(name)}:{ujson.dumps(image_data)}")
+        f.write('}}')
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+
+
+def save_project_data(data, path):
+    """
+    Сохранение проекта. Файлы с расширением PACKED_PROJECT_EXT сохраняются в упакованном формате, остальные - в JSON
+    """
+    if os.path.splitext(path)[1].lower() == PACKED_PROJECT_EXT:
+        save_packed_project(data, path)
+    else:
+        save_json_project(data, path)
+
+
+def convert_json_to_packed(json_path, packed_path):
+    with open(json_path, 'r', encoding='utf8') as f:
+        data = ujson.load(f)
+    save_packed_project(data, packed_path)
+
+
+def convert_packed_to_json(packed_path, json_path):
+    data = load_packed_project(packed_path)
+    save_json_project(data, json_path)
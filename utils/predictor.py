@@ -1,5 +1,8 @@
+import contextlib
+
 from PySide2 import QtCore
 
+from utils.sam_embedding_cache import get_predictor_state, set_predictor_state
 from utils.sam_predictor import predictor_set_image
 
 
@@ -7,6 +10,10 @@ class SAMImageSetter(QtCore.QThread):
 
     def __init__(self):
         super(SAMImageSetter, self).__init__()
+        self.cache = None
+        self.model_name = None
+        self.is_cache_hit = False
+        self.encoder_lock = None
 
     def set_image(self, image):
         self.image = image
@@ -17,7 +24,52 @@ class SAMImageSetter(QtCore.QThread):
     def set_predictor(self, predictor):
         self.predictor = predictor
 
+    def set_cache(self, cache, model_name):
+        """
+        cache - SAMEmbeddingCache, model_name - имя модели SAM, входит в ключ кэша
+        """
+        self.cache = cache
+        self.model_name = model_name
+
+    def set_encoder_lock(self, lock):
+        """
+        lock - threading.Lock, общий с SAMPrefetchWorker: энкодер модели работает только в одном потоке
+        """
+        self.encoder_lock = lock
+
+    def get_encoder_lock(self):
+        if self.encoder_lock is None:
+            return contextlib.nullcontext()
+        return self.encoder_lock
+
     def run(self):
-        predictor_set_image(self.predictor, self.image)
+        self.is_cache_hit = False
+        if self.cache is None:
+            with self.get_encoder_lock():
+                predictor_set_image(self.predictor, self.image)
+            return
+
+        key = self.cache.make_key(self.image, self.model_name)
+        if self.set_from_cache(key):
+            return
+
+        # если это изображение сейчас предзагружается, после ожидания оно уже будет в кэше
+        with self.get_encoder_lock():
+            if self.set_from_cache(key):
+                return
+
+            predictor_set_image(self.predictor, self.image)
+
+        state = get_predictor_state(self.predictor)
+        if state is not None:
+            self.cache.put(key, state)
+
+    def set_from_cache(self, key):
+        state = self.cache.get(key)
+        if state is None:
+            return False
+        set_predictor_state(self.predictor, state)
+        self.is_cache_hit = True
+        return True
 
 
@@ -1,3 +1,4 @@
+import copy
 import datetime
 import os
 
@@ -8,6 +9,7 @@ from PIL import Image
 from PyQt5.QtWidgets import QWidget
 from shapely import Polygon
 from utils.exporter import Exporter
+from utils.packed_project import PackedImages, is_packed_project, load_packed_project, save_project_data
 
 import utils.config as config
 import utils.help_functions as hf
@@ -48,10 +50,120 @@ class ProjectHandler(QWidget):
         self.data["labels"] = []
         self.data["labels_color"] = {}
         self.is_loaded = False
+        # учет изменений для снимков, которые еще записываются в фоне (по порядку записи)
+        self.saving_changes = []
+        self.reset_changes()
+
+    def reset_changes(self):
+        """
+        Сброс учета изменений: текущее состояние считается сохраненным
+        dirty_images - изображения, измененные после последнего сохранения или записи в журнал
+        is_images_reset - images изменен целиком (в журнал пишутся все изображения)
+        """
+        self.dirty_images = set()
+        self.is_images_reset = False
+        self.journaled_meta = copy.deepcopy(self.get_meta())
+
+    def mark_image_dirty(self, image_name):
+        self.dirty_images.add(image_name)
+
+    def get_meta(self):
+        """
+        Поля проекта, кроме images
+        """
+        return {k: v for k, v in self.data.items() if k != 'images'}
+
+    def take_journal_entries(self):
+        """
+        Записи для ProjectJournal об изменениях после прошлого вызова (или сохранения)
+        Сериализуются в фоновом потоке, поэтому данные изображений не копируются:
+        методы ProjectHandler не меняют данные изображения на месте, а заменяют их измененной копией
+        """
+        entries = []
+        meta = self.get_meta()
+        if meta != self.journaled_meta:
+            entries.append({'meta': copy.deepcopy(meta)})
+            self.journaled_meta = copy.deepcopy(meta)
+
+        images = self.data['images']
+        if self.is_images_reset:
+            entries.append({'reset_images': True})
+            if isinstance(images, PackedImages):
+                items = list(images.snapshot().plain_items())
+            else:
+                items = list(images.items())
+            entries.extend({'image': name, 'data': im} for name, im in items)
+        else:
+            for name in sorted(self.dirty_images):
+                entries.append({'image': name, 'data': images.get(name, None)})
+
+        self.dirty_images = set()
+        self.is_images_reset = False
+        return entries
+
+    def make_snapshot(self, json_path):
+        """
+        Снимок проекта для полного сохранения в json_path из фонового потока
+        Словарь images копируется без копирования данных изображений (они заменяются копией при изменении,
+        см. take_journal_entries)
+        """
+        images = self.data['images']
+        if isinstance(images, PackedImages):
+            if images.source_path and os.path.exists(json_path) and os.path.samefile(images.source_path, json_path):
+                # файл, отображенный в память, будет заменен
+                images.load_to_memory()
+            images = images.snapshot()
+        else:
+            images = dict(images)
+
+        snapshot = copy.deepcopy(self.get_meta())
+        snapshot['images'] = images
+
+        # изменения до снимка забываются только после успешной записи (finish_snapshot)
+        self.saving_changes.append((self.dirty_images, self.is_images_reset, self.journaled_meta))
+        self.reset_changes()
+        return snapshot
+
+    def finish_snapshot(self, is_ok):
+        """
+        Вызывается по окончании фоновой записи снимка из make_snapshot
+        При ошибке изменения до снимка снова считаются несохраненными и попадут в журнал
+        """
+        if not self.saving_changes:
+            return
+
+        dirty_images, is_images_reset, journaled_meta = self.saving_changes.pop(0)
+        if not is_ok:
+            self.dirty_images |= dirty_images
+            self.is_images_reset = self.is_images_reset or is_images_reset
+            self.journaled_meta = journaled_meta
+
+    def apply_journal_entries(self, entries):
+        """
+        Восстановление несохраненных изменений из записей ProjectJournal
+        """
+        for entry in entries:
+            if 'meta' in entry:
+                self.data.update(entry['meta'])
+            elif entry.get('reset_images'):
+                for name in list(self.data['images']):
+                    del self.data['images'][name]
+            elif 'image' in entry:
+                if entry['data'] is None:
+                    self.delete_image(entry['image'])
+                else:
+                    self.set_image_data(entry['image'], entry['data'])
 
     def calc_dataset_balance(self):
         labels = self.get_labels()
         labels_nums = {}
+        if isinstance(self.data['images'], PackedImages):
+            cls_nums = self.data['images'].get_cls_nums()
+            uniq, first_idx, counts = np.unique(cls_nums, return_index=True, return_counts=True)
+            for k in np.argsort(first_idx):
+                labels_nums[labels[uniq[k]]] = int(counts[k])
+            return labels_nums
+
         for im in self.data['images'].values():
             for shape in im['shapes']:
                 cls_num = shape['cls_num']
@@ -73,20 +185,38 @@ class ProjectHandler(QWidget):
             self.data["images"] = images
 
     def load(self, json_path):
+        """
+        Загрузка проекта. Формат (JSON или упакованный) определяется по содержимому файла
+        """
+        if is_packed_project(json_path):
+            self.data = load_packed_project(json_path)
+            self.update_ids()
+            self.is_loaded = True
+            self.reset_changes()
+            return
+
         with open(json_path, 'r', encoding='utf8') as f:
             self.data = ujson.load(f)
             self.check_and_convert_old_data_to_new()
             self.update_ids()
             self.is_loaded = True
+            self.reset_changes()
 
     def save(self, json_path):
-        with open(json_path, 'w', encoding='utf8') as f:
-            ujson.dump(self.data, f)
+        """
+        Сохранение проекта. Файлы с расширением PACKED_PROJECT_EXT сохраняются в упакованном формате
+        Запись атомарная: через временный файл
+        """
+        save_project_data(self.data, json_path)
+        self.reset_changes()
 
     def update_ids(self):
 
         if not self.data["images"]:
             return
+        if isinstance(self.data['images'], PackedImages):
+            self.data['images'].update_ids()
+            return
         id_num = 0
         for im in self.data['images'].values():
             for shape in im['shapes']:
@@ -96,15 +226,18 @@ class ProjectHandler(QWidget):
     def set_data(self, data):
         self.data = data
         self.is_loaded = True
+        self.is_images_reset = True
 
     def set_image_lrm(self, image_name, lrm):
         im = self.get_image_data(image_name)  # im = {shapes:[], lrm:float, status:str}
         if im:
+            im = dict(im)
             im["lrm"] = round(lrm, 6)
+            self.set_image_data(image_name, im)
         else:
             im = create_blank_image()
             im['lrm'] = round(lrm, 6)
-            self.data["images"][image_name] = im
+            self.set_image_data(image_name, im)
 
     def get_image_status(self, image_name):
         im = self.get_image_data(image_name)  # im = {shapes:[], lrm:float, status:str}
@@ -129,12 +262,13 @@ class ProjectHandler(QWidget):
             return
         im = self.get_image_data(image_name)  # im = {shapes:[], lrm:float, status:str}
         if im:
+            im = dict(im)
             im["status"] = status
-            self.data["images"][image_name] = im
+            self.set_image_data(image_name, im)
         else:
             im = create_blank_image()
             im["status"] = status
-            self.data["images"][image_name] = im
+            self.set_image_data(image_name, im)
 
     def get_image_last_user(self, image_name):
         im = self.get_image_data(image_name)
@@ -144,12 +278,13 @@ class ProjectHandler(QWidget):
     def set_image_last_user(self, image_name, last_user):
         im = self.get_image_data(image_name)
         if im:
+            im = dict(im)
             im["last_user"] = last_user
-            self.data["images"][image_name] = im
+            self.set_image_data(image_name, im)
         else:
             im = create_blank_image()
             im["last_user"] = last_user
-            self.data["images"][image_name] = im
+            self.set_image_data(image_name, im)
 
     def set_lrm_for_all_images(self, lrms_data):
         set_names = []
@@ -163,12 +298,13 @@ class ProjectHandler(QWidget):
                 lrm = lrms_data[image_name]
                 im = self.get_image_data(image_name)  # im = {shapes:[], lrm:float, status:str}
                 if im:
+                    im = dict(im)
                     im["lrm"] = round(lrm, 6)
-                    self.data["images"][image_name] = im
+                    self.set_image_data(image_name, im)
                 else:
                     im = create_blank_image()
                     im['lrm'] = round(lrm, 6)
-                    self.data["images"][image_name] = im
+                    self.set_image_data(image_name, im)
 
                 set_names.append(image_name)
 
@@ -187,7 +323,7 @@ class ProjectHandler(QWidget):
                 im = self.get_image_data(im_name)
                 if not im:
                     im = create_blank_image()
-                    self.data["images"][im_name] = im
+                    self.set_image_data(im_name, im)
 
     def set_label_color(self, cls_name, color=None, alpha=None):
 
@@ -237,16 +373,22 @@ class ProjectHandler(QWidget):
         """
         for im_name, im_data in dicts_with_shapes.items():
             if im_name in self.data['images']:
-                for shape in im_data['shapes']:  # im_data в формате {"shapes": [...]}
-                    self.data["images"][im_name]['shapes'].append(shape)
+                im = dict(self.data["images"][im_name])
+                im['shapes'] = im['shapes'] + list(im_data['shapes'])  # im_data в формате {"shapes": [...]}
+                self.set_image_data(im_name, im)
             else:
                 im_blank = create_blank_image()
                 for shape in im_data['shapes']:  # im_data в формате {"shapes": [...]}
                     im_blank['shapes'].append(shape)
-                self.data["images"][im_name] = im_blank
+                self.set_image_data(im_name, im_blank)
 
     def set_image_data(self, image_name, image_data):
+        old_data = self.data["images"].get(image_name, None)
+        if old_data is not image_data and old_data == image_data:
+            # данные не изменились, в журнал не пишутся
+            return
         self.data["images"][image_name] = image_data
+        self.mark_image_dirty(image_name)
 
     def get_data(self):
         return self.data
@@ -299,18 +441,18 @@ class ProjectHandler(QWidget):
         return export_map
 
     def change_cls_num_by_ids(self, image_name, lbl_ids, new_cls_num):
-        im = self.get_image_data(image_name)  # im = {shapes:[], lrm:float, status:str}
+        im = dict(self.get_image_data(image_name))  # im = {shapes:[], lrm:float, status:str}
         new_shapes = []
 
         for shape in im['shapes']:
             if shape['id'] in lbl_ids:
-                new_shape = shape
+                new_shape = dict(shape)
                 new_shape["cls_num"] = new_cls_num
                 new_shapes.append(new_shape)
             else:
                 new_shapes.append(shape)
         im['shapes'] = new_shapes
-        self.data["images"][image_name] = im
+        self.set_image_data(image_name, im)
 
     def rename_color(self, old_name, new_name):
         if old_name in self.data["labels_color"]:
@@ -342,6 +484,7 @@ class ProjectHandler(QWidget):
     def delete_image(self, image_name):
         if image_name in self.data["images"]:
             del self.data["images"][image_name]
+            self.mark_image_dirty(image_name)
 
     def delete_data_by_class_name(self, cls_name):
         name_to_name_map = {}  # Конвертер старого имени в новое
@@ -372,6 +515,7 @@ class ProjectHandler(QWidget):
                 num_to_num[old_num] = -1
 
         for im_name, image in self.data["images"].items():  # image = {shapes:[], lrm:float, status:str}
+            image = dict(image)
             new_shapes = []
             for shape in image["shapes"]:
 
@@ -384,7 +528,7 @@ class ProjectHandler(QWidget):
                     new_shapes.append(shape_new)
 
             image["shapes"] = new_shapes
-            self.data["images"][im_name] = image
+            self.set_image_data(im_name, image)
 
         self.set_labels(new_labels)
 
@@ -393,6 +537,7 @@ class ProjectHandler(QWidget):
     def delete_data_by_class_number(self, cls_num):
 
         for im_name, image in self.data["images"].items():  # image = {shapes:[], lrm:float, status:str}
+            image = dict(image)
             new_shapes = []
             for shape in image["shapes"]:
                 if shape["cls_num"] < cls_num:
@@ -405,7 +550,7 @@ class ProjectHandler(QWidget):
                     new_shapes.append(shape_new)
 
             image["shapes"] = new_shapes
-            self.data["images"][im_name] = image
+            self.set_image_data(im_name, image)
 
     def change_data_class_from_to(self, from_cls_name, to_cls_name):
 
@@ -434,6 +579,7 @@ class ProjectHandler(QWidget):
             num_to_num[old_num] = new_num
 
         for im_name, image in self.data["images"].items():  # image = {shapes:[], lrm:float, status:str}
+            image = dict(image)
             new_shapes = []
             for shape in image["shapes"]:
                 shape_new = {}
@@ -443,7 +589,7 @@ class ProjectHandler(QWidget):
                 new_shapes.append(shape_new)
 
             image["shapes"] = new_shapes
-            self.data["images"][im_name] = image
+            self.set_image_data(im_name, image)
 
         self.set_labels(new_labels)
 
@@ -468,15 +614,16 @@ class ProjectHandler(QWidget):
         return images_dir, labels_dir
 
     def export(self, export_dir, export_map=None, format='yolo_seg', variant_idx=0, splits=None, sim=0,
-               is_filter_null=False, new_image_size=None):
+               is_filter_null=False, new_image_size=None, incremental=False):
 
         """
         sim - тип объединения Train/Val/Test
             0 - случайно, 1 - по имени, 2 - CLIP
+        incremental - перезаписывать только изменившиеся изображения и разметку (только YOLO)
         """
         self.exporter = Exporter(self.data, export_dir=export_dir, format=format, export_map=export_map,
                                  variant_idx=variant_idx, splits=splits, sim=sim, is_filter_null=is_filter_null,
-                                 new_image_size=new_image_size)
+                                 new_image_size=new_image_size, incremental=incremental)
 
         self.exporter.export_percent_conn.percent.connect(self.on_exporter_percent_change)
         self.exporter.info_conn.info_message.connect(self.on_exporter_message)
@@ -507,6 +654,7 @@ class ProjectHandler(QWidget):
                 print(f"Checking files: image {filename} doesn't exist")
 
         self.data['images'] = images
+        self.is_images_reset = True
 
 
 if __name__ == '__main__':
@@ -0,0 +1,31 @@
+from PySide2 import QtCore
+
+from utils.image_pyramid import build_cached_pyramid
+
+
+class PyramidBuilderWorker(QtCore.QThread):
+    """
+    Построение полной пирамиды большого изображения и запись ее в дисковый кэш вне потока GUI
+    Результат - get_pyramid() после сигнала finished (None, если построить не удалось)
+    """
+
+    def __init__(self, image_path, image, cache=None):
+        super(PyramidBuilderWorker, self).__init__()
+        self.image_path = image_path
+        self.image = image
+        self.cache = cache
+        self.pyramid = None
+
+    def run(self):
+        try:
+            self.pyramid = build_cached_pyramid(self.image_path, self.image, cache=self.cache)
+        except Exception as e:
+            # например, нехватка места на диске под кэш; изображение остается с временной пирамидой
+            print(f"Pyramid build error for {self.image_path}: {e}")
+            self.pyramid = None
+        finally:
+            # массив нужен только на время построения
+            self.image = None
+
+    def get_pyramid(self):
+        return self.pyramid
@@ -0,0 +1,198 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def calc_image_hash(image):
+    """
+    Хэш содержимого изображения (np.ndarray в формате cv2)
+    """
+    md5 = hashlib.md5(str(image.shape).encode('utf8'))
+    md5.update(image.data if image.flags['C_CONTIGUOUS'] else image.tobytes())
+    return md5.hexdigest()
+
+
+def get_predictor_state(predictor):
+    """
+    Состояние SamPredictor после set_image: признаки энкодера и размеры изображения
+    Для предикторов без поля features (FastSAM) возвращает None - они не кэшируются
+    """
+    if not getattr(predictor, 'is_image_set', False) or getattr(predictor, 'features', None) is None:
+        return None
+
+    state = {'features': predictor.features.detach().cpu(),
+             'original_size': tuple(predictor.original_size),
+             'input_size': tuple(predictor.input_size)}
+
+    # SAM HQ дополнительно хранит промежуточные признаки ViT
+    interm_features = getattr(predictor, 'interm_features', None)
+    if interm_features is not None:
+        state['interm_features'] = [f.detach().cpu() for f in interm_features]
+
+    return state
+
+
+def get_state_size(state):
+    """
+    Размер тензоров состояния предиктора в байтах
+    """
+    tensors = [state['features']] + list(state.get('interm_features', []))
+    return sum(t.element_size() * t.nelement() for t in tensors)
+
+
+def set_predictor_state(predictor, state):
+    """
+    Восстановление состояния SamPredictor без запуска энкодера
+    """
+    device = predictor.model.device
+
+    predictor.reset_image()
+    predictor.features = state['features'].to(device)
+    predictor.original_size = state['original_size']
+    predictor.input_size = state['input_size']
+    if 'interm_features' in state:
+        predictor.interm_features = [f.to(device) for f in state['interm_features']]
+    predictor.is_image_set = True
+
+
+class SAMEmbeddingCache:
+    """
+    Кэш признаков энкодера SAM. Ключ - модель SAM + хэш содержимого изображения
+    Два уровня:
+        в памяти - LRU, при превышении memory_max_mb удаляются давно не использованные (последнее остается всегда)
+        на диске (если задан disk_dir) - файлы .pt, при превышении disk_max_mb удаляются давно не использованные
+    Потокобезопасен: используется из потоков загрузки изображений в SAM
+    """
+
+    def __init__(self, memory_max_mb=512, disk_dir=None, disk_max_mb=2048):
+        self.memory_max_bytes = int(memory_max_mb * 1024 * 1024)
+        self.memory_bytes = 0
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = int(disk_max_mb * 1024 * 1024)
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if self.disk_dir and self.disk_max_bytes > 0:
+            os.makedirs(self.disk_dir, exist_ok=True)
+        else:
+            self.disk_dir = None
+
+    @staticmethod
+    def make_key(image, model_name):
+        return f"{model_name}_{calc_image_hash(image)}"
+
+    def get_disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.pt")
+
+    def contains(self, key):
+        with self.lock:
+            if key in self.memory:
+                return True
+        return bool(self.disk_dir) and os.path.exists(self.get_disk_path(key))
+
+    def get(self, key):
+        """
+        Состояние предиктора по ключу или None
+        Найденное на диске поднимается в память
+        """
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+
+        state = self.read_from_disk(key)
+        with self.lock:
+            if state is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.put_to_memory(key, state)
+        return state
+
+    def put(self, key, state):
+        with self.lock:
+            self.put_to_memory(key, state)
+        self.write_to_disk(key, state)
+
+    def put_to_memory(self, key, state):
+        if key in self.memory:
+            self.memory_bytes -= get_state_size(self.memory[key])
+        self.memory[key] = state
+        self.memory.move_to_end(key)
+        self.memory_bytes += get_state_size(state)
+
+        # SAM HQ ViT-H с interm_features - около 84 Мб на изображение, поэтому ограничение по размеру, а не по числу
+        while len(self.memory) > 1 and self.memory_bytes > self.memory_max_bytes:
+            _, old_state = self.memory.popitem(last=False)
+            self.memory_bytes -= get_state_size(old_state)
+
+    def read_from_disk(self, key):
+        if not self.disk_dir:
+            return None
+
+        path = self.get_disk_path(key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            state = torch.load(path, map_location='cpu')
+        except Exception as e:
+            print(f"Can't read SAM embedding {path}: {e}")
+            return None
+
+        # время доступа для вытеснения давно не использованных
+        os.utime(path)
+        return state
+
+    def write_to_disk(self, key, state):
+        if not self.disk_dir:
+            return
+
+        path = self.get_disk_path(key)
+        tmp_path = path + '.tmp'
+        try:
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Can't save SAM embedding {path}: {e}")
+            return
+
+        self.evict_disk()
+
+    def evict_disk(self):
+        """
+        Удаление давно не использованных файлов, пока кэш на диске больше disk_max_mb
+        """
+        files = []
+        total_size = 0
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith('.pt'):
+                continue
+            path = os.path.join(self.disk_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+
+        files.sort()
+        for mtime, size, path in files:
+            if total_size <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+                total_size -= size
+            except OSError:
+                pass
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'memory_items': len(self.memory),
+                    'memory_mb': self.memory_bytes / (1024 * 1024)}
@@ -1,7 +1,10 @@
+import copy
 import json
 import math
 import os
 import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List
 
 import cv2  # type: ignore
@@ -105,6 +108,94 @@ def create_generator(sam, pred_iou_thresh=0.88, box_nms_thresh=0.7,
     return generator
 
 
+def generate_masks(generator, image, one_image_name=None, pickle_name=None):
+    """
+    Маски SAM для изображения в памяти (np.ndarray в формате cv2, BGR)
+    one_image_name, pickle_name - необязательное сохранение цветной визуализации масок и самих масок (для отладки)
+    Возвращает список бинарных масок
+    """
+    masks = generator.generate(image)
+    if one_image_name:
+        create_one_image_from_masks(masks, one_image_name, pickle_name=pickle_name)
+
+    return [mask['segmentation'] for mask in masks]
+
+
+def clone_generator(generator):
+    """
+    Копия SamAutomaticMaskGenerator с отдельным SamPredictor для той же модели (веса общие),
+    чтобы несколько изображений обрабатывались параллельно
+    Возвращает None, если генератор не поддерживает копирование
+    """
+    predictor = getattr(generator, 'predictor', None)
+    if predictor is None or not hasattr(predictor, 'model'):
+        return None
+
+    clone = copy.copy(generator)
+    clone.predictor = type(predictor)(predictor.model)
+    return clone
+
+
+def crop_to_cv2(crop):
+    """
+    Кроп (PIL.Image в RGB или np.ndarray в формате cv2) -> np.ndarray в формате cv2 (BGR)
+    """
+    if isinstance(crop, Image.Image):
+        return cv2.cvtColor(np.asarray(crop.convert('RGB')), cv2.COLOR_RGB2BGR)
+    return crop
+
+
+def generate_masks_for_crops(generator, crops, max_workers=1, debug_folder=None, on_crop_finished=None):
+    """
+    Маски SAM для списка кропов без промежуточных файлов
+    crops - PIL.Image (RGB) или np.ndarray (BGR)
+    max_workers - число кропов, обрабатываемых одновременно. Каждый поток получает свою копию генератора
+    debug_folder - если задан, сохраняются crop{i}.jpg, crop{i}_sam.jpg и crop{i}.pkl, как в create_masks
+    on_crop_finished - функция (число обработанных кропов), вызывается из потоков обработки
+    Возвращает списки масок в порядке crops
+    """
+    results = [None] * len(crops)
+    finished = [0]
+    lock = threading.Lock()
+
+    generators = [generator]
+    for _ in range(min(max_workers, len(crops)) - 1):
+        clone = clone_generator(generator)
+        if clone is None:
+            break
+        generators.append(clone)
+
+    def process(worker_num):
+        for i in range(worker_num, len(crops), len(generators)):
+            image = crop_to_cv2(crops[i])
+            one_image_name = None
+            pickle_name = None
+            if debug_folder:
+                cv2.imwrite(os.path.join(debug_folder, f'crop{i}.jpg'), image)
+                one_image_name = os.path.join(debug_folder, f'crop{i}_sam.jpg')
+                pickle_name = os.path.join(debug_folder, f'crop{i}.pkl')
+
+            results[i] = generate_masks(generators[worker_num], image, one_image_name=one_image_name,
+                                        pickle_name=pickle_name)
+            with lock:
+                finished[0] += 1
+                finished_num = finished[0]
+            if on_crop_finished:
+                on_crop_finished(finished_num)
+
+    if debug_folder:
+        os.makedirs(debug_folder, exist_ok=True)
+
+    if len(generators) == 1:
+        process(0)
+    else:
+        with ThreadPoolExecutor(max_workers=len(generators)) as executor:
+            # list - чтобы исключения из потоков не терялись
+            list(executor.map(process, range(len(generators))))
+
+    return results
+
+
 def create_masks(generator, input_path, output_path=None, one_image_name=None, pickle_name=None,
                  output_mode="binary_mask"):
     if output_path:
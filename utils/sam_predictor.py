@@ -1,9 +1,11 @@
 import cv2
 import matplotlib.pyplot as plt
 import numpy as np
+import torch
 from segment_anything import SamPredictor, build_sam, build_sam_hq, build_sam_hq_vit_b, build_sam_hq_vit_l
 
-from utils.edges_from_mask import mask_to_polygons_layer
+from utils import help_functions as hf
+from utils.edges_from_mask import mask_to_contours, mask_to_polygons_layer
 from utils.ml_config import SAM_DICT
 from utils.efficient_sam import FastSAMPredictor
 
@@ -130,6 +132,119 @@ def predict_by_box(predictor, input_box, is_best=True):
     return masks
 
 
+def pad_point_sets(point_sets, label_sets):
+    """
+    Наборы точек разной длины -> массивы (N, P, 2) и (N, P)
+    Недостающие точки получают метку -1, SAM их не учитывает
+    """
+    max_len = max(len(points) for points in point_sets)
+    points = np.zeros((len(point_sets), max_len, 2), dtype=np.float32)
+    labels = -np.ones((len(point_sets), max_len), dtype=np.int64)
+    for i, (pts, lbls) in enumerate(zip(point_sets, label_sets)):
+        points[i, :len(pts)] = pts
+        labels[i, :len(lbls)] = lbls
+    return points, labels
+
+
+def predict_batch(predictor, boxes=None, point_sets=None, label_sets=None, multimask_output=False, chunk_size=64):
+    """
+    Декодирование сразу N prompts для изображения, уже загруженного в predictor
+    boxes - np.ndarray (N, 4) [x1, y1, x2, y2] в координатах изображения
+    point_sets, label_sets - N наборов точек [[x, y], ...] и меток 1/0, длина наборов может быть разной
+    Если заданы и boxes, и точки, i-й набор точек относится к i-му боксу
+    Prompts декодируются пачками по chunk_size за один вызов predict_torch
+    При multimask_output из вариантов каждого prompt берется маска с наибольшим score
+    Возвращает (masks - np.ndarray bool (N, H, W), scores - np.ndarray (N,))
+    """
+    if boxes is not None:
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        prompts_num = len(boxes)
+    else:
+        prompts_num = len(point_sets) if point_sets is not None else 0
+
+    height, width = predictor.original_size
+    if prompts_num == 0:
+        return np.zeros((0, height, width), dtype=bool), np.zeros(0, dtype=np.float32)
+
+    points = labels = None
+    if point_sets is not None:
+        points, labels = pad_point_sets(point_sets, label_sets)
+
+    device = predictor.device
+    masks_parts = []
+    scores_parts = []
+    for start in range(0, prompts_num, chunk_size):
+        end = min(start + chunk_size, prompts_num)
+
+        boxes_torch = coords_torch = labels_torch = None
+        if boxes is not None:
+            boxes_torch = predictor.transform.apply_boxes_torch(torch.as_tensor(boxes[start:end], device=device),
+                                                                predictor.original_size)
+        if points is not None:
+            coords_torch = predictor.transform.apply_coords_torch(
+                torch.as_tensor(points[start:end], device=device), predictor.original_size)
+            labels_torch = torch.as_tensor(labels[start:end], device=device)
+
+        with torch.no_grad():
+            masks, scores, _ = predictor.predict_torch(point_coords=coords_torch, point_labels=labels_torch,
+                                                       boxes=boxes_torch, multimask_output=multimask_output)
+
+        # masks (n, variants, H, W), scores (n, variants)
+        best = torch.argmax(scores, dim=1)
+        rows = torch.arange(len(best), device=best.device)
+        masks_parts.append(masks[rows, best].cpu().numpy())
+        scores_parts.append(scores[rows, best].cpu().numpy())
+
+    return np.concatenate(masks_parts), np.concatenate(scores_parts)
+
+
+def masks_to_polygons(masks, simplify_factor=2, min_size=80, fast=False):
+    """
+    Перевод пачки масок (N, H, W) в полигоны
+    Каждая маска обрезается до своего ограничивающего прямоугольника
+    min_size - компоненты маски меньше min_size пикселей отбрасываются, 0 - без очистки
+    fast - контуры cv2 (mask_to_contours, 8-связность, cv2.approxPolyDP), как yolo8masks2points(fast=True)
+           Без fast - прежний путь: hf.clean_mask(connectivity=1) и mask_to_seg с упрощением Shapely
+    Возвращает список длины N, для каждой маски - список полигонов [[x, y], ...] в координатах изображения
+    """
+    masks = np.asarray(masks)
+    if masks.ndim == 2:
+        masks = masks[None]
+
+    rows_any = masks.any(axis=2)  # (N, H)
+    cols_any = masks.any(axis=1)  # (N, W)
+    not_empty = rows_any.any(axis=1)
+    y_min = np.argmax(rows_any, axis=1)
+    y_max = masks.shape[1] - np.argmax(rows_any[:, ::-1], axis=1)
+    x_min = np.argmax(cols_any, axis=1)
+    x_max = masks.shape[2] - np.argmax(cols_any[:, ::-1], axis=1)
+
+    results = []
+    for i in range(len(masks)):
+        if not not_empty[i]:
+            results.append([])
+            continue
+
+        # рамка в 1 пиксель, чтобы контур у края рамки не отличался от контура на полном изображении
+        y0, y1 = max(0, y_min[i] - 1), min(masks.shape[1], y_max[i] + 1)
+        x0, x1 = max(0, x_min[i] - 1), min(masks.shape[2], x_max[i] + 1)
+        mask = masks[i, y0:y1, x0:x1]
+        if not fast:
+            if min_size:
+                mask = hf.clean_mask(mask, type='remove', min_size=min_size, connectivity=1)
+            results.append([[[x + x0, y + y0] for x, y in points]
+                            for points in mask_to_seg(mask, simplify_factor=simplify_factor)])
+            continue
+
+        contours = mask_to_contours(mask, simplify_factor=simplify_factor, is_clear=min_size > 0,
+                                    min_size=min_size)
+
+        shift = np.array([x0, y0], dtype=np.float32)
+        results.append([(contour + shift).astype(np.int32).tolist() for contour in contours])
+
+    return results
+
+
 if __name__ == '__main__':
     # mask_name = "F:\python\\ai_annotator\\test_temp\mask.png"
     # mask = cv2.imread(mask_name)
@@ -0,0 +1,161 @@
+import threading
+
+import cv2
+from PySide2 import QtCore
+
+from utils.sam_embedding_cache import get_predictor_state
+
+
+class SAMPrefetchWorker(QtCore.QThread):
+    """
+    Фоновая загрузка в кэш SAM следующих по списку изображений
+    Энкодер запускается на отдельном SamPredictor с той же моделью, поэтому состояние
+    основного предиктора (текущего изображения) не меняется
+    Новый вызов schedule отменяет еще не начатые задания
+    """
+
+    def __init__(self, predictor, cache, model_name, is_busy=None, encoder_lock=None):
+        """
+        is_busy - функция без аргументов. Пока возвращает True (например, идет загрузка текущего изображения),
+        новые задания не начинаются
+        encoder_lock - threading.Lock, общий с SAMImageSetter. Энкодер работает только под ним, поэтому
+        предзагрузка и загрузка текущего изображения не идут одновременно
+        """
+        super(SAMPrefetchWorker, self).__init__()
+        self.cache = cache
+        self.model_name = model_name
+        self.is_busy = is_busy
+        self.encoder_lock = encoder_lock if encoder_lock is not None else threading.Lock()
+
+        # отдельное состояние изображения, веса модели общие
+        self.predictor = type(predictor)(predictor.model)
+
+        self.queue = []
+        self.generation = 0
+        self.condition = threading.Condition()
+        self.running = True
+
+        self.prefetched = 0
+        self.cancelled = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def is_supported(predictor):
+        """
+        Предзагрузка возможна для предикторов с признаками энкодера (SAM, SAM HQ)
+        """
+        return hasattr(predictor, 'model') and hasattr(predictor, 'features')
+
+    def schedule(self, image_paths):
+        """
+        Новый список изображений для предзагрузки в порядке приоритета. Старые задания отменяются
+        """
+        with self.condition:
+            self.cancelled += len([path for path in self.queue if path not in image_paths])
+            self.queue = list(image_paths)
+            self.generation += 1
+            self.condition.notify()
+
+        if not self.isRunning():
+            self.start(QtCore.QThread.LowPriority)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.queue = []
+            self.condition.notify()
+
+    def register_access(self, is_hit):
+        """
+        Учет обращений к изображениям: было ли изображение уже в кэше при открытии
+        """
+        if is_hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'prefetched': self.prefetched,
+                'cancelled': self.cancelled}
+
+    def next_job(self):
+        with self.condition:
+            while self.running and not self.queue:
+                self.condition.wait()
+            if not self.running:
+                return None, self.generation
+            return self.queue.pop(0), self.generation
+
+    def is_stale(self, image_path, generation):
+        """
+        Пока задание ждало, пользователь мог перейти к другим изображениям
+        """
+        with self.condition:
+            if not self.running:
+                return True
+            if generation == self.generation:
+                return False
+            if image_path in self.queue:
+                # задание осталось в новом списке - выполняем сейчас, а не второй раз
+                self.queue.remove(image_path)
+                return False
+            self.cancelled += 1
+            return True
+
+    def is_foreground_busy(self):
+        return self.is_busy is not None and self.is_busy()
+
+    def acquire_encoder(self):
+        """
+        Захват энкодера, когда он не нужен текущему изображению. Загрузка текущего изображения имеет приоритет:
+        если она началась, пока ждали блокировку, блокировка отдается ей
+        Возвращает False, если работа остановлена
+        """
+        while self.running:
+            if self.is_foreground_busy():
+                self.msleep(50)
+                continue
+
+            self.encoder_lock.acquire()
+            if not self.is_foreground_busy():
+                return True
+            self.encoder_lock.release()
+            self.msleep(50)
+
+        return False
+
+    def run(self):
+        while True:
+            image_path, generation = self.next_job()
+            if image_path is None:
+                return
+
+            if self.is_stale(image_path, generation):
+                continue
+
+            # чтение и хэширование - до захвата энкодера, чтобы не задерживать текущее изображение
+            image = cv2.imread(image_path)
+            if image is None:
+                continue
+
+            key = self.cache.make_key(image, self.model_name)
+            if self.cache.contains(key):
+                continue
+
+            if not self.acquire_encoder():
+                return
+
+            try:
+                # пока ждали энкодер, изображение могло попасть в кэш при загрузке как текущего
+                if not self.running or self.cache.contains(key):
+                    continue
+
+                self.predictor.set_image(image)
+                state = get_predictor_state(self.predictor)
+                if state is not None:
+                    self.cache.put(key, state)
+                    self.prefetched += 1
+                self.predictor.reset_image()
+            finally:
+                self.encoder_lock.release()
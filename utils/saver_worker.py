@@ -1,11 +1,12 @@
 from PySide2 import QtCore
-import json
+import ujson
 
 from collections import namedtuple
 from utils.help_functions import is_dicts_equals
 
 SavedData = namedtuple('SavedData', ('filename', 'json_data'))
 from ui.signals_and_slots import ProjectSaveLoadConn
+from utils.packed_project import is_packed_project, load_packed_project, save_project_data
 
 
 class SaverLoaderWorker(QtCore.QThread):
@@ -37,8 +38,7 @@ class SaverLoaderWorker(QtCore.QThread):
                 self.queue_save.clear()
 
                 self.last_version = last_data
-                with open(last_data.filename, 'w', encoding='utf8') as f:
-                    json.dump(last_data.json_data, f)
+                save_project_data(last_data.json_data, last_data.filename)
                 self.on_save.on_finished.emit(True)
 
         else:
@@ -46,7 +46,10 @@ class SaverLoaderWorker(QtCore.QThread):
                 last_json = self.queue_load[-1]
                 self.queue_load.clear()
 
-                with open(last_json, 'r', encoding='utf8') as f:
-                    self.last_version = SavedData(filename=last_json, json_data=json.load(f))
+                if is_packed_project(last_json):
+                    self.last_version = SavedData(filename=last_json, json_data=load_packed_project(last_json))
+                else:
+                    with open(last_json, 'r', encoding='utf8') as f:
+                        self.last_version = SavedData(filename=last_json, json_data=ujson.load(f))
 
                 self.on_load.on_finished.emit(True)
@@ -254,6 +254,68 @@ class AppSettings:
     def read_sam_model(self):
         return self.qt_settings.value("sam/model_name", 'SAM_HQ_VIT_H')
 
+    def write_sam_cache_memory_size(self, size_mb):
+        self.qt_settings.setValue("sam/cache_memory_mb", size_mb)
+
+    def read_sam_cache_memory_size(self):
+        # объем кэша признаков SAM в памяти, Мб
+        return int(self.qt_settings.value("sam/cache_memory_mb", 512))
+
+    def write_sam_cache_disk_size(self, size_mb):
+        self.qt_settings.setValue("sam/cache_disk_size", size_mb)
+
+    def read_sam_cache_disk_size(self):
+        # 0 - кэш на диске отключен
+        return int(self.qt_settings.value("sam/cache_disk_size", 2048))
+
+    def write_sam_prefetch_num(self, num):
+        self.qt_settings.setValue("sam/prefetch_num", num)
+
+    def read_sam_prefetch_num(self):
+        # сколько следующих изображений загружать в SAM заранее. 0 - без предзагрузки
+        return int(self.qt_settings.value("sam/prefetch_num", 2))
+
+    def write_sam_cache_dir(self, path):
+        self.qt_settings.setValue("sam/cache_dir", path)
+
+    def read_sam_cache_dir(self):
+        return self.qt_settings.value("sam/cache_dir", os.path.join(os.getcwd(), 'sam_cache'))
+
+    def write_sam_crop_workers(self, num):
+        self.qt_settings.setValue("sam/crop_workers", num)
+
+    def read_sam_crop_workers(self):
+        # сколько зон постобработки SAM обрабатывает одновременно
+        # по умолчанию - по платформе SAM: на CPU параллельные кропы только конкурируют за ядра
+        return int(self.qt_settings.value("sam/crop_workers", 2 if self.read_sam_platform() == 'cuda' else 1))
+
+    def write_post_debug_artifacts(self, is_save):
+        self.qt_settings.setValue("sam/post_debug_artifacts", is_save)
+
+    def read_post_debug_artifacts(self):
+        # сохранять кропы и маски SAM постобработки на диск (для отладки)
+        return self.qt_settings.value("sam/post_debug_artifacts", False, type=bool)
+
+    def write_pyramid_cache_dir(self, path):
+        self.qt_settings.setValue("main/pyramid_cache_dir", path)
+
+    def read_pyramid_cache_dir(self):
+        return self.qt_settings.value("main/pyramid_cache_dir", os.path.join(os.getcwd(), 'pyramid_cache'))
+
+    def write_pyramid_cache_size(self, size_mb):
+        self.qt_settings.setValue("main/pyramid_cache_size", size_mb)
+
+    def read_pyramid_cache_size(self):
+        # 0 - пирамиды больших изображений не сохраняются на диск
+        return int(self.qt_settings.value("main/pyramid_cache_size", 8192))
+
+    def write_autosave_interval(self, seconds):
+        self.qt_settings.setValue("main/autosave_interval", seconds)
+
+    def read_autosave_interval(self):
+        # как часто изменения проекта дописываются в журнал, сек. 0 - автосохранение выключено
+        return int(self.qt_settings.value("main/autosave_interval", 60))
+
     def write_seg_model(self, model_name):
         self.qt_settings.setValue("seg/model_name", model_name)
 
@@ -272,6 +334,12 @@ class AppSettings:
     def read_simplify_factor(self):
         return self.qt_settings.value("cnn/simplify_factor", 1.0)
 
+    def write_detector_batch_size(self, batch_size):
+        self.qt_settings.setValue("cnn/batch_size", batch_size)
+
+    def read_detector_batch_size(self):
+        return self.qt_settings.value("cnn/batch_size", 4)
+
     def write_iou_thres(self, iou_thres):
         self.qt_settings.setValue("cnn/iou_thres", iou_thres)
 
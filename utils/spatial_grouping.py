@@ -0,0 +1,85 @@
+import numpy as np
+import shapely
+from shapely import GeometryCollection, STRtree, unary_union
+
+from utils.help_functions import group_pairs
+
+
+def find_close_pairs(geoms, max_dist):
+    """
+    Пары (left, right), left < right, геометрий на расстоянии меньше max_dist
+    Кандидаты ищутся по STRtree по расширенным на max_dist габаритам, расстояние считается сразу для всех пар
+    """
+    tree = STRtree(geoms)
+    bounds = shapely.bounds(geoms)
+    boxes = shapely.box(bounds[:, 0] - max_dist, bounds[:, 1] - max_dist, bounds[:, 2] + max_dist,
+                        bounds[:, 3] + max_dist)
+    left, right = tree.query(boxes)
+
+    is_pair = left < right
+    left = left[is_pair]
+    right = right[is_pair]
+
+    is_close = shapely.distance(geoms[left], geoms[right]) < max_dist
+    return left[is_close], right[is_close]
+
+
+def find_overlapped_pairs(geoms):
+    """
+    Пары (left, right), left < right, геометрий, для которых выполняется overlaps
+    (внутренности пересекаются и ни одна не содержит другую)
+    """
+    tree = STRtree(geoms)
+    left, right = tree.query(geoms, predicate='overlaps')
+
+    is_pair = left < right
+    return left[is_pair], right[is_pair]
+
+
+def merge_groups(geoms, groups, merge='union'):
+    """
+    Объединение геометрий каждой группы
+    merge - 'union' (unary_union) или 'convex_hull' (выпуклая оболочка группы)
+    Одиночные геометрии остаются без изменений и идут первыми в исходном порядке,
+    за ними объединенные группы в порядке первого элемента группы
+    """
+    order = np.argsort(groups, kind='stable')
+    sorted_groups = groups[order]
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    members = np.split(order, starts[1:])
+
+    singles = sorted(m[0] for m in members if len(m) == 1)
+    merged = sorted((m for m in members if len(m) > 1), key=lambda m: m[0])
+
+    results = [geoms[i] for i in singles]
+    for m in merged:
+        if merge == 'convex_hull':
+            results.append(GeometryCollection(list(geoms[m])).convex_hull)
+        else:
+            results.append(unary_union(geoms[m]))
+
+    return results
+
+
+def group_geometries(geoms, max_dist=None, merge='union'):
+    """
+    Группировка и объединение геометрий
+    max_dist - если задан, связаны геометрии на расстоянии меньше max_dist, иначе - перекрывающиеся (overlaps)
+    Пары ищутся за один проход по STRtree, группы - как связные компоненты графа пар
+    После объединения новые геометрии могут оказаться связаны с другими, поэтому проходы повторяются,
+    пока есть что объединять
+    """
+    geoms = np.array(geoms, dtype=object)
+    while len(geoms) > 1:
+        if max_dist is not None:
+            left, right = find_close_pairs(geoms, max_dist)
+        else:
+            left, right = find_overlapped_pairs(geoms)
+
+        if len(left) == 0:
+            break
+
+        groups = group_pairs(len(geoms), left, right)
+        geoms = np.array(merge_groups(geoms, groups, merge=merge), dtype=object)
+
+    return list(geoms)
@@ -0,0 +1,132 @@
+import warnings
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.windows import Window
+
+import utils.help_functions as hf
+
+
+class WindowedImageReader:
+    """
+    Чтение больших изображений (GeoTIFF, JPEG, PNG) по окнам без загрузки всего растра в память
+    Фрагменты возвращаются в формате cv2: np.uint8 (height, width, 3), порядок каналов BGR
+    Пиковая память определяется размером фрагмента, а не размером изображения
+    """
+
+    def __init__(self, image_path):
+        self.image_path = image_path
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', NotGeoreferencedWarning)
+            self.dataset = rasterio.open(image_path)
+
+        self.width = self.dataset.width
+        self.height = self.dataset.height
+        self.bands_num = self.dataset.count
+
+        # первые три канала как RGB, одноканальные изображения - как оттенки серого
+        if self.bands_num >= 3:
+            self.indexes = [1, 2, 3]
+        else:
+            self.indexes = [1, 1, 1]
+
+        # 16-битные и float растры переводятся в uint8 по единому для всего изображения диапазону,
+        # чтобы яркость соседних фрагментов совпадала
+        self.value_range = None
+        if np.dtype(self.dataset.dtypes[0]) != np.uint8:
+            self.value_range = self.calc_value_range()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.dataset:
+            self.dataset.close()
+            self.dataset = None
+
+    def read_window(self, x_min, x_max, y_min, y_max):
+        """
+        Чтение фрагмента [x_min, x_max) x [y_min, y_max)
+        """
+        window = Window(int(x_min), int(y_min), int(x_max) - int(x_min), int(y_max) - int(y_min))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', NotGeoreferencedWarning)
+            data = self.dataset.read(self.indexes, window=window)
+        return self.to_cv2(data, self.value_range)
+
+    def read_overview(self, max_size=2560):
+        """
+        Уменьшенная копия всего изображения, большая сторона не более max_size
+        Использует внутренние обзоры GeoTIFF, если они есть
+        Возвращает (image, (scale_x, scale_y)) - во сколько раз изображение уменьшено по каждой оси
+        """
+        scale = max(1.0, max(self.width, self.height) / float(max_size))
+        out_width = max(1, int(round(self.width / scale)))
+        out_height = max(1, int(round(self.height / scale)))
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', NotGeoreferencedWarning)
+            data = self.dataset.read(self.indexes, out_shape=(len(self.indexes), out_height, out_width),
+                                     resampling=Resampling.average)
+
+        return self.to_cv2(data, self.value_range), (self.width / out_width, self.height / out_height)
+
+    def calc_value_range(self, max_size=1024, percentiles=(2, 98)):
+        """
+        Диапазон значений каждого канала по уменьшенной копии изображения (перцентили, без nodata)
+        Возвращает np.ndarray (bands, 2) [[low, high], ...]
+        """
+        scale = max(1.0, max(self.width, self.height) / float(max_size))
+        out_shape = (len(self.indexes), max(1, int(self.height / scale)), max(1, int(self.width / scale)))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', NotGeoreferencedWarning)
+            data = self.dataset.read(self.indexes, out_shape=out_shape, resampling=Resampling.average)
+
+        return self.calc_data_range(data, nodata=self.dataset.nodata, percentiles=percentiles)
+
+    @staticmethod
+    def calc_data_range(data, nodata=None, percentiles=(2, 98)):
+        data = data.reshape(len(data), -1).astype(np.float64)
+        if nodata is not None:
+            data[data == nodata] = np.nan
+
+        value_range = np.zeros((len(data), 2))
+        for band_num, band in enumerate(data):
+            band = band[np.isfinite(band)]
+            if len(band):
+                value_range[band_num] = np.percentile(band, percentiles)
+        return value_range
+
+    def iterate_fragments(self, frag_size):
+        """
+        Фрагменты для сканирующего окна, разбиение как в hf.calc_parts
+        Возвращает генератор (fragment, [[x_min, x_max], [y_min, y_max]])
+        """
+        crop_x_y_sizes, x_parts_num, y_parts_num = hf.calc_parts(self.width, self.height, frag_size)
+        for x_y_crops in crop_x_y_sizes:
+            x_min, x_max = x_y_crops[0]
+            y_min, y_max = x_y_crops[1]
+            yield self.read_window(x_min, x_max, y_min, y_max), x_y_crops
+
+    @classmethod
+    def to_cv2(cls, data, value_range=None):
+        """
+        (bands, height, width) -> (height, width, 3) BGR uint8
+        value_range - (bands, 2) диапазон значений каналов для данных не uint8, переводится в 0..255
+                      (см. calc_value_range). None - диапазон считается по самим данным
+        """
+        if data.dtype != np.uint8:
+            if value_range is None:
+                value_range = cls.calc_data_range(data)
+            low = value_range[:, 0].reshape(-1, 1, 1)
+            span = np.maximum(value_range[:, 1] - value_range[:, 0], 1e-12).reshape(-1, 1, 1)
+            data = np.nan_to_num((data - low) * (255.0 / span), nan=0.0)
+            data = np.clip(data, 0, 255).astype(np.uint8)
+
+        return np.ascontiguousarray(np.transpose(data[::-1], (1, 2, 0)))
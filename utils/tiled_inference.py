@@ -0,0 +1,158 @@
+import numpy as np
+
+import utils.help_functions as hf
+from utils.detect_yolo8 import predict_and_return_masks_batch, predict_and_return_mask_openvino
+from utils.edges_from_mask import yolo8masks2points
+
+
+def iterate_fragments(img, frag_size):
+    """
+    Фрагменты изображения для сканирующего окна
+    Возвращает генератор (fragment, [[x_min, x_max], [y_min, y_max]])
+    """
+    crop_x_y_sizes, x_parts_num, y_parts_num = hf.calc_parts(img.shape[1], img.shape[0], frag_size)
+    for x_y_crops in crop_x_y_sizes:
+        x_min, x_max = x_y_crops[0]
+        y_min, y_max = x_y_crops[1]
+        yield img[int(y_min):int(y_max), int(x_min):int(x_max), :], x_y_crops
+
+
+def filter_edged_objects(points_list, width, height, tol=5):
+    """
+    Векторизованный аналог hf.filter_edged_points для набора объектов одного фрагмента
+    points_list - список объектов, каждый List([x1,y1], [x2, y2] ... ) или np.ndarray (N, 2)
+    Объект отбрасывается, если хотя бы одна его точка ближе tol к краю фрагмента
+    Возвращает (keep - np.ndarray bool, points_int - список np.ndarray (N, 2) int)
+    """
+    if len(points_list) == 0:
+        return np.zeros(0, dtype=bool), []
+
+    arrays = [np.asarray(points, dtype=float).reshape(-1, 2) for points in points_list]
+    lengths = np.array([len(a) for a in arrays])
+
+    # int() в filter_edged_points отбрасывает дробную часть, astype делает то же самое
+    all_points = np.concatenate(arrays).astype(np.int64)
+    x = all_points[:, 0]
+    y = all_points[:, 1]
+    outside = ~((x > tol) & (x < width - tol) & (y > tol) & (y < height - tol))
+
+    # число точек у края по каждому объекту
+    object_nums = np.repeat(np.arange(len(arrays)), lengths)
+    outside_counts = np.bincount(object_nums[outside], minlength=len(arrays))
+    keep = outside_counts == 0
+
+    points_int = np.split(all_points, np.cumsum(lengths)[:-1])
+
+    return keep, points_int
+
+
+def predict_fragments(model, fragments, model_name='YOLOv8', conf=0.25, iou=0.7, nc=12, simplify_factor=1.0,
+                      batch_size=4, fast_contours=True):
+    """
+    Детекция на фрагментах пачками по batch_size
+    fragments - итератор (fragment, [[x_min, x_max], [y_min, y_max]])
+    Возвращает генератор ([[x_min, x_max], [y_min, y_max]], [(cls_num, points, conf), ...]) для каждого фрагмента
+    """
+    if model_name == 'YOLOv8_openvino':
+        # openvino модель скомпилирована под один кадр
+        batch_size = 1
+
+    batch = []
+    for fragment, part_size in fragments:
+        batch.append((fragment, part_size))
+        if len(batch) == batch_size:
+            yield from _predict_batch(model, batch, model_name, conf, iou, nc, simplify_factor, fast_contours)
+            batch = []
+
+    if batch:
+        yield from _predict_batch(model, batch, model_name, conf, iou, nc, simplify_factor, fast_contours)
+
+
+def _predict_batch(model, batch, model_name, conf, iou, nc, simplify_factor, fast_contours):
+    if model_name == 'YOLOv8_openvino':
+        for fragment, part_size in batch:
+            results = predict_and_return_mask_openvino(model, fragment, conf=conf, iou=iou, save_txt=False, nc=nc)
+            boxes = results["det"]
+            masks = results.get("segment")
+            objects = [(int(lbl), masks[idx].astype(int), obj_conf) for idx, (*xyxy, obj_conf, lbl) in
+                       enumerate(boxes)]
+            yield part_size, objects
+        return
+
+    batch_results = predict_and_return_masks_batch(model, [fragment for fragment, _ in batch], conf=conf, iou=iou,
+                                                   save_txt=False)
+    for (fragment, part_size), res in zip(batch, batch_results):
+        objects = []
+        if res:
+            x_min, x_max = part_size[0]
+            y_min, y_max = part_size[1]
+            for i, mask in enumerate(res['masks']):
+                points_mass = yolo8masks2points(mask, simplify_factor=simplify_factor, width=x_max - x_min,
+                                                height=y_max - y_min, fast=fast_contours)
+                for points in points_mass:
+                    objects.append((res['classes'][i], points, res['confs'][i]))
+        yield part_size, objects
+
+
+def shift_fragment_objects(part_size, objects, tile_num, filter_obj_on_edges=True, edge_tol=5):
+    """
+    Перевод объектов фрагмента в координаты исходного изображения
+    Возвращает список {'cls_num', 'points', 'conf', 'tile'}
+    """
+    x_min, x_max = part_size[0]
+    y_min, y_max = part_size[1]
+
+    if filter_obj_on_edges:
+        keep, points_list = filter_edged_objects([points for _, points, _ in objects], x_max - x_min,
+                                                 y_max - y_min, edge_tol)
+    else:
+        keep = np.ones(len(objects), dtype=bool)
+        points_list = [np.asarray(points).reshape(-1, 2) for _, points, _ in objects]
+
+    shift = np.array([x_min, y_min])
+    results = []
+    for (cls_num, _, conf), points, is_keep in zip(objects, points_list, keep):
+        if not is_keep:
+            continue
+        results.append({'cls_num': int(cls_num), 'points': (points + shift).tolist(), 'conf': conf,
+                        'tile': tile_num})
+
+    return results
+
+
+def merge_tiles_detections(detections, conf_thres=0.2, iou_filter=0.05):
+    """
+    Объединение результатов соседних фрагментов
+    detections - список {'cls_num', 'points', 'conf', 'tile'}
+    Дубликаты убираются hf.filter_masks (индексированный вариант): для каждого объекта из него и следующих
+    за ним объектов того же класса с IoU > iou_filter остается наибольший по площади.
+    Сравниваются все пары, в том числе внутри одного фрагмента и внутри результатов по всему изображению
+    """
+    results = [{k: v for k, v in d.items() if k != 'tile'} for d in detections]
+    return hf.filter_masks(results, conf_thres=conf_thres, iou_filter=iou_filter)
+
+
+def run_tiled_inference(model, fragments, model_name='YOLOv8', conf=0.25, iou=0.7, nc=12, simplify_factor=1.0,
+                        fast_contours=True, batch_size=4, base_results=None, filter_obj_on_edges=True, edge_tol=5,
+                        merge_iou=0.05, fragments_num=None, on_progress=None):
+    """
+    Детекция сканирующим окном
+    fragments - итератор (fragment, [[x_min, x_max], [y_min, y_max]])
+    base_results - результаты по всему изображению, участвуют в объединении как отдельный фрагмент
+    on_progress - функция (done_num, fragments_num) для отображения прогресса
+    """
+    detections = []
+    if base_results:
+        for res in base_results:
+            detections.append({'cls_num': res['cls_num'], 'points': res['points'], 'conf': res['conf'], 'tile': -1})
+
+    for tile_num, (part_size, objects) in enumerate(
+            predict_fragments(model, fragments, model_name=model_name, conf=conf, iou=iou, nc=nc,
+                              simplify_factor=simplify_factor, batch_size=batch_size,
+                              fast_contours=fast_contours)):
+        detections.extend(shift_fragment_objects(part_size, objects, tile_num, filter_obj_on_edges=filter_obj_on_edges,
+                                                 edge_tol=edge_tol))
+        if on_progress:
+            on_progress(tile_num + 1, fragments_num)
+
+    return merge_tiles_detections(detections, conf_thres=conf, iou_filter=merge_iou)